@@ -0,0 +1,273 @@
+# This code benchmarks metric sampling, cpu fan control, LED rendering and
+# dashboard updates on simulated hardware and reports the results as JSON
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+import common
+import led
+import hardware
+import metricstore
+from fan import CPU_FAN, MODES as FAN_MODES
+from display import DashBoard
+from layout import Layout
+
+# Constants
+ITERATIONS = 1000       # Calls measured for every benchmark
+WARMUP = 20             # Calls before measuring, e.g. to fill caches
+SEED = 1985             # Seed of the simulated inputs, so runs are comparable
+STARTS = 5              # Starts of the monitoring program measured
+START_TIMEOUT = 10.0    # Time in seconds a start may take before it is reported as failed
+
+# Audit events of the interpreter that start another process
+PROCESS_EVENTS = ('os.fork', 'os.forkpty', 'os.posix_spawn', 'os.spawn', 'os.system', 'os.exec', 'subprocess.Popen')
+processCount = 0
+
+def countProcesses(event: str, args: tuple) -> None:
+    """
+    Audit hook counting started processes.
+    """
+    global processCount
+    if event in PROCESS_EVENTS:
+        processCount += 1
+
+def percentile(values: list[float], ratio: float) -> float:
+    """
+    Returns percentile of sorted values.
+    values: sorted values.
+    ratio: percentile 0.0-1.0.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(ratio * len(values)))]
+
+def measure(function, inputs: list, iterations: int = ITERATIONS) -> dict:
+    """
+    Measures a function called with one input after the other.
+    function: function taking one input.
+    inputs: inputs cycled through.
+    iterations: count of measured calls.
+    Returns dictionary of latency, cpu time, memory and process statistics.
+    """
+    global processCount
+    for i in range(WARMUP):
+        function(inputs[i % len(inputs)])
+
+    latencies = []
+    processCount = 0
+    cpuStart = time.process_time_ns()
+    for i in range(iterations):
+        value = inputs[i % len(inputs)]
+        start = time.perf_counter_ns()
+        function(value)
+        latencies.append(time.perf_counter_ns() - start)
+    cpuTime = time.process_time_ns() - cpuStart
+    processes = processCount
+
+    # Separate pass for memory, tracing slows every allocation down
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for i in range(iterations):
+        function(inputs[i % len(inputs)])
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'p50Us': round(percentile(latencies, 0.50) / 1000, 2),
+        'p99Us': round(percentile(latencies, 0.99) / 1000, 2),
+        'maxUs': round(latencies[-1] / 1000, 2),
+        'cpuUsPerCall': round(cpuTime / iterations / 1000, 2),
+        'peakBytes': peak,
+        'retainedBlocksPerCall': round(blocks / iterations, 3),
+        'processesPerCall': round(processes / iterations, 3),
+    }
+
+def simulatedSnapshots(count: int) -> list[common.SystemSnapshot]:
+    """
+    Creates snapshots of a random walk through typical values.
+    count: count of snapshots.
+    Returns list of snapshots.
+    """
+    generator = random.Random(SEED)
+    temperature = 45.0
+    load = 10.0
+    snapshots = []
+    for _ in range(count):
+        temperature = min(85.0, max(35.0, temperature + generator.uniform(-1.0, 1.0)))
+        load = min(100.0, max(0.0, load + generator.uniform(-8.0, 8.0)))
+        snapshots.append(common.SystemSnapshot(round(load, 1), round(temperature, 1), '192.168.1.20', 0.9, round(generator.uniform(0.3, 0.5), 1), 29.3, 12.4, 58.6, 20.1))
+    return snapshots
+
+def recordedSnapshots(path: str) -> list[common.SystemSnapshot]:
+    """
+    Reads snapshots persisted by the metric store.
+    path: metric store file.
+    Returns list of snapshots.
+    """
+    return [common.SystemSnapshot(round(record[2], 1), round(record[1], 1), '192.168.1.20', 0.9, round(record[3], 1), 29.3, round(record[4], 1), 58.6, round(record[5], 1))
+            for record in metricstore.query(path)]
+
+def benchmarkSampling(iterations: int) -> dict:
+    """
+    Measures every getter of the common library and a whole snapshot.
+    """
+    results = {}
+    getters = ['getCpuTemperature', 'getCpuLoad', 'getIP', 'getTotalRam', 'getUsedRam', 'getTotalSd', 'getUsedSd', 'getTotalUsb', 'getUsedUsb']
+    for name in getters:
+        getter = getattr(common, name)
+        results[f'common.{name}'] = measure(lambda _: getter(), [None], iterations)
+    results['common.snapshot'] = measure(lambda _: common.snapshot(), [None], iterations)
+    common.cache.invalidate()
+    results['common.snapshot.uncached'] = measure(lambda _: (common.cache.invalidate(), common.snapshot()), [None], iterations)
+    return results
+
+def benchmarkFan(snapshots: list, iterations: int) -> dict:
+    """
+    Measures cpu fan control in every mode.
+    """
+    results = {}
+    for mode in FAN_MODES:
+        fan = CPU_FAN(hardware.SimulatedGPIO(), 8, mode)
+        results[f'fan.setCpuFanSpeed.{mode}'] = measure(lambda snapshot: fan.setCpuFanSpeed(snapshot.cpuTemperature, snapshot.cpuLoad), snapshots, iterations)
+    return results
+
+def benchmarkLed(iterations: int, count: int) -> dict:
+    """
+    Measures frame generation and writing of every LED effect.
+    """
+    results = {}
+    backend = hardware.SimulatedBackend()
+    strip = led.init(count, 18, backend)
+    writer = led.StripWriter(strip)
+    state = led.LedState(55.0, 80, 20.0)
+    for name, effect in led.EFFECTS.items():
+        instance = effect(writer.count)
+        results[f'led.{name}'] = measure(lambda t: writer.write(instance.frame(t, state)), [i * led.WAIT_MS / 1000 for i in range(256)], iterations)
+    return results
+
+def benchmarkDashboard(snapshots: list, iterations: int) -> dict:
+    """
+    Measures tile rendering and display transfer of dashboard updates.
+    """
+    results = {}
+    backend = hardware.SimulatedBackend()
+    screen = backend.display()
+    dashBoard = DashBoard(screen)
+    dashBoard.initializeTiles(snapshots[0])
+    sent = screen.bytesSent
+    results['display.updateDashboard'] = measure(dashBoard.updateDashboard, snapshots, iterations)
+    results['display.updateDashboard']['bytesPerUpdate'] = round((screen.bytesSent - sent) / (2 * iterations + WARMUP), 1)
+
+    history = common.SnapshotHistory()
+    for snapshot in snapshots[:common.HISTORY_LENGTH]:
+        history.record(snapshot)
+    sparkline = DashBoard(backend.display(), Layout([['ip', 'gauges', 'bar:ram', 'bar:sd', 'sparkline:cpuTemperature']]))
+    sparkline.initializeTiles(snapshots[0], history)
+    results['display.updateDashboard.sparkline'] = measure(lambda snapshot: (history.record(snapshot), sparkline.updateDashboard(snapshot)), snapshots, iterations)
+    return results
+
+def benchmarkTick(snapshots: list, iterations: int, count: int) -> dict:
+    """
+    Measures a whole tick of the monitoring loop without waiting: sampling,
+    cpu fan control, LED engine update and dashboard update.
+    """
+    backend = hardware.SimulatedBackend()
+    fan = CPU_FAN(backend.gpio(), 8)
+    strip = led.init(count, 18, backend)
+    engine = led.LedEngine(strip)
+    dashBoard = DashBoard(backend.display())
+    dashBoard.initializeTiles(snapshots[0])
+
+    def tick(recorded: common.SystemSnapshot) -> None:
+        common.snapshot()
+        isFanOn = fan.setCpuFanSpeed(recorded.cpuTemperature, recorded.cpuLoad)
+        engine.update(recorded.cpuTemperature, fan.dutyCycle, recorded.cpuLoad)
+        engine.setEffect('rainbow' if isFanOn else 'off')
+        dashBoard.updateDashboard(recorded)
+
+    return {'monitoring.tick': measure(tick, snapshots, iterations)}
+
+def benchmarkStartup(starts: int) -> dict:
+    """
+    Measures time from process start to the first cpu fan decision of the
+    monitoring program on simulated hardware, as written to its log.
+    """
+    seconds = []
+    for _ in range(starts):
+        with tempfile.TemporaryDirectory() as directory:
+            log = os.path.join(directory, 'monitoring.log')
+            process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'monitoring.py'), '--simulate', '-g', '0', '-l', log])
+            deadline = time.monotonic() + START_TIMEOUT
+            decision = None
+            while decision is None and time.monotonic() < deadline:
+                time.sleep(0.05)
+                if os.path.exists(log):
+                    with open(log) as file:
+                        decision = next((line.split()[-4] for line in file if 'First cpu fan decision' in line), None)
+            process.send_signal(signal.SIGINT)
+            process.wait()
+            if decision is None:
+                raise RuntimeError('Monitoring program made no cpu fan decision')
+            seconds.append(float(decision))
+    seconds.sort()
+    return {'monitoring.firstFanDecision': {'starts': starts, 'medianS': seconds[len(seconds) // 2], 'maxS': seconds[-1]}}
+
+if __name__ == '__main__':
+    # Parse imput parameters to get benchmark configuration
+    parser = argparse.ArgumentParser(description='Benchmark sampling, cpu fan control, LED rendering and dashboard updates')
+    parser.add_argument('-i', '--iterations', default=ITERATIONS, type=int, help='measured calls of every benchmark')
+    parser.add_argument('-d', '--data', default=None, type=str, help='metric store file with recorded inputs, simulated inputs by default')
+    parser.add_argument('-c', '--count', default=4, type=int, help='count of LED pixels')
+    parser.add_argument('-o', '--output', default=None, type=str, help='JSON output file, standard output by default')
+    parser.add_argument('-b', '--benchmark', default=[], action='append', choices=['sampling', 'fan', 'led', 'dashboard', 'tick', 'startup'], help='benchmark to run, all by default')
+    args = parser.parse_args()
+
+    sys.addaudithook(countProcesses)
+    snapshots = recordedSnapshots(args.data) if args.data is not None else []
+    if not snapshots:
+        snapshots = simulatedSnapshots(common.HISTORY_LENGTH)
+    selected = args.benchmark or ['sampling', 'fan', 'led', 'dashboard', 'tick', 'startup']
+
+    results = {}
+    if 'sampling' in selected:
+        results.update(benchmarkSampling(args.iterations))
+    if 'fan' in selected:
+        results.update(benchmarkFan(snapshots, args.iterations))
+    if 'led' in selected:
+        results.update(benchmarkLed(args.iterations, args.count))
+    if 'dashboard' in selected:
+        results.update(benchmarkDashboard(snapshots, args.iterations))
+    if 'tick' in selected:
+        results.update(benchmarkTick(snapshots, args.iterations, args.count))
+    if 'startup' in selected:
+        results.update(benchmarkStartup(STARTS))
+
+    report = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpuCount': os.cpu_count(),
+        'inputs': args.data or 'simulated',
+        'results': results,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
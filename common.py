@@ -1,20 +1,866 @@
 # This library provides common funtionality utilized by othe modules
 
-import subprocess as sp
+import os
+import re
+import time
+import math
+import fcntl
+import select
+import socket
+import struct
+import threading
 import psutil
+from array import array
+
+# Bits of the firmware throttle flags as reported by 'vcgencmd get_throttled', the same conditions are kept
+# 16 bits higher once they occurred since boot
+THROTTLE_FLAGS = {0: 'UV', 1: 'CAP', 2: 'THR', 3: 'SOFT'}   # under-voltage, arm frequency capped, throttled, soft temperature limit
+THROTTLE_OCCURRED_SHIFT = 16
+UNDER_VOLTAGE_FLAG = 0b0001     # supply voltage is too low
+CLOCK_THROTTLE_FLAGS = 0b0110   # arm frequency capped or throttled, because of heat or of under-voltage
+SOFT_LIMIT_FLAG = 0b1000        # soft temperature limit is active, caused by heat only
+
+class SensorEngine:
+    """
+    Reads system metrics directly from /proc, /sys and the kernel interfaces
+    instead of forking shell tools. Pseudo files are opened once and re-read
+    from offset 0 on every call, so a sample costs a few syscalls only.
+    """
+
+    # Constants
+    __THERMAL_ZONE = '/sys/class/thermal/thermal_zone0/temp'   # SoC temperature in milli degrees
+    __MEMINFO = '/proc/meminfo'                                 # kernel memory statistics
+    __UPTIME = '/proc/uptime'                                   # seconds since boot
+    __MOUNTS = '/proc/self/mounts'                              # currently mounted file systems
+    __ROUTES = '/proc/net/route'                                # IPv4 routing table
+    __NET_STATISTICS = '/sys/class/net/{}/statistics/{}'        # byte counters of a network interface
+    __THROTTLED = '/sys/devices/platform/soc/soc:firmware/get_throttled'   # firmware throttle flags in hex
+    __CPU_FREQUENCY = '/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq'  # actual arm clock in kHz
+    __READ_SIZE = 8192                                          # enough for every pseudo file read here but the mount table
+    __SIOCGIFADDR = 0x8915                                      # ioctl request to get interface address
+    __MIB = 1024 * 1024                                         # bytes in one MiB
+
+    def __init__(self):
+        self.__files = {}
+        self.__socket = None
+
+    def readCpuTemperature(self) -> float:
+        """
+        Reads SoC temperature from the thermal zone.
+        Returns temperature in grad celcius with one floating point digit or 0.0 if not available.
+        """
+        res = self.__read(self.__THERMAL_ZONE)
+        if res != '':
+            return round(int(res) / 1000, 1)
+        return 0.0
+
+    def readThrottled(self) -> int:
+        """
+        Reads throttle and under-voltage flags from the firmware driver, the same
+        bitfield 'vcgencmd get_throttled' prints without starting a process.
+        Returns throttle flags or 0 if not available.
+        """
+        res = self.__read(self.__THROTTLED)
+        if res != '':
+            return int(res, 16)
+        return 0
+
+    def readCpuFrequency(self) -> int:
+        """
+        Reads the actual arm clock of the first core, all cores share it on the Raspberry Pi.
+        Returns clock in MHz or 0 if not available.
+        """
+        res = self.__read(self.__CPU_FREQUENCY)
+        if res != '':
+            return int(res) // 1000
+        return 0
+
+    def readUptime(self) -> float:
+        """
+        Reads time since boot.
+        Returns uptime in seconds or 0.0 if not available.
+        """
+        res = self.__read(self.__UPTIME)
+        if res != '':
+            return float(res.split()[0])
+        return 0.0
+
+    def readMemInfo(self) -> dict[str, int]:
+        """
+        Reads kernel memory statistics.
+        Returns dictionary of meminfo fields with values in kB.
+        """
+        info = {}
+        for line in self.__read(self.__MEMINFO).splitlines():
+            key, _, value = line.partition(':')
+            fields = value.split()
+            if fields:
+                info[key] = int(fields[0])
+        return info
+
+    def readRam(self) -> tuple[int, int]:
+        """
+        Reads total and used RAM the same way 'free' does.
+        Returns tuple of total and used RAM in Mi.
+        """
+        info = self.readMemInfo()
+        total = info.get('MemTotal', 0)
+        if 'MemAvailable' in info:
+            used = total - info['MemAvailable']
+        else:
+            used = total - info.get('MemFree', 0) - info.get('Buffers', 0) - info.get('Cached', 0) - info.get('SReclaimable', 0)
+        return (total // 1024, used // 1024)
+
+    def findMountPoint(self, device: str) -> str:
+        """
+        Looks up where a block device is mounted.
+        device: device path as shown by 'df', e.g. '/dev/sda1'.
+        Returns mount point or empty string if device is not mounted.
+        """
+        return self.readMounts().get(device, '')
+
+    def readMounts(self) -> dict[str, str]:
+        """
+        Reads mounted block devices, loop devices of snap packages and images are left out.
+        Returns dictionary of device paths and their first mount point in mount order.
+        """
+        mounts = {}
+        for line in self.__read(self.__MOUNTS, True).splitlines():
+            fields = line.split()
+            if len(fields) > 1 and fields[0].startswith('/dev/') and not fields[0].startswith('/dev/loop'):
+                mounts.setdefault(decodeMountField(fields[0]), decodeMountField(fields[1]))
+        return mounts
+
+    def readDisk(self, mountPoint: str) -> tuple[int, int]:
+        """
+        Reads disk usage of a mounted file system the same way 'df -m' does.
+        mountPoint: path of the mounted file system.
+        Returns tuple of total and used memory in Mi or zeros if not available.
+        """
+        if mountPoint == '':
+            return (0, 0)
+        try:
+            stat = os.statvfs(mountPoint)
+        except OSError:
+            return (0, 0)
+        total = math.ceil(stat.f_blocks * stat.f_frsize / self.__MIB)
+        used = math.ceil((stat.f_blocks - stat.f_bfree) * stat.f_frsize / self.__MIB)
+        return (total, used)
+
+    def readIP(self) -> str:
+        """
+        Reads IPv4 address of the interface holding the default route, so with both
+        'eth0' and 'wlan0' up the address the tower is reached by is shown. Falls back
+        to the first address of all non loopback interfaces like 'hostname -I' does.
+        Returns IPv4 address as a string or empty string if there is none.
+        """
+        default = self.readDefaultInterface()
+        for name in ([default] if default != '' else []) + self.readInterfaces():
+            ip = self.readInterfaceAddress(name)
+            if ip != '':
+                return ip
+        return ''
+
+    def readInterfaces(self) -> list[str]:
+        """
+        Reads names of all non loopback network interfaces.
+        Returns list of interface names.
+        """
+        try:
+            return [name for _, name in socket.if_nameindex() if name != 'lo']
+        except OSError:
+            return []
+
+    def readDefaultInterface(self) -> str:
+        """
+        Reads the interface of the IPv4 default route with the lowest metric.
+        Returns interface name or empty string if there is no default route.
+        """
+        best = ('', float('inf'))
+        for line in self.__read(self.__ROUTES).splitlines()[1:]:
+            fields = line.split()
+            if len(fields) > 7 and fields[1] == '00000000' and fields[7] == '00000000' and int(fields[6]) < best[1]:
+                best = (fields[0], int(fields[6]))
+        return best[0]
+
+    def readInterfaceCounters(self, name: str) -> tuple[int, int]:
+        """
+        Reads received and transmitted byte counters of a network interface.
+        name: interface name, e.g. 'wlan0'.
+        Returns tuple of received and transmitted bytes or zeros if not available.
+        """
+        received = self.__read(self.__NET_STATISTICS.format(name, 'rx_bytes'))
+        transmitted = self.__read(self.__NET_STATISTICS.format(name, 'tx_bytes'))
+        if received == '' or transmitted == '':
+            return (0, 0)
+        return (int(received), int(transmitted))
+
+    def readInterfaceAddress(self, name: str) -> str:
+        """
+        Reads IPv4 address of a network interface through ioctl.
+        name: interface name, e.g. 'wlan0'.
+        Returns IPv4 address as a string or empty string if interface has no address.
+        """
+        if self.__socket is None:
+            self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            res = fcntl.ioctl(self.__socket.fileno(), self.__SIOCGIFADDR, struct.pack('256s', name[:15].encode()))
+        except OSError:
+            return ''
+        return socket.inet_ntoa(res[20:24])
+
+    def close(self) -> None:
+        """Closes all kept open file handles and sockets."""
+        for fd in self.__files.values():
+            os.close(fd)
+        self.__files.clear()
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+
+    def __read(self, path: str, unbounded: bool = False) -> str:
+        """
+        Reads whole pseudo file from offset 0 keeping its handle open for the next call.
+        path: path of the file to read.
+        unbounded: grow the buffer until the whole file fits, e.g. for the mount table of a host with many mounts.
+        Returns file content or empty string if file is not readable.
+        """
+        try:
+            fd = self.__files.get(path)
+            if fd is None:
+                fd = os.open(path, os.O_RDONLY)
+                self.__files[path] = fd
+            size = self.__READ_SIZE
+            data = os.pread(fd, size, 0)
+            while unbounded and len(data) == size:
+                # A full buffer may end in a partial line, read again from offset 0 so the table stays consistent
+                size *= 2
+                data = os.pread(fd, size, 0)
+            return data.decode().strip()
+        except (OSError, ValueError):
+            fd = self.__files.pop(path, None)
+            if fd is not None:
+                os.close(fd)
+            return ''
+
+sensors = SensorEngine()
+
+def decodeMountField(field: str) -> str:
+    """
+    Decodes a field of the mount table, the kernel writes space, tab, newline and backslash as octal escapes like '\\040'.
+    field: field as read from '/proc/self/mounts'.
+    Returns decoded field.
+    """
+    return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), field)
+
+class ChangeWatcher:
+    """
+    Counts kernel notifications of one kind. Pending notifications are drained
+    without blocking, so any number of consumers can subscribe and every one
+    of them learns about a change exactly once.
+    """
+
+    def __init__(self):
+        self.__generation = 0
+
+    @property
+    def generation(self) -> int:
+        """Count of changes seen so far, pending notifications are drained first."""
+        if self._drain():
+            self.__generation += 1
+        return self.__generation
+
+    def subscribe(self):
+        """
+        Creates a change check for one consumer.
+        Returns function returning True if a change happened since its last call.
+        """
+        seen = self.generation
+
+        def hasChanged() -> bool:
+            nonlocal seen
+            generation = self.generation
+            changed = generation != seen
+            seen = generation
+            return changed
+        return hasChanged
+
+    def close(self) -> None:
+        pass
+
+    def _drain(self) -> bool:
+        """
+        Consumes pending notifications without blocking.
+        Returns state if any notification was pending.
+        """
+        return False
+
+class AddressWatcher(ChangeWatcher):
+    """
+    Listens on a netlink route socket for link and IPv4 address changes,
+    so cached network values can be dropped right when they become stale.
+    """
+
+    # Constants
+    __RTMGRP_LINK = 0x1           # multicast group of link state changes
+    __RTMGRP_IPV4_IFADDR = 0x10   # multicast group of IPv4 address changes
+    __RECV_SIZE = 65536           # netlink messages are drained in chunks of this size
+
+    def __init__(self):
+        super().__init__()
+        try:
+            self.__socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            self.__socket.bind((0, self.__RTMGRP_LINK | self.__RTMGRP_IPV4_IFADDR))
+            self.__socket.setblocking(False)
+        except (OSError, AttributeError):
+            self.__socket = None
+
+    def close(self) -> None:
+        """Closes the netlink socket."""
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+
+    def _drain(self) -> bool:
+        changed = False
+        while self.__socket is not None:
+            try:
+                self.__socket.recv(self.__RECV_SIZE)
+            except BlockingIOError:
+                break
+            except OSError:
+                # Receive buffer overran, changes were lost
+                changed = True
+                break
+            changed = True
+        return changed
+
+class MountWatcher(ChangeWatcher):
+    """
+    Polls the mount table for changes. The kernel flags '/proc/self/mounts' with
+    POLLPRI whenever a file system is mounted or unmounted.
+    """
+
+    # Constants
+    __MOUNTS = '/proc/self/mounts'
+
+    def __init__(self):
+        super().__init__()
+        try:
+            self.__fd = os.open(self.__MOUNTS, os.O_RDONLY)
+            self.__poll = select.poll()
+            self.__poll.register(self.__fd, select.POLLPRI)
+        except (OSError, AttributeError):
+            self.__fd = None
+
+    def close(self) -> None:
+        """Closes the mount table."""
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+    def _drain(self) -> bool:
+        if self.__fd is None:
+            return False
+        return bool(self.__poll.poll(0))
+
+def isExternalMount(mountPoint: str) -> bool:
+    """
+    Tells if a file system is an additional drive like a USB disk or an NVMe
+    drive rather than the root or boot file system of the tower.
+    mountPoint: mount point of the file system.
+    """
+    return mountPoint != '/' and mountPoint != '/boot' and not mountPoint.startswith('/boot/')
+
+class DeviceDiscovery:
+    """
+    Keeps the mounted block devices and the network interfaces of the system.
+    Both are read once and read again only when the mount table or netlink
+    reports a change, so sampling never rescans the system.
+    """
+
+    def __init__(self, sensors: SensorEngine, mountWatcher: ChangeWatcher, addressWatcher: ChangeWatcher):
+        """
+        Discovers devices and interfaces.
+        sensors: sensor engine to read from.
+        mountWatcher: watcher of mount table changes.
+        addressWatcher: watcher of link and address changes.
+        """
+        self.__sensors = sensors
+        self.__mountsChanged = mountWatcher.subscribe()
+        self.__linksChanged = addressWatcher.subscribe()
+        self.__devices = sensors.readMounts()
+        self.__interfaces = sensors.readInterfaces()
+        self.__counters = {}
+
+    def devices(self) -> dict[str, str]:
+        """
+        Returns dictionary of mounted block devices and their mount points in mount order.
+        """
+        if self.__mountsChanged():
+            self.__devices = self.__sensors.readMounts()
+        return self.__devices
+
+    def externalDevices(self) -> list[str]:
+        """
+        Returns mounted block devices holding neither the root nor the boot file system.
+        """
+        return [device for device, mountPoint in self.devices().items() if isExternalMount(mountPoint)]
+
+    def interfaces(self) -> list[str]:
+        """
+        Returns names of the non loopback network interfaces.
+        """
+        if self.__linksChanged():
+            self.__interfaces = self.__sensors.readInterfaces()
+        return self.__interfaces
+
+    def readUsage(self) -> dict[str, tuple[str, int, int]]:
+        """
+        Reads disk usage of every mounted block device.
+        Returns dictionary of device paths and tuples of mount point, total and used memory in Mi.
+        """
+        return {device: (mountPoint,) + self.__sensors.readDisk(mountPoint) for device, mountPoint in self.devices().items()}
+
+    def readExternalDisk(self) -> tuple[int, int]:
+        """
+        Reads disk usage of the first additional drive, e.g. the USB disk.
+        Returns tuple of total and used memory in Mi or zeros if there is no such drive.
+        """
+        devices = self.externalDevices()
+        if not devices:
+            return (0, 0)
+        return self.__sensors.readDisk(self.devices()[devices[0]])
+
+    def readAddresses(self) -> dict[str, str]:
+        """
+        Reads IPv4 address of every network interface.
+        Returns dictionary of interface names and addresses, empty string for interfaces without one.
+        """
+        return {name: self.__sensors.readInterfaceAddress(name) for name in self.interfaces()}
+
+    def readThroughput(self) -> dict[str, tuple[float, float]]:
+        """
+        Reads throughput of every network interface since the previous call.
+        Returns dictionary of interface names and tuples of received and transmitted bytes per second, zeros on the first call.
+        """
+        now = time.monotonic()
+        throughput = {}
+        counters = {}
+        for name in self.interfaces():
+            received, transmitted = self.__sensors.readInterfaceCounters(name)
+            counters[name] = (now, received, transmitted)
+            previous = self.__counters.get(name)
+            if previous is None or now <= previous[0] or received < previous[1] or transmitted < previous[2]:
+                throughput[name] = (0.0, 0.0)
+            else:
+                elapsed = now - previous[0]
+                throughput[name] = ((received - previous[1]) / elapsed, (transmitted - previous[2]) / elapsed)
+        self.__counters = counters
+        return throughput
+
+# Default refresh intervals in seconds for each cached metric
+REFRESH_INTERVALS = {
+    'cpuLoad': 1.0,
+    'cpuTemperature': 1.0,
+    'ram': 5.0,
+    'sd': 60.0,
+    'usb': 60.0,
+    'ip': 300.0,
+    'disks': 60.0,
+    'addresses': 300.0,
+    'network': 5.0,
+    'uptime': 60.0,
+    'throttled': 1.0,
+    'frequency': 1.0,
+    'cores': 1.0,
+}
+EXPIRY_TOLERANCE = 0.1  # Share of the refresh interval values expire early, so a loop sampling at the same period never gets the previous value
+
+class MetricCache:
+    """
+    Keeps the last value of each registered metric reader and only calls the
+    reader again once the refresh interval of that metric has passed. Every
+    metric has its own lock, so threads sampling at the same time never run a
+    reader twice, e.g. measuring the cpu load over a near zero interval.
+    """
+
+    def __init__(self):
+        self.__readers = {}
+        self.__locks = {}
+        self.__intervals = {}
+        self.__watchers = {}
+        self.__values = {}
+        self.__expires = {}
+        self.__hits = {}
+        self.__misses = {}
+
+    def register(self, name: str, reader, interval: float, watcher=None) -> None:
+        """
+        Registers a metric reader.
+        name: unique name of the metric.
+        reader: function without arguments returning the metric value.
+        interval: refresh interval in seconds.
+        watcher: optional function returning True if the value has to be read again right away.
+        """
+        self.__readers[name] = reader
+        self.__locks[name] = threading.Lock()
+        self.__intervals[name] = interval
+        self.__watchers[name] = watcher
+        self.__hits[name] = 0
+        self.__misses[name] = 0
+        self.invalidate(name)
+
+    def setInterval(self, name: str, interval: float) -> None:
+        """
+        Changes refresh interval of a metric.
+        name: name of the registered metric.
+        interval: new refresh interval in seconds.
+        """
+        if name not in self.__readers:
+            raise KeyError(f'Unknown metric: {name}')
+        self.__intervals[name] = interval
+        self.invalidate(name)
+
+    def get(self, name: str):
+        """
+        Reads a metric from cache or from its reader if cached value is expired.
+        name: name of the registered metric.
+        Returns metric value.
+        """
+        watcher = self.__watchers[name]
+        with self.__locks[name]:
+            now = time.monotonic()
+            if now < self.__expires[name] and (watcher is None or not watcher()):
+                self.__hits[name] += 1
+                return self.__values[name]
+
+            self.__misses[name] += 1
+            value = self.__readers[name]()
+            self.__values[name] = value
+            self.__expires[name] = now + self.__intervals[name] * (1.0 - EXPIRY_TOLERANCE)
+            return value
+
+    def invalidate(self, name: str = None) -> None:
+        """
+        Drops cached values so they are read again on the next access.
+        name: name of the metric to invalidate, all metrics if not given.
+        """
+        names = self.__readers.keys() if name is None else [name]
+        for key in names:
+            self.__expires[key] = 0.0
+            self.__values.pop(key, None)
+
+    def stats(self) -> dict[str, tuple[int, int]]:
+        """
+        Returns dictionary of hit and miss counters for each metric.
+        """
+        return {name: (self.__hits[name], self.__misses[name]) for name in self.__readers}
+
+cache = MetricCache()
+
+# Kernel watchers and discovered devices, created by 'start'
+addressWatcher = None
+mountWatcher = None
+discovery = None
+
+def start() -> None:
+    """
+    Opens the kernel watchers, discovers drives and interfaces and registers
+    all cached metrics. Importing this library has no side effects, sampling
+    starts it on first use. Later calls do nothing.
+    """
+    global addressWatcher, mountWatcher, discovery
+    if discovery is not None:
+        return
+    addressWatcher = AddressWatcher()
+    mountWatcher = MountWatcher()
+    discovery = DeviceDiscovery(sensors, mountWatcher, addressWatcher)
+
+    cache.register('cpuLoad', lambda: psutil.cpu_percent(None), REFRESH_INTERVALS['cpuLoad'])
+    cache.register('cpuTemperature', sensors.readCpuTemperature, REFRESH_INTERVALS['cpuTemperature'])
+    cache.register('ram', sensors.readRam, REFRESH_INTERVALS['ram'])
+    cache.register('sd', lambda: sensors.readDisk('/'), REFRESH_INTERVALS['sd'])
+    cache.register('usb', discovery.readExternalDisk, REFRESH_INTERVALS['usb'], mountWatcher.subscribe())
+    cache.register('ip', sensors.readIP, REFRESH_INTERVALS['ip'], addressWatcher.subscribe())
+    cache.register('disks', discovery.readUsage, REFRESH_INTERVALS['disks'], mountWatcher.subscribe())
+    cache.register('addresses', discovery.readAddresses, REFRESH_INTERVALS['addresses'], addressWatcher.subscribe())
+    cache.register('network', discovery.readThroughput, REFRESH_INTERVALS['network'])
+    cache.register('uptime', sensors.readUptime, REFRESH_INTERVALS['uptime'])
+    cache.register('throttled', sensors.readThrottled, REFRESH_INTERVALS['throttled'])
+    cache.register('frequency', sensors.readCpuFrequency, REFRESH_INTERVALS['frequency'])
+    cache.register('cores', lambda: tuple(psutil.cpu_percent(None, percpu=True)), REFRESH_INTERVALS['cores'])
+
+def stop() -> None:
+    """Closes the kernel watchers and all kept open files."""
+    global addressWatcher, mountWatcher, discovery
+    if discovery is not None:
+        addressWatcher.close()
+        mountWatcher.close()
+        addressWatcher = mountWatcher = discovery = None
+    sensors.close()
+
+class SystemSnapshot:
+    """
+    Holds all metrics of the system sampled at one moment, so every consumer
+    acts on the same readings.
+    """
+
+    __slots__ = ('cpuLoad', 'cpuTemperature', 'ip', 'totalRam', 'usedRam', 'totalSd', 'usedSd', 'totalUsb', 'usedUsb', 'disks', 'network', 'uptime',
+                 'throttled', 'cpuFrequency', 'coreLoads', 'ramMi', 'disksMi', 'sampled')
+
+    def __init__(self, cpuLoad: float = 0.0, cpuTemperature: float = 0.0, ip: str = '', totalRam: float = 0.0, usedRam: float = 0.0,
+                 totalSd: float = 0.0, usedSd: float = 0.0, totalUsb: float = 0.0, usedUsb: float = 0.0,
+                 disks: dict[str, tuple[str, float, float]] = None, network: dict[str, tuple[str, float, float]] = None, uptime: float = 0.0,
+                 throttled: int = 0, cpuFrequency: int = 0, coreLoads: tuple[float, ...] = (), ramMi: tuple[int, int] = None,
+                 disksMi: dict[str, tuple[int, int]] = None, sampled: frozenset[str] = None):
+        self.cpuLoad = cpuLoad
+        self.cpuTemperature = cpuTemperature
+        self.ip = ip
+        self.totalRam = totalRam
+        self.usedRam = usedRam
+        self.totalSd = totalSd
+        self.usedSd = usedSd
+        self.totalUsb = totalUsb
+        self.usedUsb = usedUsb
+        self.disks = {} if disks is None else disks         # device: (mount point, total Gi, used Gi)
+        self.network = {} if network is None else network   # interface: (IPv4 address, received bytes/s, transmitted bytes/s)
+        self.uptime = uptime
+        self.throttled = throttled          # firmware throttle flags, see 'THROTTLE_FLAGS'
+        self.cpuFrequency = cpuFrequency    # arm clock in MHz
+        self.coreLoads = coreLoads          # load of every core in percent
+        # Readings in Mi the values in Gi are rounded from, taken from the values in Gi if not given
+        self.ramMi = (round(totalRam * 1000), round(usedRam * 1000)) if ramMi is None else ramMi
+        self.disksMi = {device: (round(total * 1000), round(used * 1000)) for device, (_, total, used) in self.disks.items()} if disksMi is None else disksMi
+        self.sampled = sampled              # names of the cached metrics read for this snapshot, None if all of them
+
+    def copy(self) -> 'SystemSnapshot':
+        """
+        Returns shallow copy of the snapshot.
+        """
+        return SystemSnapshot(*(getattr(self, name) for name in self.__slots__))
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'SystemSnapshot({fields})'
+
+def snapshot(metrics: set[str] = None, previous: SystemSnapshot = None) -> SystemSnapshot:
+    """
+    Samples all metrics in one pass. Memory statistics and disk usage are read
+    once and shared between total and used values. Each metric is taken from
+    the cache as long as its refresh interval has not passed.
+    metrics: names of the cached metrics to sample, all if not given.
+    previous: snapshot the values of metrics not sampled are kept from, defaults if not given.
+    Returns snapshot of the current system state.
+    """
+    start()
+    result = SystemSnapshot() if previous is None else previous.copy()
+    result.sampled = None if metrics is None else frozenset(metrics)
+    if metrics is None or 'cpuLoad' in metrics:
+        result.cpuLoad = cache.get('cpuLoad')
+    if metrics is None or 'cpuTemperature' in metrics:
+        result.cpuTemperature = cache.get('cpuTemperature')
+    if metrics is None or 'ip' in metrics:
+        result.ip = cache.get('ip')
+    if metrics is None or 'ram' in metrics:
+        totalRam, usedRam = cache.get('ram')
+        result.ramMi = (totalRam, usedRam)
+        result.totalRam = round(totalRam / 1000, 1)
+        result.usedRam = round(usedRam / 1000, 1)
+    if metrics is None or 'sd' in metrics:
+        totalSd, usedSd = cache.get('sd')
+        result.totalSd = round(totalSd / 1000, 1)
+        result.usedSd = round(usedSd / 1000, 1)
+    if metrics is None or 'usb' in metrics:
+        totalUsb, usedUsb = cache.get('usb')
+        result.totalUsb = round(totalUsb / 1000, 1)
+        result.usedUsb = round(usedUsb / 1000, 1)
+    if metrics is None or 'disks' in metrics:
+        disks = cache.get('disks')
+        result.disks = {device: (mountPoint, round(total / 1000, 1), round(used / 1000, 1)) for device, (mountPoint, total, used) in disks.items()}
+        result.disksMi = {device: (total, used) for device, (_, total, used) in disks.items()}
+    if metrics is None or 'network' in metrics or 'addresses' in metrics:
+        addresses = cache.get('addresses')
+        result.network = {name: (addresses.get(name, ''), received, transmitted) for name, (received, transmitted) in cache.get('network').items()}
+    if metrics is None or 'uptime' in metrics:
+        result.uptime = cache.get('uptime')
+    if metrics is None or 'throttled' in metrics:
+        result.throttled = cache.get('throttled')
+    if metrics is None or 'frequency' in metrics:
+        result.cpuFrequency = cache.get('frequency')
+    if metrics is None or 'cores' in metrics:
+        result.coreLoads = cache.get('cores')
+    return result
+
+def isHeatThrottled(flags: int) -> bool:
+    """
+    Tells if the SoC is throttled because of heat, so the cpu fan can do something about it.
+    The firmware caps and throttles the clock on under-voltage too, then a faster fan would
+    only draw more current from the sagging supply.
+    flags: throttle flags as read by 'SensorEngine.readThrottled'.
+    """
+    if flags & SOFT_LIMIT_FLAG:
+        return True
+    return bool(flags & CLOCK_THROTTLE_FLAGS) and not flags & UNDER_VOLTAGE_FLAG
+
+def throttleConditions(flags: int) -> list[str]:
+    """
+    Decodes firmware throttle flags.
+    flags: throttle flags as read by 'SensorEngine.readThrottled'.
+    Returns list of short names of the active conditions like 'SOFT', followed by
+    lower case names of the conditions only occurred since boot.
+    """
+    active = [name for bit, name in THROTTLE_FLAGS.items() if flags & (1 << bit)]
+    occurred = [name.lower() for bit, name in THROTTLE_FLAGS.items() if flags & (1 << (bit + THROTTLE_OCCURRED_SHIFT)) and not flags & (1 << bit)]
+    return active + occurred
+
+# Count of samples kept in history, one hour at one sample per second
+HISTORY_LENGTH = 3600
+
+class MetricHistory:
+    """
+    Fixed size ring buffer of metric samples. Values and timestamps are kept in
+    preallocated arrays, so recording a sample allocates no python objects and
+    memory use does not grow over time.
+    """
+
+    def __init__(self, capacity: int = HISTORY_LENGTH):
+        """
+        Creates an empty history.
+        capacity: count of samples to keep, older samples are overwritten.
+        """
+        self.__capacity = capacity
+        self.__values = array('f', bytes(4 * capacity))
+        self.__times = array('d', bytes(8 * capacity))
+        self.__next = 0
+        self.__count = 0
+        self.__total = 0
+
+    def __len__(self) -> int:
+        return self.__count
+
+    @property
+    def capacity(self) -> int:
+        """Count of samples the history can hold."""
+        return self.__capacity
+
+    @property
+    def total(self) -> int:
+        """Count of samples appended since creation, including overwritten ones."""
+        return self.__total
+
+    def append(self, value: float, timestamp: float = None) -> None:
+        """
+        Records a sample, overwriting the oldest one if the history is full.
+        value: metric value.
+        timestamp: unix time of the sample, current time if not given.
+        """
+        self.__values[self.__next] = value
+        self.__times[self.__next] = time.time() if timestamp is None else timestamp
+        self.__next = (self.__next + 1) % self.__capacity
+        self.__count = min(self.__count + 1, self.__capacity)
+        self.__total += 1
+
+    def last(self) -> float:
+        """
+        Returns the most recent value or 0.0 if the history is empty.
+        """
+        if self.__count == 0:
+            return 0.0
+        return self.__values[self.__next - 1]
+
+    def values(self, count: int = None) -> array:
+        """
+        Copies the most recent values in chronological order.
+        count: count of values, all kept values if not given.
+        Returns array of values.
+        """
+        return self.__slice(self.__values, count)
+
+    def timestamps(self, count: int = None) -> array:
+        """
+        Copies the timestamps of the most recent values in chronological order.
+        count: count of timestamps, all kept timestamps if not given.
+        Returns array of unix times.
+        """
+        return self.__slice(self.__times, count)
+
+    def stats(self, count: int = None) -> tuple[float, float, float]:
+        """
+        Computes minimum, maximum and average of the most recent values.
+        count: count of values, all kept values if not given.
+        Returns tuple of minimum, maximum and average or zeros if the history is empty.
+        """
+        values = self.values(count)
+        if not values:
+            return (0.0, 0.0, 0.0)
+        return (min(values), max(values), sum(values) / len(values))
+
+    def downsample(self, buckets: int, count: int = None) -> tuple[array, array, array]:
+        """
+        Reduces the most recent values to a fixed count of buckets.
+        buckets: count of buckets, less if there are not enough values.
+        count: count of values to reduce, all kept values if not given.
+        Returns tuple of arrays with minimum, maximum and average of every bucket, oldest first.
+        """
+        values = self.values(count)
+        buckets = min(buckets, len(values))
+        mins = array('f', bytes(4 * buckets))
+        maxs = array('f', bytes(4 * buckets))
+        avgs = array('f', bytes(4 * buckets))
+        for bucket in range(buckets):
+            part = values[bucket * len(values) // buckets:(bucket + 1) * len(values) // buckets]
+            mins[bucket] = min(part)
+            maxs[bucket] = max(part)
+            avgs[bucket] = sum(part) / len(part)
+        return (mins, maxs, avgs)
+
+    def __slice(self, data: array, count: int) -> array:
+        count = self.__count if count is None else min(count, self.__count)
+        start = (self.__next - count) % self.__capacity
+        if start + count <= self.__capacity:
+            return data[start:start + count]
+        return data[start:] + data[:self.__next]
+
+class SnapshotHistory:
+    """
+    Keeps a history of every numeric metric of the sampled snapshots.
+    """
+
+    # Metrics of 'SystemSnapshot' recorded in history and the cached metrics they are read from
+    METRICS = {'cpuTemperature': 'cpuTemperature', 'cpuLoad': 'cpuLoad', 'usedRam': 'ram', 'usedSd': 'sd', 'usedUsb': 'usb'}
+
+    def __init__(self, capacity: int = HISTORY_LENGTH):
+        """
+        Creates empty histories.
+        capacity: count of samples to keep for each metric.
+        """
+        self.__histories = {name: MetricHistory(capacity) for name in self.METRICS}
+
+    def record(self, snapshot: SystemSnapshot, timestamp: float = None) -> None:
+        """
+        Records the metrics sampled for a snapshot, values kept from an older snapshot are left out.
+        snapshot: sampled system state.
+        timestamp: unix time of the snapshot, current time if not given.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        for name, history in self.__histories.items():
+            if snapshot.sampled is None or self.METRICS[name] in snapshot.sampled:
+                history.append(getattr(snapshot, name), timestamp)
+
+    def metric(self, name: str) -> MetricHistory:
+        """
+        Returns history of one metric.
+        name: name of a recorded metric.
+        """
+        return self.__histories[name]
 
 def getCpuTemperature() -> float:
     """
-    Reads current SoC temperature from VideoCore command tool.
+    Reads current SoC temperature from the thermal zone.
     Returns cpu temperature in grad celcius with one floating point digit.
     """
-    res = sp.getoutput("vcgencmd measure_temp|egrep -o '[0-9]*\.[0-9]*'")
-    # Only for debug and testing purposes
-    #f = open('/home/pi/Projects/Raspberry/Monitoring/cpu_temp.txt', 'r')
-    #res = f.read()
-    if res != '':
-        return float(res)
-    return 0.0
+    return sensors.readCpuTemperature()
 
 def getCpuLoad() -> float:
     """
@@ -28,64 +874,48 @@ def getIP() -> str:
     Read own IP address.
     Returns IPv4 address as a string.
     """
-    return sp.getoutput("hostname -I | cut -d' ' -f1")
+    return sensors.readIP()
 
 def getTotalRam() -> float:
     """
     Reads total RAM.
     Returns total RAM amount in Gi.
     """
-    res = sp.getoutput("free -m | awk 'NR==2 {printf \"%s\", $2}'")
-    if res != '':
-        return round(float(res) / 1000, 1)
-    return 0.0
+    return round(sensors.readRam()[0] / 1000, 1)
 
 def getUsedRam() -> float:
     """
     Reads used RAM.
     Returns used RAM amount in Gi.
     """
-    res = sp.getoutput("free -m | awk 'NR==2 {printf \"%s\", $3}'")
-    if res != '':
-        return round(float(res) / 1000, 1)
-    return 0.0
+    return round(sensors.readRam()[1] / 1000, 1)
 
 def getTotalSd() -> float:
     """
     Reads total sd card memory.
     Returns total sd card memory in Gi.
     """
-    res = sp.getoutput("df -m | grep -w '/dev/root' | awk '{printf \"%s\", $2}'")
-    if res != '':
-        return round(float(res) / 1000, 1)
-    return 0.0
+    return round(sensors.readDisk('/')[0] / 1000, 1)
 
 def getUsedSd() -> float:
     """
     Reads used sd card memory.
     Return used sd card memory in Gi.
     """
-    res = sp.getoutput("df -m | grep -w '/dev/root' | awk '{printf \"%s\", $3}'")
-    if res != '':
-        return round(float(res) / 1000, 1)
-    return 0.0
+    return round(sensors.readDisk('/')[1] / 1000, 1)
 
 def getTotalUsb() -> float:
     """
     Reads total usb card memory.
     Return total usb card memory in Gi.
     """
-    res = sp.getoutput("df -m | grep -w '/dev/sda1' | awk '{printf \"%s\", $2}'")
-    if res != '':
-        return round(float(res) / 1000, 1)
-    return 0.0
+    start()
+    return round(discovery.readExternalDisk()[0] / 1000, 1)
 
 def getUsedUsb() -> float:
     """
     Reads used usb card memory.
     Return used usb card memory in Gi.
     """
-    res = sp.getoutput("df -m | grep -w '/dev/sda1' | awk '{printf \"%s\", $3}'")
-    if res != '':
-        return round(float(res) / 1000, 1)
-    return 0.0
+    start()
+    return round(discovery.readExternalDisk()[1] / 1000, 1)
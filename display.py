@@ -1,11 +1,100 @@
 # This code shows main information of raspberry pi system on a display
 
+import os
 import math
-import Adafruit_SSD1306 as SSD
+import time
 
 from PIL import Image, ImageDraw, ImageFont
 
 import common
+import sprites
+import hardware
+import layout
+from instrumentation import profiler
+
+# Locations of the dashboard font, the copy next to this file is used off the Pi
+FONT_PATHS = ['/home/pi/.fonts/SoletoTK.ttf', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SoletoTK.ttf')]
+
+def fontPath() -> str:
+    """
+    Returns first existing location of the dashboard font.
+    """
+    for path in FONT_PATHS:
+        if os.path.exists(path):
+            return path
+    return FONT_PATHS[0]
+
+
+def mergeBox(box: list[float], other: list[float]) -> list[float]:
+    """
+    Merges two bounding boxes.
+    box: first box [x0, y0, x1, y1] or None.
+    other: second box [x0, y0, x1, y1] or None.
+    Returns bounding box covering both boxes.
+    """
+    if other is None:
+        return box
+    if box is None:
+        return list(other)
+    return [min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3])]
+
+def lineBox(line: list[float]) -> list[float]:
+    """
+    Returns bounding box of a line [x0, y0, x1, y1].
+    """
+    return [min(line[0], line[2]), min(line[1], line[3]), max(line[0], line[2]), max(line[1], line[3])]
+
+def compactNumber(value: float) -> str:
+    """
+    Formats a value for the narrow display, large values drop their decimal digit.
+    value: value to format.
+    Returns formatted value.
+    """
+    return f'{value:.0f}' if value >= 100 else f'{value}'
+
+def formatRate(value: float) -> str:
+    """
+    Formats bytes per second with a unit prefix, e.g. '12.3k'.
+    value: bytes per second.
+    Returns formatted value.
+    """
+    if value >= 1e6:
+        return f'{value / 1e6:.1f}M'
+    if value >= 1e3:
+        return f'{value / 1e3:.1f}k'
+    return f'{value:.0f}'
+
+def formatUptime(seconds: float) -> str:
+    """
+    Formats uptime as days, hours and minutes, e.g. '3d 04:12'.
+    seconds: uptime in seconds.
+    Returns formatted uptime.
+    """
+    minutes = int(seconds) // 60
+    return f'{minutes // 1440}d {minutes // 60 % 24:02d}:{minutes % 60:02d}'
+
+def deviceLabels(devices: list[str]) -> list[str]:
+    """
+    Creates short labels of block devices fitting a bar tile, e.g. 'USB' for '/dev/sda1'
+    or 'NVMe' for '/dev/nvme0n1p2'. Devices of the same kind are numbered.
+    devices: device paths.
+    Returns list of labels in the order of the devices.
+    """
+    kinds = []
+    for device in devices:
+        name = os.path.basename(device)
+        if name.startswith('sd'):
+            kinds.append('USB')
+        elif name.startswith('nvme'):
+            kinds.append('NVMe')
+        elif name.startswith('mmcblk'):
+            kinds.append('MMC')
+        else:
+            kinds.append(name[:4].upper())
+    labels = []
+    for index, kind in enumerate(kinds):
+        labels.append(f'{kind}{kinds[:index + 1].count(kind)}' if kinds.count(kind) > 1 else kind)
+    return labels
 
 
 class CpuLoadTile():
@@ -16,42 +105,49 @@ class CpuLoadTile():
     __INK_BKG = 0
     __WIDTH = 1
 
-    def __init__(self, center: tuple[float, float], draw: ImageDraw, font: ImageFont):
+    def __init__(self, center: tuple[float, float], draw: ImageDraw, glyphs: sprites.GlyphCache):
         self.__center = center
         self.__draw = draw
-        self.__font = font
+        self.__glyphs = glyphs
+        self.__needle = sprites.NeedleTable(self.__RADIUS)
 
         self.__textLocation = (self.__center[0] * 0.1, self.__center[1] + 1)
         self.__value = -1.0
         self.__line = [0, 0, 0, 0]
         self.__text = ''
+        self.__dirtyBox = None
 
         self.__drawArc()
 
     def updateValue(self, cpuLoad: float) -> None:
         if cpuLoad != self.__value:
             self.__value = cpuLoad
-            angle = 1.8 * cpuLoad
 
             # Remove privious arrow and redraw arc line
+            self.__markDirty(lineBox(self.__line))
             self.__draw.line(self.__line, self.__INK_BKG, self.__WIDTH)
             self.__drawArcLine()
 
             # Draw new arrow
-            arrowEnd = self.__getArrowEnd(angle)
-            self.__line = [self.__center[0], self.__center[1], arrowEnd[0], arrowEnd[1]]
+            dx, dy = self.__needle.offset(cpuLoad)
+            self.__line = [self.__center[0], self.__center[1], self.__center[0] - dx, self.__center[1] - dy]
             self.__draw.line(self.__line, self.__INK, self.__WIDTH)
+            self.__markDirty(lineBox(self.__line))
 
             # Remove privious text and draw a new one
-            self.__draw.text(self.__textLocation, self.__text, self.__INK_BKG, self.__font)
+            self.__markDirty(self.__glyphs.eraseText(self.__textLocation, self.__text, self.__INK_BKG))
             self.__text = f'{cpuLoad}%'
-            self.__draw.text(self.__textLocation, self.__text, self.__INK, self.__font)
+            self.__markDirty(self.__glyphs.drawText(self.__textLocation, self.__text, self.__INK))
 
-    def __getArrowEnd(self, angle: float) -> tuple[float, float]:
-        angle *= math.pi / 180
-        x = self.__center[0] - self.__RADIUS * 0.85 * math.cos(angle)
-        y = self.__center[1] - self.__RADIUS * 0.85 * math.sin(angle)
-        return (x, y)
+    def popDirtyBox(self) -> list[float]:
+        """
+        Returns bounding box of everything redrawn since the last call or None if nothing changed.
+        """
+        box, self.__dirtyBox = self.__dirtyBox, None
+        return box
+
+    def __markDirty(self, box: list[float]) -> None:
+        self.__dirtyBox = mergeBox(self.__dirtyBox, box)
 
     def __drawArc(self) -> None:
         arcBox = [self.__center[0] - self.__RADIUS, self.__center[1] - self.__RADIUS, self.__center[0] + self.__RADIUS, self.__center[1] + self.__RADIUS]
@@ -59,7 +155,9 @@ class CpuLoadTile():
         self.__drawArcLine()
 
     def __drawArcLine(self) -> None:
-        self.__draw.line([self.__center[0] - self.__RADIUS, self.__center[1], self.__center[0] + self.__RADIUS, self.__center[1]], self.__INK, self.__WIDTH)
+        line = [self.__center[0] - self.__RADIUS, self.__center[1], self.__center[0] + self.__RADIUS, self.__center[1]]
+        self.__draw.line(line, self.__INK, self.__WIDTH)
+        self.__markDirty(lineBox(line))
 
 class CpuTemperatureTile():
 
@@ -69,42 +167,49 @@ class CpuTemperatureTile():
     __INK_BKG = 0
     __WIDTH = 1
 
-    def __init__(self, center: tuple[float, float], draw: ImageDraw, font: ImageFont):
+    def __init__(self, center: tuple[float, float], draw: ImageDraw, glyphs: sprites.GlyphCache):
         self.__center = center
         self.__draw = draw
-        self.__font = font
+        self.__glyphs = glyphs
+        self.__needle = sprites.NeedleTable(self.__RADIUS)
 
         self.__textLocation = (self.__center[0] * 0.1, self.__center[1])
         self.__value = -1.0
         self.__line = [0, 0, 0, 0]
         self.__text = ''
+        self.__dirtyBox = None
 
         self.__drawArc()
 
     def updateValue(self, cpuTemp: float) -> None:
         if cpuTemp != self.__value:
             self.__value = cpuTemp
-            angle = 1.8 * cpuTemp
 
             # Remove privious arrow and redraw arc line
+            self.__markDirty(lineBox(self.__line))
             self.__draw.line(self.__line, self.__INK_BKG, self.__WIDTH)
             self.__drawArcLine()
 
             # Draw new arrow
-            arrowEnd = self.__getArrowEnd(angle)
-            self.__line = [self.__center[0], self.__center[1] + self.__RADIUS, arrowEnd[0], arrowEnd[1] + self.__RADIUS]
+            dx, dy = self.__needle.offset(cpuTemp)
+            self.__line = [self.__center[0], self.__center[1] + self.__RADIUS, self.__center[0] + dx, self.__center[1] + dy + self.__RADIUS]
             self.__draw.line(self.__line, self.__INK, self.__WIDTH)
+            self.__markDirty(lineBox(self.__line))
 
             # Remove privious text and draw a new one
-            self.__draw.text(self.__textLocation, self.__text, self.__INK_BKG, self.__font)
+            self.__markDirty(self.__glyphs.eraseText(self.__textLocation, self.__text, self.__INK_BKG))
             self.__text = f'{cpuTemp}\'C'
-            self.__draw.text(self.__textLocation, self.__text, self.__INK, self.__font)
+            self.__markDirty(self.__glyphs.drawText(self.__textLocation, self.__text, self.__INK))
+
+    def popDirtyBox(self) -> list[float]:
+        """
+        Returns bounding box of everything redrawn since the last call or None if nothing changed.
+        """
+        box, self.__dirtyBox = self.__dirtyBox, None
+        return box
 
-    def __getArrowEnd(self, angle: float) -> tuple[float, float]:
-        angle *= math.pi / 180
-        x = self.__center[0] + self.__RADIUS * 0.85 * math.cos(angle)
-        y = self.__center[1] + self.__RADIUS * 0.85 * math.sin(angle)
-        return (x, y)
+    def __markDirty(self, box: list[float]) -> None:
+        self.__dirtyBox = mergeBox(self.__dirtyBox, box)
 
     def __drawArc(self) -> None:
         arcBox = [self.__center[0] - self.__RADIUS, self.__center[1], self.__center[0] + self.__RADIUS, self.__center[1] + self.__RADIUS * 2]
@@ -112,7 +217,9 @@ class CpuTemperatureTile():
         self.__drawArcLine()
 
     def __drawArcLine(self) -> None:
-        self.__draw.line([self.__center[0] - self.__RADIUS, self.__center[1] + self.__RADIUS, self.__center[0] + self.__RADIUS, self.__center[1] + self.__RADIUS], self.__INK, self.__WIDTH)
+        line = [self.__center[0] - self.__RADIUS, self.__center[1] + self.__RADIUS, self.__center[0] + self.__RADIUS, self.__center[1] + self.__RADIUS]
+        self.__draw.line(line, self.__INK, self.__WIDTH)
+        self.__markDirty(lineBox(line))
 
 class IpTile():
 
@@ -120,23 +227,34 @@ class IpTile():
     __INK = 0
     __INK_BKG = 128
 
-    def __init__(self, location: tuple[float, float], draw: ImageDraw, font: ImageFont, fontSize: float, displayWidth: float):
+    def __init__(self, location: tuple[float, float], draw: ImageDraw, glyphs: sprites.GlyphCache, fontSize: float, displayWidth: float):
         self.__location = location
         self.__draw = draw
-        self.__font = font
+        self.__glyphs = glyphs
 
         self.__width = displayWidth - location[0]
         self.__height = fontSize + 2
         self.__textLocation = [location[0] + self.__height + 5, location[1] - 1]
         self.__text = ''
+        self.__dirtyBox = None
 
         self.__drawBackground()
 
     def updateValue(self, ip: str) -> None:
         if self.__text != ip:
-            self.__draw.text(self.__textLocation, self.__text, self.__INK_BKG, self.__font)
+            self.__markDirty(self.__glyphs.eraseText(self.__textLocation, self.__text, self.__INK_BKG))
             self.__text = ip
-            self.__draw.text(self.__textLocation, self.__text, self.__INK, self.__font)
+            self.__markDirty(self.__glyphs.drawText(self.__textLocation, self.__text, self.__INK))
+
+    def popDirtyBox(self) -> list[float]:
+        """
+        Returns bounding box of everything redrawn since the last call or None if nothing changed.
+        """
+        box, self.__dirtyBox = self.__dirtyBox, None
+        return box
+
+    def __markDirty(self, box: list[float]) -> None:
+        self.__dirtyBox = mergeBox(self.__dirtyBox, box)
 
     def __drawBackground(self) -> None:
         # Draw rectangle
@@ -152,10 +270,10 @@ class BarTile():
     __INK = 255
     __INK_BKG = 0
 
-    def __init__(self, location: tuple[float, float], draw: ImageDraw, font: ImageFont, fontSize: float, displayWidth: float, name: str, maxValue: float, unit: str):
+    def __init__(self, location: tuple[float, float], draw: ImageDraw, glyphs: sprites.GlyphCache, fontSize: float, displayWidth: float, name: str, maxValue: float, unit: str):
         self.__location = location
         self.__draw = draw
-        self.__font = font
+        self.__glyphs = glyphs
         self.__name = name
         self.__maxValue = maxValue
         self.__unit = unit
@@ -166,79 +284,430 @@ class BarTile():
         self.__value = -1.0
         self.__rectFill = [0, 0, 0, 0]
         self.__text = ''
+        self.__dirtyBox = None
 
         self.__drawBar()
 
+    def setLabel(self, name: str, maxValue: float) -> None:
+        """
+        Shows another quantity in the bar, it is redrawn on the next update.
+        name: label of the quantity.
+        maxValue: value of a full bar.
+        """
+        if name != self.__name or maxValue != self.__maxValue:
+            self.__name = name
+            self.__maxValue = maxValue
+            self.__value = -1.0
+
     def updateValue(self, actual: float) -> None:
         if actual != self.__value:
             self.__value = actual
             # Redraw text
-            self.__draw.text(self.__location, self.__text, self.__INK_BKG, self.__font)
-            self.__text = f'{self.__name}: {actual}/{self.__maxValue} {self.__unit}'
-            self.__draw.text(self.__location, self.__text, self.__INK, self.__font)
+            self.__markDirty(self.__glyphs.eraseText(self.__location, self.__text, self.__INK_BKG))
+            self.__text = f'{self.__name}: {compactNumber(actual)}/{compactNumber(self.__maxValue)} {self.__unit}'
+            self.__markDirty(self.__glyphs.drawText(self.__location, self.__text, self.__INK))
 
             # Redraw bar
+            self.__markDirty(self.__rectFill)
             self.__draw.rectangle(self.__rectFill, self.__INK_BKG, 0)
-            percentage = actual / self.__maxValue
+            percentage = actual / self.__maxValue if self.__maxValue > 0 else 0.0
             self.__rectFill = [self.__barLocation[0] + 1, self.__barLocation[1] + 1, self.__barLocation[0] + 1 + (self.__barWidth - 3) * percentage, self.__barLocation[1] + self.__barHeight - 1]
             self.__draw.rectangle(self.__rectFill, self.__INK, 0)
+            self.__markDirty(self.__rectFill)
+
+    def popDirtyBox(self) -> list[float]:
+        """
+        Returns bounding box of everything redrawn since the last call or None if nothing changed.
+        """
+        box, self.__dirtyBox = self.__dirtyBox, None
+        return box
+
+    def __markDirty(self, box: list[float]) -> None:
+        self.__dirtyBox = mergeBox(self.__dirtyBox, box)
 
     def __drawBar(self) -> None:
         rect = [self.__barLocation[0], self.__barLocation[1], self.__barLocation[0] + self.__barWidth - 1, self.__barLocation[1] + self.__barHeight]
         self.__draw.rectangle(rect, self.__INK_BKG, self.__INK, 1)
 
-class DashBoard():
+class SparklineTile():
 
     # Constants
-    __RST = None        # On the PiOLED this pin isnt used
-    __FONT_SIZE = 10    # Font size
+    __INK = 255
+    __INK_BKG = 0
+    __MIN_SPAN = 5.0    # Smallest value range of the graph, so sensor noise is not blown up
 
-    def __init__(self, gpio):
-        self.__disp = SSD.SSD1306_128_64(rst=self.__RST, gpio=gpio)                        # 128x64 display with hardware I2C
-        self.__image = Image.new('1', (self.__disp.width, self.__disp.height))  # Create blank image for drawing. Make sure to create image with mode '1' for 1-bit color.
-        self.__draw = ImageDraw.Draw(self.__image)                              # Get drawing object to draw on image.
-        self.__font = ImageFont.truetype('/home/pi/.fonts/SoletoTK.ttf', self.__FONT_SIZE)      # Define a new true type font for drawing text
+    def __init__(self, location: tuple[float, float], draw: ImageDraw, glyphs: sprites.GlyphCache, displayWidth: float, bottom: float, name: str, history: common.MetricHistory, span: int):
+        self.__location = location
+        self.__draw = draw
+        self.__glyphs = glyphs
+        self.__history = history
+
+        labelBox = glyphs.drawText(location, name, self.__INK)
+        self.__graphBox = [labelBox[2] + 3, location[1] + 2, displayWidth - 1, bottom - 1]
+        self.__columns = self.__graphBox[2] - self.__graphBox[0] - 1
+        self.__samplesPerColumn = max(1, span // self.__columns)
+        self.__step = -1
+        self.__dirtyBox = None
+
+        self.__draw.rectangle(self.__graphBox, self.__INK_BKG, self.__INK, 1)
+
+    def updateValue(self) -> None:
+        # Graph only moves once enough samples for a new column were recorded
+        step = self.__history.total // self.__samplesPerColumn
+        if step != self.__step:
+            self.__step = step
+            self.__drawGraph()
+
+    def popDirtyBox(self) -> list[float]:
+        """
+        Returns bounding box of everything redrawn since the last call or None if nothing changed.
+        """
+        box, self.__dirtyBox = self.__dirtyBox, None
+        return box
+
+    def __markDirty(self, box: list[float]) -> None:
+        self.__dirtyBox = mergeBox(self.__dirtyBox, box)
+
+    def __drawGraph(self) -> None:
+        left, top, right, bottom = self.__graphBox
+        inner = [left + 1, top + 1, right - 1, bottom - 1]
+        self.__draw.rectangle(inner, self.__INK_BKG, 0)
+        self.__markDirty(inner)
+
+        # Only complete columns are drawn from the right, so the time scale stays the same while the history fills
+        columns = min(self.__columns, len(self.__history) // self.__samplesPerColumn)
+        if columns == 0:
+            return
+        mins, maxs, _ = self.__history.downsample(columns, columns * self.__samplesPerColumn)
+        low = min(mins)
+        high = max(max(maxs), low + self.__MIN_SPAN)
+        height = inner[3] - inner[1]
+
+        # Newest column on the right, every column spans from minimum to maximum of its samples
+        x = inner[2] - len(mins) + 1
+        for lowValue, highValue in zip(mins, maxs):
+            y0 = inner[3] - round((highValue - low) / (high - low) * height)
+            y1 = inner[3] - round((lowValue - low) / (high - low) * height)
+            self.__draw.line([x, y0, x, y1], self.__INK, 1)
+            x += 1
+
+class TextTile():
 
-        self.__disp.begin()     # Initialize display library
-        self.__disp.clear()     # Clear display
-        self.__disp.display()   # Invalidate display
+    # Constants
+    __INK = 255
+    __INK_BKG = 0
 
-    def updateDashboard(self, cpuLoad: float, cpuTemp: float, ip: str, ram: float, sd: float, usb: float) -> None:
-        self.__ipTile.updateValue(ip)
-        self.__cpuLoadTile.updateValue(cpuLoad)
-        self.__cpuTempTile.updateValue(cpuTemp)
-        self.__barRamTile.updateValue(ram)
-        self.__barSdTile.updateValue(sd)
-        self.__barUsbTile.updateValue(usb)
+    def __init__(self, location: tuple[float, float], glyphs: sprites.GlyphCache, name: str):
+        self.__location = location
+        self.__glyphs = glyphs
+        self.__name = name
+        self.__text = ''
+        self.__dirtyBox = None
 
-        self.__updateDisplay()
+    def updateValue(self, value: str) -> None:
+        text = f'{self.__name}: {value}'
+        if text != self.__text:
+            self.__markDirty(self.__glyphs.eraseText(self.__location, self.__text, self.__INK_BKG))
+            self.__text = text
+            self.__markDirty(self.__glyphs.drawText(self.__location, self.__text, self.__INK))
 
-    def clear(self) -> None:
-        self.__draw.rectangle([0, 0, self.__disp.width, self.__disp.height], 0)
-        self.__updateDisplay()
+    def popDirtyBox(self) -> list[float]:
+        """
+        Returns bounding box of everything redrawn since the last call or None if nothing changed.
+        """
+        box, self.__dirtyBox = self.__dirtyBox, None
+        return box
 
-    def greetings(self, name: str) -> None:
-        font_size = 14
-        font = ImageFont.truetype('/home/pi/.fonts/SoletoTK.ttf', font_size)
+    def __markDirty(self, box: list[float]) -> None:
+        self.__dirtyBox = mergeBox(self.__dirtyBox, box)
 
-        location_hello = [(self.__disp.width - self.__draw.textlength('HELLO', font)) / 2, self.__disp.height / 2 - font_size - 2]
-        self.__draw.text(location_hello, 'HELLO', 255, font)
+class DashBoard():
 
-        location_name = [(self.__disp.width - self.__draw.textlength(name, font)) / 2, self.__disp.height / 2 + 2]
-        self.__draw.text(location_name, name, 255, font)
+    # Constants
+    __FONT_SIZE = 10            # Font size
+    __DEVICE_PAGE_UPDATES = 5   # Dashboard updates every discovered drive is shown for in the USB bar
+    __PREFETCH = 2.0            # Time in seconds before a page change the metrics of the next page are sampled
+    __CONTRAST = 0xCF           # Contrast of the display, the one set by the Adafruit driver
+    __DIM_CONTRAST = 0x00       # Contrast of the dimmed display
+
+    def __init__(self, disp, pages: layout.Layout = None, dimAfter: float = None, blankAfter: float = None):
+        """
+        Initializes the dashboard.
+        disp: display of a hardware backend.
+        pages: layout of the dashboard pages, the default pages if not given.
+        dimAfter: time in seconds without changing system values after which the display is dimmed, never if not given.
+        blankAfter: time in seconds without changing system values after which the display is switched off, never if not given.
+        """
+        self.__disp = disp
+        self.__image = Image.new('1', (self.__disp.width, self.__disp.height))  # Create blank image for drawing. Make sure to create image with mode '1' for 1-bit color.
+        self.__draw = ImageDraw.Draw(self.__image)                              # Get drawing object to draw on image.
+        self.__font = ImageFont.truetype(fontPath(), self.__FONT_SIZE)          # Define a new true type font for drawing text
+        self.__glyphs = sprites.GlyphCache(self.__image, self.__font)          # Rasterize glyphs of the font once for all tiles
+
+        self.__layout = layout.Layout(height=self.__disp.height) if pages is None else pages
+        self.__histories = None
+        self.__page = 0
+        self.__pageEnd = 0.0
+        self.__tiles = []
+        self.__drawnTiles = []
+        self.__updates = 0
+        self.__devices = None
+        self.__deviceLabels = []
+        self.__overlayEnd = None
+        self.__dimAfter = dimAfter
+        self.__blankAfter = blankAfter
+        self.__power = 'on'
+
+        self.__disp.begin()     # Initialize and clear display
+
+    @property
+    def page(self) -> int:
+        """Index of the visible page."""
+        return self.__page
+
+    def metrics(self) -> set[str]:
+        """
+        Returns names of the cached metrics the next update needs: those of the visible
+        page, of the following page shortly before it is shown and of all sparklines.
+        """
+        metrics = self.__layout.metrics(self.__page) | self.__layout.historyMetrics()
+        pageCount = len(self.__layout.pages)
+        if pageCount > 1 and time.monotonic() >= self.__pageEnd - self.__PREFETCH:
+            metrics = metrics | self.__layout.metrics((self.__page + 1) % pageCount)
+        return metrics
+
+    def updateDashboard(self, snapshot: common.SystemSnapshot, dutyCycle: int = 0, idleTime: float = 0.0) -> None:
+        """
+        Redraws tiles of the visible page whose values changed and rotates pages.
+        snapshot: sampled system state.
+        dutyCycle: duty cycle of the cpu fan in percent.
+        idleTime: time in seconds the system values did not change, dims or blanks the display.
+        """
+        if self.__overlayEnd is not None:
+            if time.monotonic() < self.__overlayEnd:
+                return      # Greeting is shown, tiles are drawn once it ends
+            self.__overlayEnd = None
+            self.__showPage(self.__page, snapshot)
+
+        if not self.__setPower(idleTime):
+            return          # Display is off, nothing is drawn until the values change again
+
+        pageCount = len(self.__layout.pages)
+        if pageCount > 1 and time.monotonic() >= self.__pageEnd:
+            self.__showPage((self.__page + 1) % pageCount, snapshot)
+
+        with profiler.stage('render'):
+            for update in self.__tiles:
+                update(snapshot, dutyCycle)
+        self.__updates += 1
+
+        # Send only the regions redrawn by the tiles, nothing at all if no value changed
+        boxes = [box for box in (tile.popDirtyBox() for tile in self.__drawnTiles) if box is not None]
+        if boxes:
+            with profiler.stage('push'):
+                self.__updateRegions(boxes)
 
+    def clear(self) -> None:
+        self.__overlayEnd = None
+        self.__draw.rectangle([0, 0, self.__disp.width, self.__disp.height], 0)
         self.__updateDisplay()
 
-    def initializeTiles(self) -> None:
-        self.__ipTile = IpTile([25, 0], self.__draw, self.__font, self.__FONT_SIZE, self.__disp.width)
-        self.__cpuLoadTile = CpuLoadTile([15, 19], self.__draw, self.__font)
-        self.__cpuTempTile = CpuTemperatureTile([15, 30], self.__draw, self.__font)
-        self.__barRamTile = BarTile([37, 11], self.__draw, self.__font, self.__FONT_SIZE, self.__disp.width, 'RAM', common.getTotalRam(), 'Gi')
-        self.__barSdTile = BarTile([37, 28], self.__draw, self.__font, self.__FONT_SIZE, self.__disp.width, 'SD', common.getTotalSd(), 'Gi')
-        self.__barUsbTile = BarTile([37, 45], self.__draw, self.__font, self.__FONT_SIZE, self.__disp.width, 'USB', common.getTotalUsb(), 'Gi')
-
-        self.__updateDisplay()
+    def greetings(self, name: str, duration: float = 0.0) -> None:
+        """
+        Shows a greeting on top of the dashboard. Tiles can be initialized meanwhile,
+        they are shown by the first update after the greeting ended.
+        name: greeted name.
+        duration: time in seconds the greeting is shown at least.
+        """
+        font_size = 14
+        font = ImageFont.truetype(fontPath(), font_size)
+        overlay = Image.new('1', (self.__disp.width, self.__disp.height))
+        draw = ImageDraw.Draw(overlay)
+
+        location_hello = [(self.__disp.width - draw.textlength('HELLO', font)) / 2, self.__disp.height / 2 - font_size - 2]
+        draw.text(location_hello, 'HELLO', 255, font)
+
+        location_name = [(self.__disp.width - draw.textlength(name, font)) / 2, self.__disp.height / 2 + 2]
+        draw.text(location_name, name, 255, font)
+
+        self.__overlayEnd = time.monotonic() + duration
+        self.__disp.showImage(overlay)
+
+    def initializeTiles(self, snapshot: common.SystemSnapshot, histories: common.SnapshotHistory = None) -> None:
+        """
+        Draws all tiles of the first page.
+        snapshot: sampled system state to take total values from.
+        histories: metric histories sparklines are drawn from, needed if the layout has sparklines.
+        """
+        self.__histories = histories
+        self.__showPage(0, snapshot)
+
+    def __showPage(self, page: int, snapshot: common.SystemSnapshot) -> None:
+        """
+        Creates the tiles of a page at their computed positions and sends the whole image.
+        page: index of the page.
+        snapshot: sampled system state to take total values from.
+        """
+        self.__draw.rectangle([0, 0, self.__disp.width, self.__disp.height], 0)
+        self.__page = page
+        self.__pageEnd = time.monotonic() + self.__layout.rotation
+        self.__tiles = []
+        self.__drawnTiles = []
+        for placement in self.__layout.pages[page]:
+            self.__createTile(placement, snapshot)
+        for tile in self.__drawnTiles:
+            tile.popDirtyBox()
+
+        if self.__overlayEnd is None:
+            self.__updateDisplay()
+
+    def __createTile(self, placement: layout.Placement, snapshot: common.SystemSnapshot) -> None:
+        """
+        Creates the tiles of a placement and registers functions updating them.
+        placement: tile with its position.
+        snapshot: sampled system state to take total values from.
+        """
+        x, y = placement.location
+        width = self.__disp.width
+        kind, option = placement.kind, placement.option
+        if kind == 'ip':
+            tile = IpTile([x, y], self.__draw, self.__glyphs, self.__FONT_SIZE, width)
+            self.__addTile(tile, lambda snapshot, dutyCycle: tile.updateValue(snapshot.ip))
+        elif kind == 'gauges':
+            loadTile = CpuLoadTile([x + 15, y + 19], self.__draw, self.__glyphs)
+            temperatureTile = CpuTemperatureTile([x + 15, y + 30], self.__draw, self.__glyphs)
+            self.__addTile(loadTile, lambda snapshot, dutyCycle: loadTile.updateValue(snapshot.cpuLoad))
+            self.__addTile(temperatureTile, lambda snapshot, dutyCycle: temperatureTile.updateValue(snapshot.cpuTemperature))
+        elif kind == 'bar' and option == 'ram':
+            tile = BarTile([x, y], self.__draw, self.__glyphs, self.__FONT_SIZE, width, 'RAM', snapshot.totalRam, 'Gi')
+            self.__addTile(tile, lambda snapshot, dutyCycle: self.__updateBar(tile, 'RAM', snapshot.totalRam, snapshot.usedRam))
+        elif kind == 'bar' and option == 'sd':
+            tile = BarTile([x, y], self.__draw, self.__glyphs, self.__FONT_SIZE, width, 'SD', snapshot.totalSd, 'Gi')
+            self.__addTile(tile, lambda snapshot, dutyCycle: self.__updateBar(tile, 'SD', snapshot.totalSd, snapshot.usedSd))
+        elif kind == 'bar' and option == 'usb':
+            tile = BarTile([x, y], self.__draw, self.__glyphs, self.__FONT_SIZE, width, 'USB', snapshot.totalUsb, 'Gi')
+            self.__addTile(tile, lambda snapshot, dutyCycle: self.__updateDeviceBar(tile, snapshot))
+        elif kind == 'sparkline':
+            if self.__histories is None:
+                raise ValueError(f'Sparkline of {option} needs metric histories')
+            history = self.__histories.metric(option)
+            tile = SparklineTile([x, y], self.__draw, self.__glyphs, width, placement.bottom, layout.SPARKLINE_LABELS[option], history, history.capacity)
+            self.__addTile(tile, lambda snapshot, dutyCycle: tile.updateValue())
+        elif kind == 'text' and option == 'fan':
+            tile = TextTile([x, y], self.__glyphs, 'FAN')
+            self.__addTile(tile, lambda snapshot, dutyCycle: tile.updateValue(f'{dutyCycle}%'))
+        elif kind == 'text' and option == 'uptime':
+            tile = TextTile([x, y], self.__glyphs, 'UP')
+            self.__addTile(tile, lambda snapshot, dutyCycle: tile.updateValue(formatUptime(snapshot.uptime)))
+        elif kind == 'text' and option == 'network':
+            interface = placement.argument
+            tile = TextTile([x, y], self.__glyphs, interface.upper() if interface else 'NET')
+            self.__addTile(tile, lambda snapshot, dutyCycle: tile.updateValue(self.__formatThroughput(snapshot, interface)))
+        elif kind == 'text' and option == 'throttle':
+            tile = TextTile([x, y], self.__glyphs, 'SOC')
+            self.__addTile(tile, lambda snapshot, dutyCycle: tile.updateValue(' '.join(common.throttleConditions(snapshot.throttled)) or 'OK'))
+        elif kind == 'text' and option == 'clock':
+            tile = TextTile([x, y], self.__glyphs, 'ARM')
+            self.__addTile(tile, lambda snapshot, dutyCycle: tile.updateValue(f'{snapshot.cpuFrequency}MHz'))
+        elif kind == 'text' and option == 'cores':
+            # Two digits per core, so four cores fit the right column
+            tile = TextTile([x, y], self.__glyphs, 'CPU')
+            self.__addTile(tile, lambda snapshot, dutyCycle: tile.updateValue(' '.join(str(min(99, round(load))) for load in snapshot.coreLoads)))
+
+    def __setPower(self, idleTime: float) -> bool:
+        """
+        Dims or switches off the display once the system values did not change for long enough
+        and wakes it up again. Display memory is kept while it is off.
+        idleTime: time in seconds the system values did not change.
+        Returns state if the display is on.
+        """
+        power = 'on'
+        if self.__blankAfter is not None and idleTime >= self.__blankAfter:
+            power = 'off'
+        elif self.__dimAfter is not None and idleTime >= self.__dimAfter:
+            power = 'dim'
+
+        if power != self.__power:
+            if power == 'off':
+                self.__disp.setPower(False)
+            else:
+                if self.__power == 'off':
+                    self.__disp.setPower(True)
+                self.__disp.setContrast(self.__DIM_CONTRAST if power == 'dim' else self.__CONTRAST)
+            self.__power = power
+        return power != 'off'
+
+    def __addTile(self, tile, update) -> None:
+        self.__drawnTiles.append(tile)
+        self.__tiles.append(update)
+
+    def __formatThroughput(self, snapshot: common.SystemSnapshot, interface: str) -> str:
+        """
+        Formats received and transmitted bytes per second of a network interface.
+        snapshot: sampled system state.
+        interface: name of the interface, the one holding the shown IP address if empty.
+        Returns text like '12.3k/1.2k'.
+        """
+        if interface == '':
+            interface = next((name for name, (ip, _, _) in snapshot.network.items() if ip == snapshot.ip and ip != ''), '')
+        received, transmitted = snapshot.network.get(interface, ('', 0.0, 0.0))[1:]
+        return f'{formatRate(received)}/{formatRate(transmitted)}'
+
+    def __updateBar(self, tile: BarTile, name: str, total: float, used: float) -> None:
+        """
+        Updates a bar taking its total from the same snapshot, so a bar created from a
+        snapshot without totals, e.g. the one sampled at start, is corrected right away.
+        tile: bar tile showing the quantity.
+        name: label of the quantity.
+        total: value of a full bar.
+        used: actual value.
+        """
+        tile.setLabel(name, total)
+        tile.updateValue(used)
+
+    def __updateDeviceBar(self, tile: BarTile, snapshot: common.SystemSnapshot) -> None:
+        """
+        Pages the USB bar through all discovered additional drives.
+        tile: bar tile showing the drives.
+        snapshot: sampled system state.
+        """
+        devices = [device for device, (mountPoint, _, _) in snapshot.disks.items() if common.isExternalMount(mountPoint)]
+        if not devices:
+            tile.setLabel('USB', snapshot.totalUsb)
+            tile.updateValue(snapshot.usedUsb)
+            return
+
+        if devices != self.__devices:
+            self.__devices = devices
+            self.__deviceLabels = deviceLabels(devices)
+        index = self.__updates // self.__DEVICE_PAGE_UPDATES % len(devices)
+        _, total, used = snapshot.disks[devices[index]]
+        tile.setLabel(self.__deviceLabels[index], total)
+        tile.updateValue(used)
 
     def __updateDisplay(self) -> None:
-        self.__disp.image(self.__image) # Draw image into display
-        self.__disp.display()           # Invalidate display
+        self.__disp.showImage(self.__image) # Draw image into display
+
+    def __updateRegions(self, boxes: list[list[float]]) -> None:
+        """
+        Sends only the display memory covering the given regions of the image using
+        the column and page addressing of the SSD1306 controller. Every touched page
+        is sent once, limited to the columns the regions cover in that page.
+        boxes: regions of the image [x0, y0, x1, y1] to be sent.
+        """
+        width = self.__disp.width
+        height = self.__disp.height
+        columns = {}
+        for box in boxes:
+            x0 = max(0, math.floor(box[0]))
+            x1 = min(width - 1, math.ceil(box[2]))
+            page0 = max(0, math.floor(box[1])) // hardware.PAGE_HEIGHT
+            page1 = min(height - 1, math.ceil(box[3])) // hardware.PAGE_HEIGHT
+            if x0 > x1:
+                continue
+            for page in range(page0, page1 + 1):
+                left, right = columns.get(page, (x0, x1))
+                columns[page] = (min(left, x0), max(right, x1))
+
+        for page, (x0, x1) in columns.items():
+            self.__disp.showPages(page, x0, x1, hardware.pageBytes(self.__image, page, x0, x1))
@@ -0,0 +1,137 @@
+# This library serves the latest metrics of the monitoring loop over HTTP in
+# the Prometheus text format, so a fleet of towers can be scraped centrally
+
+import threading
+import http.server
+
+import common
+
+# Constants
+PORT = 9101                 # Default port of the metrics endpoint
+ADDRESS = '0.0.0.0'         # Default address the endpoint listens on
+MI_BYTES = 1024 * 1024     # Bytes of one 'Mi', the unit memory and disk usage are read in
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class MetricsExporter:
+    """
+    HTTP endpoint serving the snapshot last published by the monitoring loop.
+    A scrape never samples anything, it only formats the published values and
+    the formatted text is reused until the next publish. Requests are served by
+    a daemon thread, so the control loop is never blocked by a slow client.
+    """
+
+    def __init__(self, port: int = PORT, address: str = ADDRESS):
+        """
+        Creates a stopped endpoint.
+        port: TCP port to listen on.
+        address: address to listen on.
+        """
+        self.__port = port
+        self.__address = address
+        self.__lock = threading.Lock()
+        self.__state = None
+        self.__payload = b''
+        self.__version = 0
+        self.__payloadVersion = -1
+        self.__server = None
+        self.__thread = None
+
+    def start(self) -> None:
+        """Opens the endpoint and serves requests in a daemon thread."""
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = exporter.payload()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass    # Keep scrapes out of the log
+
+        self.__server = http.server.ThreadingHTTPServer((self.__address, self.__port), Handler)
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__server.serve_forever, name='exporter', daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        """Closes the endpoint."""
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    def publish(self, snapshot: common.SystemSnapshot, dutyCycle: int, ledEffect: str) -> None:
+        """
+        Makes the latest values available to scrapes. Only references are stored,
+        formatting is left to the next scrape.
+        snapshot: latest sampled system state.
+        dutyCycle: duty cycle of the cpu fan in percent.
+        ledEffect: name of the shown LED effect.
+        """
+        with self.__lock:
+            self.__state = (snapshot, dutyCycle, ledEffect)
+            self.__version += 1
+
+    def payload(self) -> bytes:
+        """
+        Returns metrics of the latest published values in Prometheus text format.
+        """
+        with self.__lock:
+            if self.__payloadVersion != self.__version:
+                self.__payload = formatMetrics(*self.__state) if self.__state is not None else b''
+                self.__payloadVersion = self.__version
+            return self.__payload
+
+def escapeLabel(value: str) -> str:
+    """
+    Escapes a label value as the text exposition format requires.
+    value: label value, e.g. a mount point.
+    Returns value with backslash, double quote and newline escaped.
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def formatMetrics(snapshot: common.SystemSnapshot, dutyCycle: int, ledEffect: str) -> bytes:
+    """
+    Formats metrics in Prometheus text format.
+    snapshot: sampled system state.
+    dutyCycle: duty cycle of the cpu fan in percent.
+    ledEffect: name of the shown LED effect.
+    Returns encoded metrics.
+    """
+    lines = []
+
+    def metric(name: str, description: str, samples: list[tuple[str, float]]) -> None:
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} gauge')
+        for labels, value in samples:
+            lines.append(f'{name}{labels} {value}')
+
+    metric('tower_cpu_temperature_celsius', 'CPU temperature.', [('', snapshot.cpuTemperature)])
+    metric('tower_cpu_load_percent', 'CPU load.', [('', snapshot.cpuLoad)])
+    metric('tower_cpu_core_load_percent', 'Load of the CPU core.', [(f'{{core="{core}"}}', load) for core, load in enumerate(snapshot.coreLoads)])
+    metric('tower_cpu_frequency_hertz', 'Actual ARM clock.', [('', snapshot.cpuFrequency * 1000000)])
+    metric('tower_soc_throttled_flags', 'Firmware throttle and under-voltage flags as printed by vcgencmd get_throttled.', [('', snapshot.throttled)])
+    metric('tower_soc_throttle_active', 'Throttle condition of the SoC is active.', [(f'{{condition="{name}"}}', int(bool(snapshot.throttled & (1 << bit)))) for bit, name in common.THROTTLE_FLAGS.items()])
+    # Memory and disk usage in bytes from the readings in Mi, the values in Gi are rounded for the display
+    filesystems = [(f'{{device="{escapeLabel(device)}",mountpoint="{escapeLabel(mountPoint)}"}}', snapshot.disksMi.get(device, (0, 0)))
+                   for device, (mountPoint, _, _) in snapshot.disks.items()]
+    interfaces = {name: escapeLabel(name) for name in snapshot.network}
+    metric('tower_memory_total_bytes', 'Total RAM.', [('', snapshot.ramMi[0] * MI_BYTES)])
+    metric('tower_memory_used_bytes', 'Used RAM.', [('', snapshot.ramMi[1] * MI_BYTES)])
+    metric('tower_filesystem_size_bytes', 'Size of the file system.', [(labels, total * MI_BYTES) for labels, (total, _) in filesystems])
+    metric('tower_filesystem_used_bytes', 'Used memory of the file system.', [(labels, used * MI_BYTES) for labels, (_, used) in filesystems])
+    metric('tower_network_receive_bytes_per_second', 'Received bytes per second of the network interface.', [(f'{{interface="{interfaces[name]}"}}', round(received, 1)) for name, (_, received, _) in snapshot.network.items()])
+    metric('tower_network_transmit_bytes_per_second', 'Transmitted bytes per second of the network interface.', [(f'{{interface="{interfaces[name]}"}}', round(transmitted, 1)) for name, (_, _, transmitted) in snapshot.network.items()])
+    metric('tower_network_address_info', 'IPv4 address of the network interface.', [(f'{{interface="{interfaces[name]}",ip="{escapeLabel(ip)}"}}', 1) for name, (ip, _, _) in snapshot.network.items() if ip != ''])
+    metric('tower_fan_duty_cycle_percent', 'Duty cycle of the cpu fan.', [('', dutyCycle)])
+    metric('tower_led_effect_info', 'Shown LED effect.', [(f'{{effect="{escapeLabel(ledEffect)}"}}', 1)])
+    metric('tower_ip_info', 'IPv4 address of the tower.', [(f'{{ip="{escapeLabel(snapshot.ip)}"}}', 1)])
+    lines.append('')
+    return '\n'.join(lines).encode('utf-8')
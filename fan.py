@@ -1,5 +1,95 @@
 # This code automatically adjusts cpu fan speed depending on the cpu temperature.
 
+import time
+import collections
+
+# Available control modes of the cpu fan
+MODES = ('step', 'curve', 'pid', 'predict')
+
+# Constants
+HORIZON = 10.0          # Default time in seconds the temperature is predicted ahead
+WINDOW = 10             # Count of latest readings the temperature trend is fitted to
+LOAD_GAIN = 0.005       # Temperature rise in grad per second for every percent the load exceeds its recent average
+
+class ThermalPredictor:
+    """
+    Estimates the cpu temperature a few seconds ahead. The trend of the latest
+    readings is extrapolated and a load above its recent average adds heat the
+    sensor does not show yet. Every prediction is compared with the reading
+    once its time has come, so the prediction error can be reported.
+    """
+
+    def __init__(self, horizon: float = HORIZON, window: int = WINDOW):
+        """
+        Creates a predictor without readings.
+        horizon: time in seconds the temperature is predicted ahead.
+        window: count of latest readings the trend is fitted to.
+        """
+        self.horizon = horizon
+        self.__readings = collections.deque(maxlen=window)
+        self.__pending = collections.deque()
+        self.__errorCount = 0
+        self.__errorSum = 0.0
+        self.__absoluteErrorSum = 0.0
+
+    def predict(self, timestamp: float, temperature: float, load: float = None) -> float:
+        """
+        Records a reading and predicts the temperature a horizon ahead.
+        timestamp: monotonic time of the reading in seconds.
+        temperature: actual cpu temperature.
+        load: actual cpu load in percent, the trend alone is extrapolated if not given.
+        Returns predicted temperature.
+        """
+        self.__evaluate(timestamp, temperature)
+        self.__readings.append((timestamp, temperature, load))
+
+        prediction = temperature
+        if len(self.__readings) >= 3:
+            slope = self.__slope()
+            if load is not None:
+                loads = [reading[2] for reading in self.__readings if reading[2] is not None]
+                slope += LOAD_GAIN * (load - sum(loads) / len(loads))
+            prediction = temperature + slope * self.horizon
+        self.__pending.append((timestamp + self.horizon, prediction))
+        return prediction
+
+    def error(self) -> dict:
+        """
+        Returns dictionary of count, mean absolute error and mean error (bias) of the evaluated predictions in grad.
+        """
+        if self.__errorCount == 0:
+            return {'count': 0, 'meanAbsolute': 0.0, 'bias': 0.0}
+        return {'count': self.__errorCount,
+                'meanAbsolute': round(self.__absoluteErrorSum / self.__errorCount, 2),
+                'bias': round(self.__errorSum / self.__errorCount, 2)}
+
+    def reset(self) -> None:
+        """Forgets all readings and pending predictions, the error statistics are kept."""
+        self.__readings.clear()
+        self.__pending.clear()
+
+    def __evaluate(self, timestamp: float, temperature: float) -> None:
+        """
+        Compares the predictions due by now with the actual temperature.
+        """
+        while self.__pending and self.__pending[0][0] <= timestamp:
+            _, prediction = self.__pending.popleft()
+            error = prediction - temperature
+            self.__errorCount += 1
+            self.__errorSum += error
+            self.__absoluteErrorSum += abs(error)
+
+    def __slope(self) -> float:
+        """
+        Returns least squares slope of the recorded temperatures in grad per second.
+        """
+        count = len(self.__readings)
+        meanTime = sum(reading[0] for reading in self.__readings) / count
+        meanTemperature = sum(reading[1] for reading in self.__readings) / count
+        covariance = sum((reading[0] - meanTime) * (reading[1] - meanTemperature) for reading in self.__readings)
+        variance = sum((reading[0] - meanTime) ** 2 for reading in self.__readings)
+        return covariance / variance if variance > 0 else 0.0
+
 class CPU_FAN:
 
     # Constants
@@ -12,38 +102,99 @@ class CPU_FAN:
     __DUTY_CYCLE_LOW = 80     # duty cycle at 80%
     __DUTY_CYCLE_MID = 90     # duty cycle at 90%
     __DUTY_CYCLE_HIGH = 100   # duty cycle at 100%
+    __DUTY_CYCLE_MIN = 30     # lowest duty cycle the fan keeps spinning at in curve and pid mode
+    __DUTY_CYCLE_KICK = 100   # duty cycle to start a standing fan
+    __KICK_TIME = 1.0         # time in seconds the start duty cycle is held
+    __DUTY_RATE = 20          # largest duty cycle change per second in curve and pid mode
+    __SMOOTHING = 0.3         # weight of a new temperature reading in the smoothed temperature
+    __PID_KP = 8.0            # proportional gain in duty cycle percent per grad
+    __PID_KI = 0.5            # integral gain in duty cycle percent per grad and second
+    __PID_KD = 4.0            # derivative gain in duty cycle percent per grad per second
 
-    def __init__(self, GPIO, channel: int):
+    def __init__(self, GPIO, channel: int, mode: str = 'step', setpoint: float = 50.0, horizon: float = HORIZON):
         """
         Initializes cpu fan GPIO to control fan speed.
         GPIO: GPIO configuration for the board.
         channel: power out pin for cpu fan.
+        mode: control mode, 'step' for fixed duty cycle levels, 'curve' for a duty cycle
+              rising linear with temperature, 'pid' for a controller holding the setpoint
+              or 'predict' for the curve applied to the temperature predicted ahead.
+        setpoint: temperature the pid controller holds.
+        horizon: time in seconds the temperature is predicted ahead in predict mode.
         """
+        if mode not in MODES:
+            raise ValueError(f'Unknown cpu fan mode: {mode}')
+        self.__mode = mode
+        self.__setpoint = setpoint
+        self.__predictor = ThermalPredictor(horizon)
+        self.__hotReadings = 0
+        self.__throttleEvents = 0
+        self.__throttled = False
+
         GPIO.setup(channel, GPIO.OUT)                       # setup fan pin as an output connection
         self.__pwm = GPIO.PWM(channel, self.__FREQUENCY)    # set frequency for power with modulation
         self.__dutyCycle = self.__DUTY_CYCLE_NONE           # initialize starting duty cycle of the fan
         self.__pwm.start(self.__dutyCycle)                  # start modulation with duty cycle 0
+        self.__resetController()
 
-    def setCpuFanSpeed(self, temp: float) -> bool:
+    def setCpuFanSpeed(self, temp: float, load: float = None, throttled: bool = False) -> bool:
         """
         Sets the cpu fan speed accordingly to cpu temperature.
         temp: actual cpu temperature.
+        load: actual cpu load in percent, used by predict mode.
+        throttled: state if the SoC is throttled because of heat, the fan runs at full speed then in every mode.
         Returns state if the cpu fan was turned on.
         """
-        neededDutyCycle = self.__getDutyCycleByTemp(temp)
-        if self.__dutyCycle != self.__DUTY_CYCLE_NONE:
-            if self.__dutyCycle < neededDutyCycle:
+        if temp >= self.__TEMP_LEVEL_HIGH:
+            self.__hotReadings += 1
+        if throttled and not self.__throttled:
+            self.__throttleEvents += 1
+        self.__throttled = throttled
+
+        if self.__mode == 'step':
+            neededDutyCycle = self.__getDutyCycleByTemp(temp)
+            if self.__dutyCycle != self.__DUTY_CYCLE_NONE:
+                if self.__dutyCycle < neededDutyCycle:
+                    self.__dutyCycle = neededDutyCycle
+                elif temp <= (self.__TEMP_LEVEL_LOW - self.__TEMP_TRESHOLD):
+                    self.__dutyCycle = self.__DUTY_CYCLE_NONE
+            else:
                 self.__dutyCycle = neededDutyCycle
-            elif temp <= (self.__TEMP_LEVEL_LOW - self.__TEMP_TRESHOLD):
-                self.__dutyCycle = self.__DUTY_CYCLE_NONE
         else:
-            self.__dutyCycle = neededDutyCycle
+            self.__dutyCycle = self.__getContinuousDutyCycle(temp, load)
+
+        # The controllers keep following the temperature, so they continue smoothly once throttling ended
+        if throttled:
+            self.__dutyCycle = self.__DUTY_CYCLE_HIGH
 
         self.__pwm.ChangeDutyCycle(self.__dutyCycle)
         return self.__dutyCycle != self.__DUTY_CYCLE_NONE
 
+    @property
+    def dutyCycle(self) -> int:
+        """Actual duty cycle of the cpu fan in percent."""
+        return self.__dutyCycle
+
+    @property
+    def mode(self) -> str:
+        """Control mode of the cpu fan."""
+        return self.__mode
+
+    def statistics(self) -> dict:
+        """
+        Returns dictionary of readings at or above the high temperature level, count of
+        times the SoC started throttling and the prediction error in predict mode, so
+        control modes can be compared.
+        """
+        statistics = {'hotReadings': self.__hotReadings, 'throttleEvents': self.__throttleEvents}
+        if self.__mode == 'predict':
+            statistics['predictionError'] = self.__predictor.error()
+        return statistics
+
     def reset(self) -> None:
         self.setCpuFanSpeed(0.0)
+        self.__resetController()
+        self.__predictor.reset()
 
     def clear(self) -> None:
         """Stops the pulse width modulation for cpu fan pin."""
@@ -60,3 +211,92 @@ class CPU_FAN:
         if temperature >= self.__TEMP_LEVEL_MID:  dutyCycle = self.__DUTY_CYCLE_MID
         if temperature >= self.__TEMP_LEVEL_HIGH: dutyCycle = self.__DUTY_CYCLE_HIGH
         return dutyCycle
+
+    def __getContinuousDutyCycle(self, temperature: float, load: float = None) -> int:
+        """
+        Defines the duty cycle in curve, pid and predict mode. The temperature is smoothed,
+        the duty cycle changes at most by the duty rate per second and a standing
+        fan is started with a short kick at full speed.
+        temperature: actual temperature of the cpu.
+        load: actual cpu load in percent.
+        Returns needed duty cycle to control fan speed.
+        """
+        now = time.monotonic()
+        elapsed = 1.0 if self.__lastTime is None else max(now - self.__lastTime, 1e-3)
+        self.__lastTime = now
+
+        previous = self.__smoothed
+        if previous is None:
+            self.__smoothed = temperature
+        else:
+            self.__smoothed += self.__SMOOTHING * (temperature - self.__smoothed)
+
+        controlled = self.__smoothed
+        if self.__mode == 'predict':
+            # A rising prediction spins the fan up early, a falling one never slows it below the reactive curve
+            controlled = max(controlled, self.__predictor.predict(now, temperature, load))
+            lowLevel = self.__TEMP_LEVEL_LOW
+            target = self.__getDutyCycleByCurve(controlled)
+        elif self.__mode == 'curve':
+            lowLevel = self.__TEMP_LEVEL_LOW
+            target = self.__getDutyCycleByCurve(controlled)
+        else:
+            lowLevel = self.__setpoint
+            target = self.__getDutyCycleByPid(controlled, previous, elapsed)
+
+        # Hysteresis: a standing fan starts at the low level, a running fan stops below it minus the treshold
+        if self.__dutyCycle == self.__DUTY_CYCLE_NONE:
+            if controlled < lowLevel:
+                return self.__DUTY_CYCLE_NONE
+            self.__kickEnd = now + self.__KICK_TIME
+            self.__kicking = True
+            return self.__DUTY_CYCLE_KICK
+        if controlled <= lowLevel - self.__TEMP_TRESHOLD:
+            self.__integral = 0.0
+            return self.__DUTY_CYCLE_NONE
+        if now < self.__kickEnd:
+            return self.__DUTY_CYCLE_KICK
+        if self.__kicking:
+            # Kick has just ended, continue right away at the needed duty cycle
+            self.__kicking = False
+            return round(max(self.__DUTY_CYCLE_MIN, target))
+
+        step = self.__DUTY_RATE * elapsed
+        dutyCycle = min(max(target, self.__dutyCycle - step), self.__dutyCycle + step)
+        return round(min(self.__DUTY_CYCLE_HIGH, max(self.__DUTY_CYCLE_MIN, dutyCycle)))
+
+    def __getDutyCycleByCurve(self, temperature: float) -> float:
+        """
+        Defines the duty cycle rising linear from minimum at low level to full speed at high level.
+        temperature: smoothed temperature of the cpu.
+        Returns needed duty cycle to control fan speed.
+        """
+        ratio = (temperature - self.__TEMP_LEVEL_LOW) / (self.__TEMP_LEVEL_HIGH - self.__TEMP_LEVEL_LOW)
+        ratio = min(1.0, max(0.0, ratio))
+        return self.__DUTY_CYCLE_MIN + ratio * (self.__DUTY_CYCLE_HIGH - self.__DUTY_CYCLE_MIN)
+
+    def __getDutyCycleByPid(self, temperature: float, previous: float, elapsed: float) -> float:
+        """
+        Defines the duty cycle holding the setpoint with a pid controller.
+        temperature: smoothed temperature of the cpu.
+        previous: smoothed temperature of the last call or None.
+        elapsed: time in seconds since the last call.
+        Returns needed duty cycle to control fan speed.
+        """
+        error = temperature - self.__setpoint
+        derivative = 0.0 if previous is None else (temperature - previous) / elapsed
+        output = self.__PID_KP * error + self.__PID_KI * self.__integral + self.__PID_KD * derivative
+
+        # Integrate only while the output is not saturated in the direction of the error, so the integral does not wind up
+        saturatedLow = output <= self.__DUTY_CYCLE_MIN and error < 0
+        saturatedHigh = output >= self.__DUTY_CYCLE_HIGH and error > 0
+        if not (saturatedLow or saturatedHigh):
+            self.__integral += error * elapsed
+        return min(self.__DUTY_CYCLE_HIGH, max(self.__DUTY_CYCLE_MIN, output))
+
+    def __resetController(self) -> None:
+        self.__smoothed = None
+        self.__lastTime = None
+        self.__integral = 0.0
+        self.__kickEnd = 0.0
+        self.__kicking = False
@@ -0,0 +1,336 @@
+# This library abstracts the hardware of the tower: PWM pins, the LED strip
+# and the display. Besides the Raspberry Pi backend there is a simulated one
+# recording everything in memory, so the control and render loops can run,
+# be profiled and be tested on any Linux machine.
+
+import os
+import time
+import collections
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from PIL import Image   # Annotations only, PIL is imported on use so the cpu fan does not wait for it at start
+
+try:
+    from rpi_ws281x import PixelStrip, Color
+except ImportError:
+    PixelStrip = None
+
+    def Color(red: int, green: int, blue: int, white: int = 0) -> int:
+        """
+        Convert the provided red, green, blue color to a 24-bit color value.
+        Each color component should be a value 0-255 where 0 is the lowest intensity
+        and 255 is the highest intensity.
+        """
+        return (white << 24) | (red << 16) | (green << 8) | blue
+
+# Constants
+PAGE_HEIGHT = 8         # Pixel rows in one SSD1306 memory page
+RECORD_LENGTH = 1000    # Count of PWM changes, LED frames and display frames kept by simulated hardware
+
+def pageBytes(image: 'Image.Image', page: int, x0: int, x1: int) -> bytearray:
+    """
+    Converts a part of a 1-bit image row into SSD1306 display memory.
+    Every byte holds 8 vertical pixels of one column in a page, lowest bit on top.
+    image: 1-bit image.
+    page: memory page, i.e. row of 8 pixels.
+    x0: first column.
+    x1: last column.
+    Returns display memory bytes of the columns.
+    """
+    pixels = image.load()
+    top = page * PAGE_HEIGHT
+    data = bytearray()
+    for x in range(x0, x1 + 1):
+        bits = 0
+        for bit in range(PAGE_HEIGHT):
+            if pixels[x, top + bit]:
+                bits |= 1 << bit
+        data.append(bits)
+    return data
+
+class SSD1306Display:
+    """
+    SSD1306 128x64 display connected by hardware I2C.
+    """
+
+    # Constants
+    __RST = None            # On the PiOLED this pin isnt used
+    __DATA_CONTROL = 0x40   # I2C control byte for display data
+    __CHUNK_SIZE = 16       # Bytes written in one I2C transfer
+
+    def __init__(self, gpio):
+        import Adafruit_SSD1306 as SSD
+        import Adafruit_GPIO.I2C as I2C
+        self.__ssd = SSD
+        self.__disp = SSD.SSD1306_128_64(rst=self.__RST, gpio=gpio)     # 128x64 display with hardware I2C
+        self.__i2c = I2C.get_i2c_device(SSD.SSD1306_I2C_ADDRESS)        # own handle of the display for partial writes, the one of the driver is private
+        self.width = self.__disp.width
+        self.height = self.__disp.height
+
+    def begin(self) -> None:
+        """Initializes the display and clears it."""
+        self.__disp.begin()     # Initialize display library
+        self.__disp.clear()     # Clear display
+        self.__disp.display()   # Invalidate display
+
+    def showImage(self, image: 'Image.Image') -> None:
+        """
+        Sends a whole image to the display.
+        image: 1-bit image of display size.
+        """
+        self.__disp.image(image)    # Draw image into display
+        self.__disp.display()       # Invalidate display
+
+    def showPages(self, page: int, x0: int, x1: int, data: bytearray) -> None:
+        """
+        Sends a part of one memory page using the column and page addressing of the controller.
+        page: memory page to write.
+        x0: first column to write.
+        x1: last column to write.
+        data: display memory bytes of the columns.
+        """
+        self.__disp.command(self.__ssd.SSD1306_COLUMNADDR)
+        self.__disp.command(x0)
+        self.__disp.command(x1)
+        self.__disp.command(self.__ssd.SSD1306_PAGEADDR)
+        self.__disp.command(page)
+        self.__disp.command(page)
+        for i in range(0, len(data), self.__CHUNK_SIZE):
+            self.__i2c.writeList(self.__DATA_CONTROL, list(data[i:i + self.__CHUNK_SIZE]))
+
+    def setContrast(self, contrast: int) -> None:
+        """
+        Sets the brightness of the pixels.
+        contrast: contrast 0-255.
+        """
+        self.__disp.command(self.__ssd.SSD1306_SETCONTRAST)     # 0x81
+        self.__disp.command(contrast)
+
+    def setPower(self, on: bool) -> None:
+        """
+        Switches the panel on or off, display memory is kept while it is off.
+        on: True to switch the panel on.
+        """
+        self.__disp.command(self.__ssd.SSD1306_DISPLAYON if on else self.__ssd.SSD1306_DISPLAYOFF)   # 0xAF or 0xAE
+
+class PiBackend:
+    """
+    Real hardware of the Raspberry Pi.
+    """
+
+    def __init__(self):
+        self.__gpio = None
+
+    def gpio(self):
+        """
+        Returns RPi.GPIO configured for board pin numbering.
+        """
+        if self.__gpio is None:
+            import RPi.GPIO as GPIO
+            GPIO.setwarnings(False)   # disable warnings about GPIO
+            GPIO.setmode(GPIO.BOARD)  # set GPIO mode to BOARD
+            self.__gpio = GPIO
+        return self.__gpio
+
+    def pixelStrip(self, count: int, pin: int, frequency: int, dma: int, invert: bool, brightness: int, channel: int) -> PixelStrip:
+        """
+        Returns LED strip driven by rpi_ws281x.
+        """
+        return PixelStrip(count, pin, frequency, dma, invert, brightness, channel)
+
+    def display(self) -> SSD1306Display:
+        """
+        Returns SSD1306 display.
+        """
+        return SSD1306Display(self.gpio())
+
+class SimulatedPWM:
+    """
+    PWM pin recording every duty cycle change.
+    """
+
+    def __init__(self, gpio, channel: int, frequency: float):
+        self.__gpio = gpio
+        self.channel = channel
+        self.frequency = frequency
+        self.dutyCycle = 0
+
+    def start(self, dutyCycle: float) -> None:
+        self.ChangeDutyCycle(dutyCycle)
+
+    def ChangeDutyCycle(self, dutyCycle: float) -> None:
+        self.dutyCycle = dutyCycle
+        self.__gpio.pwmChanges.append((time.monotonic(), self.channel, dutyCycle))
+
+    def ChangeFrequency(self, frequency: float) -> None:
+        self.frequency = frequency
+
+    def stop(self) -> None:
+        self.ChangeDutyCycle(0)
+
+class SimulatedGPIO:
+    """
+    Drop in replacement of RPi.GPIO for PWM outputs.
+    """
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+
+    def __init__(self):
+        self.pwmChanges = collections.deque(maxlen=RECORD_LENGTH)   # (monotonic time, channel, duty cycle)
+        self.channels = {}
+
+    def setwarnings(self, enabled: bool) -> None:
+        pass
+
+    def setmode(self, mode: int) -> None:
+        self.mode = mode
+
+    def setup(self, channel: int, direction: int) -> None:
+        self.channels[channel] = direction
+
+    def PWM(self, channel: int, frequency: float) -> SimulatedPWM:
+        return SimulatedPWM(self, channel, frequency)
+
+    def cleanup(self) -> None:
+        self.channels.clear()
+
+class SimulatedPixelStrip:
+    """
+    LED strip recording every shown frame.
+    """
+
+    def __init__(self, count: int, brightness: int = 255):
+        self.__pixels = [0] * count
+        self.brightness = brightness
+        self.frames = collections.deque(maxlen=RECORD_LENGTH)   # (monotonic time, colors)
+
+    def begin(self) -> None:
+        pass
+
+    def numPixels(self) -> int:
+        return len(self.__pixels)
+
+    def setPixelColor(self, n: int, color: int) -> None:
+        self.__pixels[n] = color
+
+    def getPixelColor(self, n: int) -> int:
+        return self.__pixels[n]
+
+    def setBrightness(self, brightness: int) -> None:
+        self.brightness = brightness
+
+    def getBrightness(self) -> int:
+        return self.brightness
+
+    def show(self) -> None:
+        self.frames.append((time.monotonic(), tuple(self.__pixels)))
+
+class SimulatedDisplay:
+    """
+    Display keeping SSD1306 display memory and recording every sent frame.
+    Frames can be dumped as PNG images.
+    """
+
+    def __init__(self, width: int = 128, height: int = 64, frameDir: str = None):
+        """
+        Creates a blank display.
+        width: width in pixels.
+        height: height in pixels, multiple of 8.
+        frameDir: optional directory every frame is written to as PNG.
+        """
+        self.width = width
+        self.height = height
+        self.memory = bytearray(width * height // PAGE_HEIGHT)
+        self.frames = collections.deque(maxlen=RECORD_LENGTH)   # (monotonic time, display memory)
+        self.bytesSent = 0
+        self.contrast = 0xCF    # contrast set by the Adafruit driver for internal vcc
+        self.powered = True
+        self.__frameDir = frameDir
+        self.__frameCount = 0
+        if frameDir is not None:
+            os.makedirs(frameDir, exist_ok=True)
+
+    def begin(self) -> None:
+        self.memory[:] = bytes(len(self.memory))
+        self.__record(len(self.memory))
+
+    def showImage(self, image: 'Image.Image') -> None:
+        for page in range(self.height // PAGE_HEIGHT):
+            self.memory[page * self.width:(page + 1) * self.width] = pageBytes(image, page, 0, self.width - 1)
+        self.__record(len(self.memory))
+
+    def showPages(self, page: int, x0: int, x1: int, data: bytearray) -> None:
+        start = page * self.width + x0
+        self.memory[start:start + len(data)] = data
+        self.__record(len(data))
+
+    def setContrast(self, contrast: int) -> None:
+        self.contrast = contrast
+        self.bytesSent += 2
+
+    def setPower(self, on: bool) -> None:
+        self.powered = on
+        self.bytesSent += 1
+
+    def toImage(self, memory: bytes = None) -> 'Image.Image':
+        """
+        Converts display memory into an image.
+        memory: display memory of a recorded frame, actual memory if not given.
+        Returns 1-bit image.
+        """
+        from PIL import Image     # Imported on use, so the cpu fan does not wait for it at start
+        memory = self.memory if memory is None else memory
+        image = Image.new('1', (self.width, self.height))
+        pixels = image.load()
+        for page in range(self.height // PAGE_HEIGHT):
+            for x in range(self.width):
+                bits = memory[page * self.width + x]
+                for bit in range(PAGE_HEIGHT):
+                    if bits & (1 << bit):
+                        pixels[x, page * PAGE_HEIGHT + bit] = 255
+        return image
+
+    def savePng(self, path: str, index: int = -1) -> None:
+        """
+        Writes a recorded frame as PNG image.
+        path: file to write.
+        index: index of the recorded frame, last frame by default.
+        """
+        self.toImage(self.frames[index][1]).save(path)
+
+    def __record(self, sent: int) -> None:
+        self.bytesSent += sent
+        self.frames.append((time.monotonic(), bytes(self.memory)))
+        if self.__frameDir is not None:
+            self.toImage().save(os.path.join(self.__frameDir, f'frame{self.__frameCount:06d}.png'))
+        self.__frameCount += 1
+
+class SimulatedBackend:
+    """
+    Simulated hardware recording PWM changes, LED frames and display frames in memory.
+    """
+
+    def __init__(self, frameDir: str = None):
+        """
+        Creates simulated hardware.
+        frameDir: optional directory every display frame is written to as PNG.
+        """
+        self.__gpio = SimulatedGPIO()
+        self.__frameDir = frameDir
+        self.strip = None
+        self.screen = None
+
+    def gpio(self) -> SimulatedGPIO:
+        return self.__gpio
+
+    def pixelStrip(self, count: int, pin: int, frequency: int, dma: int, invert: bool, brightness: int, channel: int) -> SimulatedPixelStrip:
+        self.strip = SimulatedPixelStrip(count, brightness)
+        return self.strip
+
+    def display(self) -> SimulatedDisplay:
+        self.screen = SimulatedDisplay(frameDir=self.__frameDir)
+        return self.screen
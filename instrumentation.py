@@ -0,0 +1,247 @@
+# This library measures how long every stage of the monitoring loop takes.
+# It is switched on and off at runtime and costs next to nothing when off.
+
+import os
+import time
+import signal
+import logging
+import cProfile
+import pstats
+import threading
+import contextlib
+import collections
+from array import array
+
+# Constants
+WINDOW = 600                # Count of latest measurements of each stage kept in the rolling histograms
+PROFILE_SECONDS = 30.0      # Length of a profile window in seconds
+BUCKETS_MS = (0.1, 0.5, 1.0, 5.0, 10.0, 50.0, 100.0, 500.0, 1000.0, float('inf'))   # Upper bounds of the histogram buckets in miliseconds
+
+# Shared context returned while instrumentation is off, so a stage costs a single call
+NULL_STAGE = contextlib.nullcontext()
+
+def processAge() -> float:
+    """
+    Measures time since the kernel started this process, so interpreter start
+    and imports are included.
+    Returns seconds since process start with a resolution of one clock tick.
+    """
+    with open('/proc/self/stat') as file:
+        fields = file.read().rpartition(')')[2].split()
+    startTicks = int(fields[19])    # field 22 'starttime' in clock ticks since boot
+    return time.clock_gettime(time.CLOCK_BOOTTIME) - startTicks / os.sysconf('SC_CLK_TCK')
+
+def processCpuTime(pid: int = None) -> float:
+    """
+    Reads user and system cpu time of a process and all of its threads.
+    pid: process id, the calling process if not given.
+    Returns cpu time in seconds or 0.0 if the process is gone.
+    """
+    try:
+        with open(f'/proc/{pid or "self"}/stat') as file:
+            fields = file.read().rpartition(')')[2].split()
+    except OSError:
+        return 0.0
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')    # fields 14 'utime' and 15 'stime' in clock ticks
+
+class RollingHistogram:
+    """
+    Histogram over the latest measurements of one stage. Counts are updated
+    when a measurement enters and when it leaves the window, so recording
+    takes constant time.
+    """
+
+    def __init__(self, window: int = WINDOW):
+        """
+        Creates an empty histogram.
+        window: count of latest measurements kept.
+        """
+        self.__buckets = collections.deque(maxlen=window)
+        self.__counts = array('L', bytes(array('L').itemsize * len(BUCKETS_MS)))
+        self.__window = window
+        self.total = 0
+        self.maximum = 0.0
+
+    def add(self, seconds: float) -> None:
+        """
+        Records a measurement.
+        seconds: measured duration.
+        """
+        milliseconds = seconds * 1000
+        bucket = 0
+        while milliseconds > BUCKETS_MS[bucket]:
+            bucket += 1
+        if len(self.__buckets) == self.__window:
+            self.__counts[self.__buckets[0]] -= 1
+        self.__buckets.append(bucket)
+        self.__counts[bucket] += 1
+        self.total += 1
+        self.maximum = max(self.maximum, milliseconds)
+
+    def counts(self) -> dict[str, int]:
+        """
+        Returns count of measurements in the window per bucket upper bound in miliseconds.
+        """
+        return {f'<={bound:g}ms': count for bound, count in zip(BUCKETS_MS, self.__counts) if count}
+
+class TickProfiler:
+    """
+    Measures stages of the monitoring loop and overruns of the task periods in
+    rolling histograms, and writes cProfile profiles of a fixed time window.
+    """
+
+    def __init__(self, window: int = WINDOW, profileDir: str = '.', profileSeconds: float = PROFILE_SECONDS):
+        """
+        Creates a switched off profiler.
+        window: count of latest measurements kept for each stage.
+        profileDir: directory profiles are written to.
+        profileSeconds: length of a profile window in seconds.
+        """
+        self.enabled = False
+        self.__window = window
+        self.__profileDir = profileDir
+        self.__profileSeconds = profileSeconds
+        self.__histograms = {}
+        self.__overruns = collections.Counter()
+        self.__lock = threading.Lock()
+        self.__profileEnd = 0.0
+        self.__profiles = {}
+
+    def configure(self, profileDir: str = None, profileSeconds: float = None) -> None:
+        """
+        Changes where and how long profiles are written.
+        profileDir: directory profiles are written to.
+        profileSeconds: length of a profile window in seconds.
+        """
+        if profileDir is not None:
+            self.__profileDir = profileDir
+        if profileSeconds is not None:
+            self.__profileSeconds = profileSeconds
+
+    def stage(self, name: str):
+        """
+        Measures a stage used as context manager: 'with profiler.stage('fan'): ...'.
+        name: name of the stage.
+        Returns context manager measuring the stage while instrumentation is on.
+        """
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self, name: str, seconds: float) -> None:
+        """
+        Records duration of a stage.
+        name: name of the stage.
+        seconds: measured duration.
+        """
+        with self.__lock:
+            histogram = self.__histograms.get(name)
+            if histogram is None:
+                histogram = self.__histograms[name] = RollingHistogram(self.__window)
+            histogram.add(seconds)
+
+    def wrap(self, name: str, callback, period: float):
+        """
+        Wraps a periodic task callback to measure it, count calls longer than the
+        period and profile it during a profile window.
+        name: name of the task.
+        callback: function without arguments.
+        period: period of the task in seconds.
+        Returns wrapped function.
+        """
+        def wrapped():
+            if not self.enabled and self.__profileEnd == 0.0:
+                return callback()
+
+            profile = self.__threadProfile()
+            start = time.perf_counter()
+            if profile is not None:
+                profile.enable()
+            try:
+                return callback()
+            finally:
+                if profile is not None:
+                    profile.disable()
+                elapsed = time.perf_counter() - start
+                if self.enabled:
+                    self.record(f'task.{name}', elapsed)
+                    if elapsed > period:
+                        self.__overruns[name] += 1
+        return wrapped
+
+    def toggle(self) -> None:
+        """Switches instrumentation on or off, switching off logs the report."""
+        self.enabled = not self.enabled
+        logging.info(f'Instrumentation {"enabled" if self.enabled else "disabled"}')
+        if not self.enabled:
+            self.logReport()
+
+    def startProfile(self) -> None:
+        """Starts a profile window, the profile is written once it ends."""
+        with self.__lock:
+            self.__profiles = {}
+            self.__profileEnd = time.monotonic() + self.__profileSeconds
+        logging.info(f'Profiling for {self.__profileSeconds} s')
+
+    def report(self) -> dict:
+        """
+        Returns dictionary of histograms, measurement counts and maximum per stage and overruns per task.
+        """
+        with self.__lock:
+            stages = {name: {'count': histogram.total, 'maxMs': round(histogram.maximum, 3), 'histogram': histogram.counts()}
+                      for name, histogram in sorted(self.__histograms.items())}
+            return {'stages': stages, 'overruns': dict(self.__overruns)}
+
+    def logReport(self) -> None:
+        """Writes the report to the log."""
+        logging.info(f'Instrumentation report: {self.report()}')
+
+    def installSignals(self) -> None:
+        """Toggles instrumentation on SIGUSR1 and starts a profile window on SIGUSR2."""
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.toggle())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.startProfile())
+
+    def __threadProfile(self) -> cProfile.Profile:
+        """
+        Returns profile of the calling thread while a profile window is open or None.
+        Writes the profile once the window is over.
+        """
+        if self.__profileEnd == 0.0:
+            return None
+        with self.__lock:
+            if time.monotonic() < self.__profileEnd:
+                return self.__profiles.setdefault(threading.get_ident(), cProfile.Profile())
+            profiles = list(self.__profiles.values())
+            self.__profiles = {}
+            self.__profileEnd = 0.0
+        self.__writeProfile(profiles)
+        return None
+
+    def __writeProfile(self, profiles: list[cProfile.Profile]) -> None:
+        if not profiles:
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        path = os.path.join(self.__profileDir, f'monitoring-{time.strftime("%Y%m%d-%H%M%S")}.prof')
+        stats.dump_stats(path)
+        logging.info(f'Profile written to {path}')
+
+class _Stage:
+    """Context manager measuring one stage."""
+
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler: TickProfiler, name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+profiler = TickProfiler()
@@ -0,0 +1,143 @@
+# This library turns a declarative page and tile configuration of the
+# dashboard into tile positions and the metrics every page needs
+
+import json
+
+# Constants
+ROTATION = 10.0         # Default time in seconds every page is shown for
+HEADER_HEIGHT = 11      # Pixel rows of the IP header
+GAUGES_WIDTH = 37       # Pixel columns of the gauge column on the left
+HEADER_INDENT = 25      # First column of the IP header next to the gauges
+
+# Pixel rows every tile of the right column takes, the last tile may reach 2 rows beyond the display
+ROW_HEIGHTS = {'bar': 17, 'sparkline': 19, 'text': 11}
+
+# Options of the tiles with the cached metrics they are sampled from
+BAR_METRICS = {'ram': {'ram'}, 'sd': {'sd'}, 'usb': {'usb', 'disks'}}
+TEXT_METRICS = {'fan': set(), 'uptime': {'uptime'}, 'network': {'ip', 'addresses', 'network'}, 'throttle': {'throttled'}, 'clock': {'frequency'}, 'cores': {'cores'}}
+SPARKLINE_METRICS = {'cpuTemperature': {'cpuTemperature'}, 'cpuLoad': {'cpuLoad'}, 'usedRam': {'ram'}, 'usedSd': {'sd'}, 'usedUsb': {'usb'}}
+SPARKLINE_LABELS = {'cpuTemperature': 'TMP', 'cpuLoad': 'CPU', 'usedRam': 'RAM', 'usedSd': 'SD', 'usedUsb': 'USB'}
+
+# Dashboard shown without a layout file, the second page shows throttling of the SoC next to its clock and core loads
+DEFAULT_PAGES = [['ip', 'gauges', 'bar:ram', 'bar:sd', 'bar:usb'],
+                 ['ip', 'gauges', 'text:throttle', 'text:clock', 'text:cores', 'text:fan']]
+
+class Placement:
+    """
+    Tile of a page with its computed position.
+    """
+
+    __slots__ = ('kind', 'option', 'argument', 'location', 'bottom', 'metrics')
+
+    def __init__(self, kind: str, option: str, argument: str, location: tuple[float, float], bottom: float, metrics: set[str]):
+        self.kind = kind            # tile type, e.g. 'bar'
+        self.option = option        # shown quantity, e.g. 'ram'
+        self.argument = argument    # optional argument, e.g. network interface
+        self.location = location    # top left corner
+        self.bottom = bottom        # first pixel row below the tile
+        self.metrics = metrics      # cached metrics the tile is sampled from
+
+    def __repr__(self) -> str:
+        return f'Placement({self.kind!r}, {self.option!r}, {self.argument!r}, {self.location!r})'
+
+class Layout:
+    """
+    Pages of the dashboard. Every page is a list of tile specifications like
+    'bar:ram' or 'text:network:wlan0'. 'ip' is drawn as header, 'gauges' as
+    cpu load and temperature column on the left and all other tiles are
+    stacked top down in the right column. Positions are computed once.
+    """
+
+    def __init__(self, pages: list[list[str]] = None, rotation: float = ROTATION, height: int = 64):
+        """
+        Computes positions of all tiles.
+        pages: tile specifications of every page, the default dashboard if not given.
+        rotation: time in seconds every page is shown for.
+        height: display height in pixels.
+        """
+        pages = DEFAULT_PAGES if pages is None else pages
+        if not pages:
+            raise ValueError('Layout has no pages')
+        if rotation <= 0:
+            raise ValueError(f'Invalid page rotation: {rotation}')
+        self.rotation = rotation
+        self.pages = [self.__place(page, height) for page in pages]
+        self.__metrics = [set().union(*(placement.metrics for placement in page)) for page in self.pages]
+        self.__historyMetrics = set().union(*(placement.metrics for page in self.pages for placement in page if placement.kind == 'sparkline'))
+
+    def metrics(self, page: int = None) -> set[str]:
+        """
+        Returns names of the cached metrics the tiles of a page are sampled from.
+        page: index of the page, all pages if not given.
+        """
+        if page is None:
+            return set().union(*self.__metrics)
+        return self.__metrics[page]
+
+    def historyMetrics(self) -> set[str]:
+        """
+        Returns names of the cached metrics shown as sparkline on any page, their history is recorded all the time.
+        """
+        return self.__historyMetrics
+
+    def __place(self, specifications: list[str], height: int) -> list[Placement]:
+        tiles = [parseTile(specification) for specification in specifications]
+        kinds = [kind for kind, _, _ in tiles]
+        left = GAUGES_WIDTH if 'gauges' in kinds else 0
+        top = HEADER_HEIGHT if 'ip' in kinds else 0
+
+        placements = []
+        y = top
+        for kind, option, argument in tiles:
+            if kind == 'ip':
+                placements.append(Placement(kind, option, argument, (HEADER_INDENT if left else 0, 0), HEADER_HEIGHT, {'ip'}))
+            elif kind == 'gauges':
+                placements.append(Placement(kind, option, argument, (0, 0), height, {'cpuLoad', 'cpuTemperature'}))
+            else:
+                rowHeight = ROW_HEIGHTS[kind]
+                if y + rowHeight > height + 2:
+                    raise ValueError(f'Tiles do not fit on the page: {", ".join(specifications)}')
+                metrics = {'bar': BAR_METRICS, 'text': TEXT_METRICS, 'sparkline': SPARKLINE_METRICS}[kind][option]
+                placements.append(Placement(kind, option, argument, (left, y), min(y + rowHeight, height), metrics))
+                y += rowHeight
+        return placements
+
+def parseTile(specification: str) -> tuple[str, str, str]:
+    """
+    Splits and checks a tile specification like 'bar:ram' or 'text:network:wlan0'.
+    specification: tile specification.
+    Returns tuple of tile type, option and argument, empty strings if not given.
+    """
+    kind, _, rest = specification.partition(':')
+    option, _, argument = rest.partition(':')
+    options = {'ip': {''}, 'gauges': {''}, 'bar': BAR_METRICS, 'text': TEXT_METRICS, 'sparkline': SPARKLINE_METRICS}
+    if kind not in options:
+        raise ValueError(f'Unknown tile: {specification}')
+    if option not in options[kind]:
+        raise ValueError(f'Unknown option of {kind} tile: {specification}')
+    return (kind, option, argument)
+
+def loadLayout(path: str, height: int = 64) -> Layout:
+    """
+    Reads a layout file like '{"rotation": 10, "pages": [["ip", "gauges", "bar:ram"], ...]}'.
+    path: JSON layout file.
+    height: display height in pixels.
+    Returns layout.
+    """
+    with open(path) as file:
+        config = json.load(file)
+    return Layout(config['pages'], config.get('rotation', ROTATION), height)
+
+def selectLayout(path: str = None, sparkline: str = None, height: int = 64) -> Layout:
+    """
+    Creates the layout chosen on the command line.
+    path: JSON layout file, overrides the sparkline.
+    sparkline: metric shown as sparkline instead of the USB bar of the first default page.
+    height: display height in pixels.
+    Returns layout of the file, the default pages with a sparkline or the default pages.
+    """
+    if path is not None:
+        return loadLayout(path, height)
+    if sparkline is not None:
+        return Layout([['ip', 'gauges', 'bar:ram', 'bar:sd', f'sparkline:{sparkline}']] + DEFAULT_PAGES[1:], height=height)
+    return Layout(height=height)
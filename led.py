@@ -2,8 +2,12 @@
 # depending on cpu temperature to visually indicate speed of cpu fan rotation
 
 import time
+import math
 import threading
-from rpi_ws281x import PixelStrip, Color
+from array import array
+
+import hardware
+from hardware import PixelStrip, Color
 
 # Constants
 FREQUENCY = 800000    # LED signal frequency 800kHz
@@ -12,17 +16,30 @@ BRIGHTNESS = 255      # Set to 0 for darkest and 255 for brightest
 INVERT = False        # True to invert the signal (when using NPN transistor level shift)
 POSITION_STEP = 85    # Color shift position step for calculation rainbow
 WAIT_MS = 20          # Wait time for rainbow rotation in miliseconds
+TARGET_FPS = 50       # Frame rate of animated effects
+MIN_FPS = 5           # Lowest frame rate used when system is under load
+IDLE_FPS = 10         # Frame rate of animated effects while the system is idle
+FRAME_BUDGET_MS = 5   # Render time of one frame in miliseconds above which the frame rate is reduced
+LOAD_LIMIT = 70.0     # Cpu load in percent above which animations fall back to the lowest frame rate
+FADE_TIME = 0.5       # Time in seconds to crossfade between two effects
+BREATH_PERIOD = 4.0   # Time in seconds of one breathing cycle
+STILL_WAIT = 1.0      # Longest time in seconds between two frames of an effect that is not animated, so a hanging render thread is noticed
+TEMP_COLD = 30.0      # Temperature shown in blue by the temperature effect
+TEMP_HOT = 80.0       # Temperature shown in red by the temperature effect
 
-def init(count: int, pin: int) -> PixelStrip:
+def init(count: int, pin: int, backend=None) -> PixelStrip:
     """
     Initializes LED strip.
     count: count of led pixels in strip.
     pin: GPIO pin connected to the pixels.
+    backend: hardware backend creating the strip, Raspberry Pi hardware by default.
     Returns instance of 'PixelStrip' class ready to be configured.
     """
+    if backend is None:
+        backend = hardware.PiBackend()
     channel = 0
     if pin in [13, 19, 41, 45, 53]: channel = 1
-    strip = PixelStrip(count, pin, FREQUENCY, DMA, INVERT, BRIGHTNESS, channel)
+    strip = backend.pixelStrip(count, pin, FREQUENCY, DMA, INVERT, BRIGHTNESS, channel)
     strip.begin()
     return strip
 
@@ -61,17 +78,336 @@ def wheel(pos: int) -> Color:
         pos -= POSITION_STEP * 2
         return Color(0, pos * 3, 255 - pos * 3)
 
+# Rainbow colors of all 256 wheel positions
+WHEEL = array('I', (wheel(pos) for pos in range(256)))
+
+def gradient(value: float) -> Color:
+    """
+    Generate colors from blue over green to red.
+    value: Position 0.0-1.0 in the gradient, values outside are clamped.
+    Returns instance of the color to be set for given position.
+    """
+    value = min(1.0, max(0.0, value))
+    return WHEEL[(POSITION_STEP * 2 + int(value * POSITION_STEP * 2)) & 255]
+
+def blend(first: Color, second: Color, ratio: float) -> Color:
+    """
+    Mix two colors channel by channel.
+    first: Color at ratio 0.0.
+    second: Color at ratio 1.0.
+    ratio: Share 0.0-1.0 of the second color.
+    Returns instance of the mixed color.
+    """
+    color = 0
+    for shift in (0, 8, 16, 24):
+        a = (first >> shift) & 255
+        b = (second >> shift) & 255
+        color |= int(a + (b - a) * ratio) << shift
+    return color
+
+def scale(color: Color, factor: float) -> Color:
+    """
+    Dim a color.
+    color: Color to be dimmed.
+    factor: Brightness 0.0-1.0.
+    Returns instance of the dimmed color.
+    """
+    return blend(0, color, factor)
+
+class LedState:
+    """
+    System values effects are rendered from.
+    """
+
+    __slots__ = ('temperature', 'dutyCycle', 'cpuLoad')
+
+    def __init__(self, temperature: float = 0.0, dutyCycle: int = 0, cpuLoad: float = 0.0):
+        self.temperature = temperature
+        self.dutyCycle = dutyCycle
+        self.cpuLoad = cpuLoad
+
+class Effect:
+    """
+    Base class of LED effects. An effect renders a frame of colors for all
+    pixels on the cpu fan, the inner light under the display is not touched.
+    Effects that are not animated only change with the system values, so the
+    engine does not render them until those values change.
+    """
+
+    animated = True
+
+    def __init__(self, count: int):
+        """
+        Prepares the effect.
+        count: count of pixels to render.
+        """
+        self.count = count
+
+    def frame(self, t: float, state: LedState) -> array:
+        """
+        Renders one frame.
+        t: time in seconds since the engine was started.
+        state: actual system values.
+        Returns array of colors, one for each pixel.
+        """
+        raise NotImplementedError
+
+class OffEffect(Effect):
+    """All pixels turned off."""
+
+    animated = False
+
+    def frame(self, t: float, state: LedState) -> array:
+        return array('I', bytes(4 * self.count))
+
+class RainbowEffect(Effect):
+    """Rainbow that uniformly distributes itself across all pixels and rotates."""
+
+    __SPEED = 1000 / WAIT_MS   # Wheel positions per second
+
+    def __init__(self, count: int):
+        super().__init__(count)
+        self.__offsets = array('B', (int((i + 1) * 256 / (count + 1)) & 255 for i in range(count)))   # wheel offset of every pixel
+
+    def frame(self, t: float, state: LedState) -> array:
+        position = round(t * self.__SPEED)
+        return array('I', [WHEEL[(offset + position) & 255] for offset in self.__offsets])
+
+class BreathingEffect(Effect):
+    """All pixels slowly pulsing in a color depending on the cpu temperature."""
+
+    def frame(self, t: float, state: LedState) -> array:
+        brightness = (1 - math.cos(2 * math.pi * t / BREATH_PERIOD)) / 2
+        color = scale(gradient((state.temperature - TEMP_COLD) / (TEMP_HOT - TEMP_COLD)), brightness)
+        return array('I', [color] * self.count)
+
+class FanLevelEffect(Effect):
+    """All pixels in a solid color from green to red depending on the cpu fan duty cycle."""
+
+    animated = False
+
+    def frame(self, t: float, state: LedState) -> array:
+        color = Color(0, 0, 0)
+        if state.dutyCycle > 0:
+            color = gradient(0.5 + state.dutyCycle / 200)
+        return array('I', [color] * self.count)
+
+class TemperatureEffect(Effect):
+    """Pixels filled like a thermometer from blue to red depending on the cpu temperature."""
+
+    animated = False
+
+    def frame(self, t: float, state: LedState) -> array:
+        level = (state.temperature - TEMP_COLD) / (TEMP_HOT - TEMP_COLD)
+        colors = array('I', bytes(4 * self.count))
+        for i in range(self.count):
+            # Every pixel lights up once the level reaches its position and shows its part of the gradient
+            fill = min(1.0, max(0.0, level * self.count - i))
+            colors[i] = scale(gradient(i / max(1, self.count - 1)), fill)
+        return colors
+
+# Registry of available effects by name
+EFFECTS = {
+    'off': OffEffect,
+    'rainbow': RainbowEffect,
+    'breathing': BreathingEffect,
+    'fan': FanLevelEffect,
+    'temperature': TemperatureEffect,
+}
+
+def registerEffect(name: str, effect: type) -> None:
+    """
+    Adds an effect to the registry.
+    name: name the effect is selected by.
+    effect: subclass of 'Effect'.
+    """
+    EFFECTS[name] = effect
+
+class StripWriter:
+    """
+    Writes frames to the cpu fan pixels of a strip. Pixels are only written if
+    their color changed and the strip is only shown if the frame differs from
+    the one shown before.
+    """
+
+    def __init__(self, strip: PixelStrip):
+        """
+        Prepares writing to a LED strip.
+        strip: LED strip to be configured.
+        """
+        self.__strip = strip
+        self.count = strip.numPixels() - 1    # first pixel is the inner light
+        self.__frame = array('I', bytes(4 * self.count))
+        self.__valid = False
+
+    def write(self, frame: array) -> bool:
+        """
+        Draws one frame.
+        frame: array of colors, one for each pixel on the cpu fan.
+        Returns state if the strip was updated.
+        """
+        if self.__valid and frame == self.__frame:
+            return False
+
+        for i, color in enumerate(frame):
+            if not self.__valid or color != self.__frame[i]:
+                self.__strip.setPixelColor(i + 1, color)
+        self.__strip.show()
+        self.__frame = frame
+        self.__valid = True
+        return True
+
+    def invalidate(self) -> None:
+        """Forces a full redraw with the next frame, e.g. after the strip was cleared."""
+        self.__valid = False
+
+class LedEngine:
+    """
+    Renders the selected effect in a single long-lived thread. Switching effects
+    crossfades between them without restarting the thread. The frame rate drops
+    when rendering takes longer than the frame budget or the cpu is busy, and
+    effects that are not animated are only rendered when system values change.
+    """
+
+    def __init__(self, strip: PixelStrip, fps: float = TARGET_FPS, budget: float = FRAME_BUDGET_MS / 1000):
+        """
+        Prepares the engine.
+        strip: LED strip to be configured.
+        fps: target frame rate of animated effects.
+        budget: render time of one frame in seconds above which the frame rate is reduced.
+        """
+        self.__writer = StripWriter(strip)
+        self.__targetFps = fps
+        self.__fps = fps
+        self.__budget = budget
+        self.__state = LedState()
+        self.__effectName = 'off'
+        self.__effect = OffEffect(self.__writer.count)
+        self.__previous = None
+        self.__fadeStart = 0.0
+        self.__lock = threading.Lock()
+        self.__wake = threading.Event()
+        self.__stopping = False
+        self.__thread = None
+        self.__lastFrame = time.monotonic()
+
+    @property
+    def effect(self) -> str:
+        """Name of the selected effect."""
+        return self.__effectName
+
+    @property
+    def fps(self) -> float:
+        """Actual frame rate of animated effects."""
+        return self.__fps
+
+    @property
+    def lastFrame(self) -> float:
+        """Monotonic time the render thread last wrote a frame, at most 'STILL_WAIT' ago while it runs."""
+        return self.__lastFrame
+
+    def start(self) -> None:
+        """Starts the render thread."""
+        self.__stopping = False
+        self.__lastFrame = time.monotonic()
+        self.__thread = threading.Thread(target=self.__render, name='led', daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        """Stops the render thread and waits for it to finish."""
+        self.__stopping = True
+        self.__wake.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def setTargetFps(self, fps: float) -> None:
+        """
+        Changes the frame rate of animated effects, e.g. to save power while the system is idle.
+        fps: target frame rate.
+        """
+        self.__targetFps = fps
+        self.__fps = min(self.__fps, fps)
+
+    def setEffect(self, name: str) -> None:
+        """
+        Switches to another effect with a crossfade.
+        name: name of a registered effect.
+        """
+        if name not in EFFECTS:
+            raise KeyError(f'Unknown LED effect: {name}')
+        with self.__lock:
+            if name == self.__effectName:
+                return
+            self.__previous = self.__effect
+            self.__effect = EFFECTS[name](self.__writer.count)
+            self.__effectName = name
+            self.__fadeStart = time.monotonic()
+        self.__wake.set()
+
+    def update(self, temperature: float, dutyCycle: int, cpuLoad: float) -> None:
+        """
+        Hands actual system values to the effects.
+        temperature: actual cpu temperature.
+        dutyCycle: actual duty cycle of the cpu fan.
+        cpuLoad: actual cpu load in percent.
+        """
+        with self.__lock:
+            changed = temperature != self.__state.temperature or dutyCycle != self.__state.dutyCycle
+            self.__state = LedState(temperature, dutyCycle, cpuLoad)
+        if changed:
+            self.__wake.set()
+
+    def invalidate(self) -> None:
+        """Forces a full redraw with the next frame, e.g. after the strip was cleared."""
+        self.__writer.invalidate()
+        self.__wake.set()
+
+    def __render(self) -> None:
+        startTime = time.monotonic()
+        while not self.__stopping:
+            self.__wake.clear()
+            frameStart = time.monotonic()
+            with self.__lock:
+                t = frameStart - startTime
+                fade = (frameStart - self.__fadeStart) / FADE_TIME
+                if fade >= 1.0:
+                    self.__previous = None
+                frame = self.__effect.frame(t, self.__state)
+                if self.__previous is not None:
+                    previous = self.__previous.frame(t, self.__state)
+                    frame = array('I', [blend(old, new, fade) for old, new in zip(previous, frame)])
+                animated = self.__effect.animated or self.__previous is not None
+                busy = self.__state.cpuLoad > LOAD_LIMIT
+            self.__writer.write(frame)
+            self.__lastFrame = time.monotonic()
+
+            # Back off quickly when rendering is too slow or the cpu is busy, recover slowly otherwise
+            elapsed = time.monotonic() - frameStart
+            if busy:
+                self.__fps = MIN_FPS
+            elif elapsed > self.__budget:
+                self.__fps = max(MIN_FPS, self.__fps / 2)
+            else:
+                self.__fps = min(self.__targetFps, self.__fps + 1)
+
+            if animated:
+                self.__wake.wait(max(0.0, 1 / self.__fps - elapsed))
+            else:
+                self.__wake.wait(STILL_WAIT)
+
 def rainbowCycle(strip: PixelStrip, stop_event: threading.Event) -> None:
     """
     Draw rainbow that uniformly distributes itself across all pixels.
     strip: LED strip to be configured.
     stop_event: Threading event to be fired from the host to stop current function.
     """
+    writer = StripWriter(strip)
+    rainbow = RainbowEffect(writer.count)
+    state = LedState()
     while not stop_event.is_set():
         for j in range(256):
-            for i in range(1, strip.numPixels()):
-                strip.setPixelColor(i, wheel((int(i * 256 / strip.numPixels()) + j) & 255))
-            strip.show()
+            writer.write(rainbow.frame(j * WAIT_MS / 1000.0, state))
             time.sleep(WAIT_MS / 1000.0)
 
             if stop_event.is_set():
@@ -0,0 +1,183 @@
+# This library persists metric history in an append-only binary file
+# and exports time ranges of it to CSV
+
+import os
+import sys
+import csv
+import bisect
+import mmap
+import time
+import struct
+import argparse
+from datetime import datetime
+
+# Constants
+RECORD = struct.Struct('<dfffffBxxx')    # timestamp, temperature, load, RAM, SD, USB, fan duty cycle, padding to 32 bytes
+FIELDS = ('timestamp', 'cpuTemperature', 'cpuLoad', 'usedRam', 'usedSd', 'usedUsb', 'dutyCycle')
+MAX_BYTES = 16 * 1024 * 1024    # File size that triggers rotation, about 6 days at one record per second
+BACKUPS = 3                     # Count of rotated files kept
+FLUSH_RECORDS = 120             # Records buffered in memory before they are written
+FLUSH_INTERVAL = 300.0          # Longest time in seconds records are buffered
+
+class MetricStore:
+    """
+    Appends fixed size metric records to a file. Records are buffered in memory
+    and written in batches to spare the SD card. Files are rotated by size,
+    'path.1' being the newest rotated file.
+    """
+
+    def __init__(self, path: str, maxBytes: int = MAX_BYTES, backups: int = BACKUPS, flushRecords: int = FLUSH_RECORDS, flushInterval: float = FLUSH_INTERVAL):
+        """
+        Opens a store.
+        path: file to append records to.
+        maxBytes: file size that triggers rotation.
+        backups: count of rotated files kept.
+        flushRecords: records buffered before they are written.
+        flushInterval: longest time in seconds records are buffered.
+        """
+        self.__path = path
+        self.__maxBytes = maxBytes - maxBytes % RECORD.size
+        self.__backups = backups
+        self.__flushRecords = flushRecords
+        self.__flushInterval = flushInterval
+        self.__buffer = bytearray(RECORD.size * flushRecords)
+        self.__count = 0
+        self.__lastFlush = time.monotonic()
+        self.__repair()
+
+    def append(self, timestamp: float, cpuTemperature: float, cpuLoad: float, usedRam: float, usedSd: float, usedUsb: float, dutyCycle: int) -> None:
+        """
+        Buffers one record and writes the buffer once it is full or old enough.
+        timestamp: unix time of the sample.
+        cpuTemperature: cpu temperature in grad celcius.
+        cpuLoad: cpu load in percent.
+        usedRam: used RAM in Gi.
+        usedSd: used sd card memory in Gi.
+        usedUsb: used usb memory in Gi.
+        dutyCycle: duty cycle of the cpu fan in percent.
+        """
+        RECORD.pack_into(self.__buffer, self.__count * RECORD.size, timestamp, cpuTemperature, cpuLoad, usedRam, usedSd, usedUsb, dutyCycle)
+        self.__count += 1
+        if self.__count >= self.__flushRecords or time.monotonic() - self.__lastFlush >= self.__flushInterval:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes all buffered records to the file, rotating it if it is full."""
+        self.__lastFlush = time.monotonic()
+        if self.__count == 0:
+            return
+
+        data = memoryview(self.__buffer)[:self.__count * RECORD.size]
+        size = os.path.getsize(self.__path) if os.path.exists(self.__path) else 0
+        if size > 0 and size + len(data) > self.__maxBytes:
+            self.__rotate()
+        with open(self.__path, 'ab') as file:
+            file.write(data)
+        self.__count = 0
+
+    def close(self) -> None:
+        """Writes remaining records."""
+        self.flush()
+
+    def __rotate(self) -> None:
+        for index in range(self.__backups - 1, 0, -1):
+            source = f'{self.__path}.{index}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.__path}.{index + 1}')
+        if self.__backups > 0:
+            os.replace(self.__path, f'{self.__path}.1')
+        else:
+            os.remove(self.__path)
+
+    def __repair(self) -> None:
+        # Cut a partly written record left by a power loss, so records stay aligned
+        if os.path.exists(self.__path):
+            size = os.path.getsize(self.__path)
+            if size % RECORD.size != 0:
+                os.truncate(self.__path, size - size % RECORD.size)
+
+def storeFiles(path: str) -> list[str]:
+    """
+    Lists all files of a store.
+    path: file the store appends records to.
+    Returns existing files, oldest first.
+    """
+    files = []
+    index = 1
+    while os.path.exists(f'{path}.{index}'):
+        files.insert(0, f'{path}.{index}')
+        index += 1
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+def query(path: str, start: float = 0.0, end: float = float('inf')):
+    """
+    Reads records of a time range without unpacking whole files. Files are memory
+    mapped and the first record is found by binary search on the timestamps. Records
+    are stamped with the wall clock, which NTP can step back on a Pi without RTC, so
+    a file whose timestamps are out of order is scanned linearly instead.
+    path: file the store appends records to.
+    start: unix time of the first record to read.
+    end: unix time after which reading stops.
+    Returns generator of record tuples in the order of 'FIELDS'.
+    """
+    for name in storeFiles(path):
+        with open(name, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            count = size // RECORD.size
+            if count == 0:
+                continue
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                # Timestamps are the first double of every record
+                with memoryview(data)[:count * RECORD.size] as records, records.cast('d') as doubles:
+                    timestamps = doubles[::RECORD.size // 8].tolist()
+                if sorted(timestamps) == timestamps:
+                    indexes = range(bisect.bisect_left(timestamps, start), bisect.bisect_right(timestamps, end))
+                else:
+                    indexes = [index for index, timestamp in enumerate(timestamps) if start <= timestamp <= end]
+                for index in indexes:
+                    yield RECORD.unpack_from(data, index * RECORD.size)
+
+def exportCsv(path: str, output, start: float = 0.0, end: float = float('inf')) -> int:
+    """
+    Writes records of a time range as CSV.
+    path: file the store appends records to.
+    output: text stream to write to.
+    start: unix time of the first record to export.
+    end: unix time of the last record to export.
+    Returns count of exported records.
+    """
+    writer = csv.writer(output)
+    writer.writerow(('time',) + FIELDS)
+    count = 0
+    for record in query(path, start, end):
+        writer.writerow((datetime.fromtimestamp(record[0]).isoformat(timespec='seconds'), round(record[0], 3)) + tuple(round(value, 1) for value in record[1:]))
+        count += 1
+    return count
+
+def parseTime(value: str) -> float:
+    """
+    Converts a command line time to unix time.
+    value: ISO time like '2024-05-01T12:00' or unix time in seconds.
+    Returns unix time.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+if __name__ == '__main__':
+    # Parse imput parameters to get the store and the time range
+    parser = argparse.ArgumentParser(description='Export persisted metric history to CSV')
+    parser.add_argument('store', type=str, help='metric store file written by monitoring.py')
+    parser.add_argument('-s', '--start', default='0', type=str, help='start of the time range (ISO time or unix time)')
+    parser.add_argument('-e', '--end', default='inf', type=str, help='end of the time range (ISO time or unix time)')
+    parser.add_argument('-o', '--output', default=None, type=str, help='CSV output file, standard output by default')
+    args = parser.parse_args()
+
+    if args.output is None:
+        exportCsv(args.store, sys.stdout, parseTime(args.start), parseTime(args.end))
+    else:
+        with open(args.output, 'w', newline='') as output:
+            exportCsv(args.store, output, parseTime(args.start), parseTime(args.end))
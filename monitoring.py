@@ -2,16 +2,19 @@
 # cpu fan velocity depending on cpu temperature
 # and adjust LED strip of the tower
 
+import sys
 import time
-import threading
+import signal
 import argparse
 import logging
-import RPi.GPIO as GPIO
+import threading
 
 import common
 import led
-from fan import CPU_FAN
-from display import DashBoard
+import hardware
+from fan import CPU_FAN, MODES as FAN_MODES, HORIZON
+from layout import selectLayout, SPARKLINE_LABELS
+from instrumentation import profiler, processAge, processCpuTime, PROFILE_SECONDS
 
 # Initialize GPIO configuration for CPU fan
 FAN_CHANNEL = 8  # Default pin of fany is a physical pin 8 (GPIO14)
@@ -20,77 +23,259 @@ FAN_CHANNEL = 8  # Default pin of fany is a physical pin 8 (GPIO14)
 LED_COUNT = 4    # Number of LED pixels
 LED_PIN = 18     # GPIO pin the led strip is connected to (18 uses PWM!)
 
-GPIO.setwarnings(False)   # disable warnings about GPIO
-GPIO.setmode(GPIO.BOARD)  # set GPIO mode to BOARD
+# Cached metrics sampled every tick, the cpu fan and the LED engine depend on them
+CONTROL_METRICS = {'cpuTemperature', 'cpuLoad', 'throttled'}
+STORE_METRICS = {'ram', 'sd', 'usb'}    # additionally sampled when metric history is persisted
 
-# Initialize CPU fan
-fan = CPU_FAN(GPIO, FAN_CHANNEL)
+# Time in seconds the greeting is shown after start
+GREETING_TIME = 30.0
 
-# Initialize LED strip and working deamon
-strip = led.init(LED_COUNT, LED_PIN)
-stop_event = threading.Event()
-stop_event.set()
-def createLedThread(led, strip, stop_event) -> threading.Thread:
-    thread = threading.Thread(target=led.rainbowCycle, args=(strip, stop_event), daemon=True)
-    return thread
+# Periods of the scheduled tasks in seconds
+SAMPLING_PERIOD = 1.0           # metric sampling
+FAN_PERIOD = 1.0                # cpu fan control
+DISPLAY_PERIOD = 1.0            # dashboard rendering
+SUPERVISOR_PERIOD = 1.0         # check of the worker processes
+USAGE_PERIOD = 3600.0           # report of the used cpu time and the cpu fan statistics
+IDLE_PERIOD = 5.0               # longest period sampling, cpu fan control and rendering are stretched to while idle
 
-# Initialize display dashboard
-dashBoard = DashBoard(GPIO)
+# Hardware is initialized once arguments are parsed and the backend is known
+fan = None
+strip = None
+ledEngine = None
+dashBoard = None
+store = None
+exporter = None
+scheduler = None
+preparation = None
+supervisor = None
+governor = None
 
 try:
     # Parse imput parameters to get greetings name
     parser = argparse.ArgumentParser(description='Monitoring system and controlling cpu fan')
     parser.add_argument('-n', '--name', default='Yuriy', type=str, help='greetings name shown by program start')
+    parser.add_argument('-g', '--greeting', default=GREETING_TIME, type=float, help='time in seconds the greeting is shown')
     parser.add_argument('-l', '--log', default='monitoring.log', type=str, help='log output file')
+    parser.add_argument('-e', '--effect', default='rainbow', choices=list(led.EFFECTS), help='LED effect shown while the cpu fan is on')
+    parser.add_argument('-f', '--fps', default=led.TARGET_FPS, type=float, help='target frame rate of animated LED effects')
+    parser.add_argument('-s', '--sparkline', default=None, choices=list(SPARKLINE_LABELS), help='metric history shown as sparkline instead of the USB bar')
+    parser.add_argument('--layout', default=None, type=str, help='JSON file with pages and tiles of the dashboard, overrides --sparkline')
+    parser.add_argument('-m', '--mode', default='step', choices=FAN_MODES, help='cpu fan control mode')
+    parser.add_argument('-t', '--setpoint', default=50.0, type=float, help='temperature held by the cpu fan in pid mode')
+    parser.add_argument('--horizon', default=HORIZON, type=float, help='time in seconds the temperature is predicted ahead in predict mode')
+    parser.add_argument('-d', '--data', default=None, type=str, help='file to persist metric history to')
+    parser.add_argument('-i', '--idle', action='store_true', help='stretch sampling, cpu fan and display periods while temperature and load are stable')
+    parser.add_argument('--idle-period', default=IDLE_PERIOD, type=float, help='longest period in seconds in idle mode')
+    parser.add_argument('--dim', default=None, type=float, help='dim the display after this many seconds of stable temperature and load')
+    parser.add_argument('--blank', default=None, type=float, help='switch the display off after this many seconds of stable temperature and load')
+    parser.add_argument('-w', '--workers', action='store_true', help='run display and LED strip in supervised worker processes, so they cannot stop the cpu fan')
+    parser.add_argument('--simulate', action='store_true', help='run on simulated hardware instead of the Raspberry Pi')
+    parser.add_argument('--frames', default=None, type=str, help='directory simulated display frames are written to as PNG')
+    parser.add_argument('-x', '--metrics-port', default=None, type=int, help='port of an HTTP endpoint serving metrics in Prometheus text format')
+    parser.add_argument('--metrics-address', default='0.0.0.0', type=str, help='address the metrics endpoint listens on')
+    parser.add_argument('-p', '--profile', action='store_true', help='start with tick instrumentation on, SIGUSR1 toggles it at runtime')
+    parser.add_argument('--profile-dir', default='.', type=str, help='directory a cProfile of the next window is written to on SIGUSR2')
+    parser.add_argument('--profile-seconds', default=PROFILE_SECONDS, type=float, help='length of the profiled window in seconds')
+    parser.add_argument('-r', '--refresh', default=[], action='append', type=str, metavar='METRIC=SECONDS', help=f'refresh interval of a cached metric ({", ".join(common.REFRESH_INTERVALS)})')
     args = parser.parse_args()
 
     # Initialize logging
     logging.basicConfig(filename=args.log, encoding='utf-8', level=logging.INFO)
 
+    # Stopping the service runs the same shutdown as an interrupt, so buffered records are written and the hardware is cleared
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Setup instrumentation, signals switch it at runtime
+    profiler.configure(args.profile_dir, args.profile_seconds)
+    profiler.enabled = args.profile
+    profiler.installSignals()
+
+    # Start sampling and setup metric refresh intervals
+    common.start()
+    for refresh in args.refresh:
+        metric, _, seconds = refresh.partition('=')
+        common.cache.setInterval(metric, float(seconds))
+
+    # Select hardware backend, every device is initialized on first use
+    backend = hardware.SimulatedBackend(args.frames) if args.simulate else hardware.PiBackend()
+
+    # Initialize CPU fan and control it right away, the cpu is busiest while booting
+    fan = CPU_FAN(backend.gpio(), FAN_CHANNEL, args.mode, args.setpoint, args.horizon)
     fan.reset()
-    led.clear(strip)
-    ledThread = None
-
-    dashBoard.greetings(args.name)
-    time.sleep(30)
-    dashBoard.clear()
-    dashBoard.initializeTiles()
-
-    while True:
-        # Setup cpu fan
-        temp = common.getCpuTemperature()
-        isFanOn = fan.setCpuFanSpeed(temp)
-
-        # Setup led strip
-        if isFanOn and stop_event.is_set():
-            stop_event.clear()
-            ledThread = createLedThread(led, strip, stop_event)
-            ledThread.start()
-        elif not isFanOn and not stop_event.is_set():
-            stop_event.set()
-            led.clear(strip)
-
-        # Setup display
-        cpuLoad = common.getCpuLoad()
-        cpuTemp = common.getCpuTemperature()
-        ip = common.getIP()
-        ram = common.getUsedRam()
-        sd = common.getUsedSd()
-        usb = common.getUsedUsb()
-        dashBoard.updateDashboard(cpuLoad, cpuTemp, ip, ram, sd, usb)
-
-        time.sleep(1)
+    snapshot = common.snapshot(CONTROL_METRICS)
+    fan.setCpuFanSpeed(snapshot.cpuTemperature, snapshot.cpuLoad, common.isHeatThrottled(snapshot.throttled))
+    logging.info(f'First cpu fan decision {processAge():.3f} s after start')
+
+    # Modules only needed once the cpu fan runs are imported now, so they do not delay the first decision
+    from metricstore import MetricStore
+    from scheduler import Scheduler, IdleGovernor
+    from exporter import MetricsExporter
+
+    if args.data is not None:
+        store = MetricStore(args.data)
+
+    # Dashboard pages are checked now, so a broken layout file stops the program right away
+    pages = selectLayout(args.layout, args.sparkline)
+    history = common.SnapshotHistory()
+
+    if args.workers:
+        # Display and LED strip are driven by worker processes fed with the snapshots of this process
+        from supervisor import Supervisor
+        workerArguments = ['-l', args.log] + (['--simulate'] if args.simulate else [])
+        supervisor = Supervisor()
+        supervisor.addWorker('led', workerArguments + ['-c', str(LED_COUNT), '-p', str(LED_PIN), '-f', str(args.fps)])
+        supervisor.addWorker('display', workerArguments + ['-n', args.name, '-g', str(args.greeting)]
+                             + (['--dim', str(args.dim)] if args.dim is not None else [])
+                             + (['--blank', str(args.blank)] if args.blank is not None else [])
+                             + (['--layout', args.layout] if args.layout is not None else [])
+                             + (['-s', args.sparkline] if args.sparkline is not None else [])
+                             + (['--frames', args.frames] if args.frames is not None else []))
+    else:
+        from display import DashBoard
+
+        # Initialize LED strip
+        strip = led.init(LED_COUNT, LED_PIN, backend)
+        led.clear(strip)
+        ledEngine = led.LedEngine(strip, args.fps)
+        ledEngine.start()
+
+    def prepareDashboard() -> None:
+        """
+        Initializes the display, shows the greeting and draws the tiles behind it.
+        Runs in the background, the render task shows the tiles once the greeting ended.
+        """
+        global dashBoard
+        try:
+            board = DashBoard(backend.display(), pages, args.dim, args.blank)
+            board.greetings(args.name, args.greeting)
+            # The startup snapshot holds the control metrics only, bars take their totals from a full one
+            board.initializeTiles(common.snapshot(pages.metrics(), snapshot), history)
+            dashBoard = board
+        except Exception as ex:
+            logging.error(f'Dashboard not available: {ex}')
+
+    if supervisor is None:
+        preparation = threading.Thread(target=prepareDashboard, name='dashboard')
+        preparation.start()
+
+    def sampledMetrics() -> set[str]:
+        """
+        Returns names of the cached metrics needed this tick, all of them while the metrics endpoint is served.
+        """
+        if exporter is not None:
+            return None
+        if supervisor is not None:
+            metrics = CONTROL_METRICS | pages.metrics()     # the page shown by the display worker is not known here
+        else:
+            metrics = CONTROL_METRICS | (dashBoard.metrics() if dashBoard is not None else set())
+        if store is not None:
+            metrics |= STORE_METRICS
+        return metrics
+
+    def sampleMetrics() -> None:
+        global snapshot
+        with profiler.stage('sampling'):
+            snapshot = common.snapshot(sampledMetrics(), snapshot)
+        governor.update(snapshot.cpuTemperature, snapshot.cpuLoad)
+        history.record(snapshot)
+        if store is not None:
+            store.append(time.time(), snapshot.cpuTemperature, snapshot.cpuLoad, snapshot.usedRam, snapshot.usedSd, snapshot.usedUsb, fan.dutyCycle)
+
+    def controlFan() -> None:
+        with profiler.stage('fan'):
+            isFanOn = fan.setCpuFanSpeed(snapshot.cpuTemperature, snapshot.cpuLoad, common.isHeatThrottled(snapshot.throttled))
+
+        # Setup led strip, the engine renders in its own thread or in the LED worker
+        effect = args.effect if isFanOn else 'off'
+        with profiler.stage('led'):
+            if supervisor is not None:
+                supervisor.publish((snapshot, fan.dutyCycle, effect, governor.idleTime, governor.idle))
+            else:
+                ledEngine.update(snapshot.cpuTemperature, fan.dutyCycle, snapshot.cpuLoad)
+                ledEngine.setEffect(effect)
+                ledEngine.setTargetFps(led.IDLE_FPS if governor.idle else args.fps)
+
+        if exporter is not None:
+            exporter.publish(snapshot, fan.dutyCycle, effect)
+
+    def renderDashboard() -> None:
+        if dashBoard is not None:
+            dashBoard.updateDashboard(snapshot, fan.dutyCycle, governor.idleTime)
+
+    def cpuTimes() -> dict[str, float]:
+        """
+        Returns cpu time in seconds used so far by this process and every worker.
+        """
+        times = {'daemon': processCpuTime()}
+        if supervisor is not None:
+            times.update({worker.role: worker.cpuTime for worker in supervisor.workers})
+        return times
+
+    cpuUsage = cpuTimes()
+
+    def reportCpuUsage() -> None:
+        global cpuUsage
+        usage = cpuTimes()
+        logging.info(f'Cpu time in seconds of the last hour: { {name: round(seconds - cpuUsage.get(name, 0.0), 2) for name, seconds in usage.items()} }')
+        cpuUsage = usage
+        logging.info(f'Cpu fan statistics: {fan.statistics()}')     # so modes can be compared on a daemon running for weeks
+
+    # Serve latest metrics to scrapes from its own thread
+    if args.metrics_port is not None:
+        exporter = MetricsExporter(args.metrics_port, args.metrics_address)
+        exporter.start()
+
+    # Every hardware path gets its own executor thread, so a stalled display bus does not delay the fan
+    scheduler = Scheduler()
+    stretched = [scheduler.addTask('sampling', SAMPLING_PERIOD, profiler.wrap('sampling', sampleMetrics, SAMPLING_PERIOD), blocking=True),
+                 scheduler.addTask('fan', FAN_PERIOD, profiler.wrap('fan', controlFan, FAN_PERIOD), blocking=True, offset=0.05)]
+    if supervisor is not None:
+        scheduler.addTask('supervisor', SUPERVISOR_PERIOD, supervisor.check, offset=0.1)
+    else:
+        stretched.append(scheduler.addTask('display', DISPLAY_PERIOD, profiler.wrap('display', renderDashboard, DISPLAY_PERIOD), blocking=True, offset=0.1))
+    scheduler.addTask('usage', USAGE_PERIOD, reportCpuUsage, offset=USAGE_PERIOD)
+
+    # Without idle mode the periods are never stretched, the governor only tracks how long the values are stable
+    governor = IdleGovernor(stretched, args.idle_period if args.idle else 0.0)
+    scheduler.run()
 
 except KeyboardInterrupt:
     logging.info('Interrupt by user keyboard input')
     pass
 
+except SystemExit:
+    logging.info('Terminated')
+    pass
+
 except Exception as ex:
     logging.error(ex)
     pass
 
-stop_event.set()    # stop led thread
-led.clear(strip)    # turn off all led pixels
-fan.clear()         # stop cpu fan
-dashBoard.clear()   # clear display
+logging.info(f'Metric cache hits/misses: {common.cache.stats()}')
+if preparation is not None:
+    preparation.join()  # wait for the display to be initialized before clearing it
+if scheduler is not None:
+    logging.info(f'Missed task deadlines: { {task.name: task.overruns for task in scheduler.tasks} }')
+if fan is not None:
+    logging.info(f'Cpu fan statistics: {fan.statistics()}')
+if scheduler is not None:
+    logging.info(f'Cpu time in seconds per hour: { {name: round(seconds * 3600 / processAge(), 2) for name, seconds in cpuTimes().items()} }')
+if profiler.enabled:
+    profiler.logReport()
+if exporter is not None:
+    exporter.stop()     # close metrics endpoint
+if supervisor is not None:
+    logging.info(f'Worker restarts: { {worker.role: worker.restarts for worker in supervisor.workers} }')
+    supervisor.stop()   # stop display and led workers
+if ledEngine is not None:
+    ledEngine.stop()    # stop led render thread
+if store is not None:
+    store.close()       # write buffered metric records
+if strip is not None:
+    led.clear(strip)    # turn off all led pixels
+if fan is not None:
+    fan.clear()         # stop cpu fan
+if dashBoard is not None:
+    dashBoard.clear()   # clear display
+common.stop()           # close kernel watchers and sensor files
 #GPIO.cleanup()     # clean up GPIO board
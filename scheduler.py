@@ -0,0 +1,252 @@
+# This library runs periodic tasks of the monitoring program on an asyncio event loop
+
+import time
+import queue
+import asyncio
+import threading
+import concurrent.futures
+
+# Constants
+IDLE_MAX_PERIOD = 5.0       # Default longest period in seconds tasks are stretched to while the system is idle
+TEMPERATURE_BAND = 1.0      # Change of the cpu temperature in grad ending idle
+LOAD_BAND = 10.0            # Change of the cpu load in percent ending idle
+STABLE_TICKS = 10           # Stable readings after which the periods are doubled
+
+class PeriodicTask:
+    """
+    Calls a function periodically on fixed deadlines of the loop's monotonic clock.
+    Deadlines are computed from the start time and not from the end of the last
+    call, so the period does not drift by the time the work takes.
+    """
+
+    def __init__(self, name: str, period: float, callback, blocking: bool = False, offset: float = 0.0):
+        """
+        Creates a periodic task.
+        name: name of the task used for its executor thread.
+        period: time between two calls in seconds.
+        callback: function without arguments to call.
+        blocking: True if callback does blocking hardware calls and has to run in its own executor thread.
+        offset: delay of the first call in seconds relative to scheduler start.
+        """
+        self.name = name
+        self.period = period
+        self.callback = callback
+        self.offset = offset
+        self.overruns = 0
+        self.__executor = _DaemonExecutor(name) if blocking else None
+        self.__loop = None
+        self.__wake = None
+        self.__lastCall = 0.0
+
+    def setPeriod(self, period: float) -> None:
+        """
+        Changes the period. A shorter period takes effect right away, the task does
+        not sleep out the rest of its old period. Can be called from any thread.
+        period: time between two calls in seconds.
+        """
+        shorter = period < self.period
+        self.period = period
+        if shorter and self.__loop is not None:
+            self.__loop.call_soon_threadsafe(self.__wake.set)
+
+    async def run(self, start: float) -> None:
+        """
+        Runs the task until it is cancelled.
+        start: loop time the scheduler was started at.
+        """
+        loop = asyncio.get_running_loop()
+        self.__wake = asyncio.Event()
+        self.__loop = loop
+        deadline = start + self.offset
+        while True:
+            delay = deadline - loop.time()
+            while delay > 0:
+                try:
+                    await asyncio.wait_for(self.__wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    break
+                # Period got shorter, move the deadline forward
+                self.__wake.clear()
+                deadline = min(deadline, self.__lastCall + self.period)
+                delay = deadline - loop.time()
+
+            self.__lastCall = loop.time()
+            if self.__executor is None:
+                self.callback()
+            else:
+                await asyncio.wrap_future(self.__executor.submit(self.callback))
+
+            # Skip deadlines missed by a slow call instead of running them late
+            deadline += self.period
+            now = loop.time()
+            if now > deadline:
+                missed = int((now - deadline) / self.period) + 1
+                self.overruns += missed
+                deadline += missed * self.period
+
+    def shutdown(self) -> None:
+        """Releases the executor thread without waiting for a hanging call."""
+        if self.__executor is not None:
+            self.__executor.shutdown()
+
+class _DaemonExecutor:
+    """
+    Runs calls one after the other in a daemon thread. Unlike the threads of a
+    'ThreadPoolExecutor', it is not joined at interpreter exit, so a call stuck
+    in a hardware driver does not keep the program from ending.
+    """
+
+    def __init__(self, name: str):
+        self.__calls = queue.SimpleQueue()
+        self.__thread = threading.Thread(target=self.__work, name=name, daemon=True)
+        self.__thread.start()
+
+    def submit(self, callback) -> concurrent.futures.Future:
+        """
+        Queues a call.
+        callback: function without arguments.
+        Returns future of the result.
+        """
+        future = concurrent.futures.Future()
+        self.__calls.put((future, callback))
+        return future
+
+    def shutdown(self) -> None:
+        """Lets the thread end after the running call, without waiting for it."""
+        self.__calls.put(None)
+
+    def __work(self) -> None:
+        while True:
+            call = self.__calls.get()
+            if call is None:
+                return
+            future, callback = call
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(callback())
+            except BaseException as ex:
+                future.set_exception(ex)
+
+class IdleGovernor:
+    """
+    Stretches the periods of tasks while the cpu temperature and load stay within
+    a band around the reading they last left it at. The periods double after every
+    few stable readings up to a limit and snap back to their base as soon as a
+    reading leaves the band.
+    """
+
+    def __init__(self, tasks: list[PeriodicTask], maxPeriod: float = IDLE_MAX_PERIOD, temperatureBand: float = TEMPERATURE_BAND,
+                 loadBand: float = LOAD_BAND, stableTicks: int = STABLE_TICKS):
+        """
+        Creates a governor, the tasks keep their periods until the readings are stable.
+        tasks: tasks to stretch, their actual periods are taken as base.
+        maxPeriod: longest period in seconds, periods are never stretched if not above the base periods.
+        temperatureBand: change of the cpu temperature in grad ending idle.
+        loadBand: change of the cpu load in percent ending idle.
+        stableTicks: stable readings after which the periods are doubled.
+        """
+        self.__tasks = [(task, task.period) for task in tasks]
+        self.__maxPeriod = maxPeriod
+        self.__temperatureBand = temperatureBand
+        self.__loadBand = loadBand
+        self.__stableTicks = stableTicks
+        self.__reference = None
+        self.__stableSince = time.monotonic()
+        self.__stable = 0
+        self.factor = 1
+
+    @property
+    def idle(self) -> bool:
+        """State if the periods are stretched."""
+        return self.factor > 1
+
+    @property
+    def idleTime(self) -> float:
+        """Time in seconds since a reading last left the band."""
+        return time.monotonic() - self.__stableSince
+
+    def update(self, temperature: float, load: float) -> None:
+        """
+        Hands the latest readings to the governor and adjusts the periods.
+        temperature: actual cpu temperature.
+        load: actual cpu load in percent.
+        """
+        if (self.__reference is None or abs(temperature - self.__reference[0]) > self.__temperatureBand
+                or abs(load - self.__reference[1]) > self.__loadBand):
+            self.__reference = (temperature, load)
+            self.__stableSince = time.monotonic()
+            self.__stable = 0
+            if self.factor > 1:
+                self.factor = 1
+                self.__apply()
+            return
+
+        self.__stable += 1
+        if self.__stable >= self.__stableTicks and any(base * self.factor < self.__maxPeriod for _, base in self.__tasks):
+            self.__stable = 0
+            self.factor *= 2
+            self.__apply()
+
+    def __apply(self) -> None:
+        for task, base in self.__tasks:
+            task.setPeriod(max(base, min(base * self.factor, self.__maxPeriod)))
+
+class Scheduler:
+    """
+    Runs independent periodic tasks. A task stuck in a blocking call only delays
+    itself, all other tasks keep their cadence.
+    """
+
+    def __init__(self):
+        self.__tasks = []
+        self.__stopEvent = None
+
+    def addTask(self, name: str, period: float, callback, blocking: bool = False, offset: float = 0.0) -> PeriodicTask:
+        """
+        Adds a periodic task to be run by the scheduler.
+        name: name of the task.
+        period: time between two calls in seconds.
+        callback: function without arguments to call.
+        blocking: True if callback does blocking hardware calls and has to run in its own executor thread.
+        offset: delay of the first call in seconds relative to scheduler start.
+        Returns created task.
+        """
+        task = PeriodicTask(name, period, callback, blocking, offset)
+        self.__tasks.append(task)
+        return task
+
+    @property
+    def tasks(self) -> list[PeriodicTask]:
+        return list(self.__tasks)
+
+    def run(self) -> None:
+        """
+        Runs all tasks until the scheduler is stopped or a task raises an exception.
+        The exception of the failed task is raised again to the caller.
+        """
+        asyncio.run(self.__run())
+
+    def stop(self) -> None:
+        """Stops the scheduler. Can be called from any task callback."""
+        if self.__stopEvent is not None:
+            self.__loop.call_soon_threadsafe(self.__stopEvent.set)
+
+    async def __run(self) -> None:
+        self.__loop = asyncio.get_running_loop()
+        self.__stopEvent = asyncio.Event()
+        start = self.__loop.time()
+        runners = [asyncio.create_task(task.run(start), name=task.name) for task in self.__tasks]
+        stopper = asyncio.create_task(self.__stopEvent.wait())
+        try:
+            done, _ = await asyncio.wait(runners + [stopper], return_when=asyncio.FIRST_COMPLETED)
+            for runner in done:
+                if runner is not stopper:
+                    runner.result()
+        finally:
+            for runner in runners + [stopper]:
+                runner.cancel()
+            await asyncio.gather(*runners, stopper, return_exceptions=True)
+            for task in self.__tasks:
+                task.shutdown()
+            self.__stopEvent = None
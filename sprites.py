@@ -0,0 +1,117 @@
+# This library prepares bitmaps and lookup tables for the display tiles
+# once, so updating a tile is a bitmap blit instead of font rendering
+
+import math
+from PIL import Image, ImageDraw, ImageFont
+
+class GlyphCache:
+    """
+    Rasterizes glyphs of a true type font once and blits them into an image.
+    Digits and units are rendered on creation, any other character the first
+    time it is used.
+    """
+
+    # Constants
+    __PRELOADED = '0123456789.%\'C/: '  # Characters of all tile values and units
+
+    def __init__(self, image: Image, font: ImageFont):
+        """
+        Creates glyph cache for drawing into an image.
+        image: 1-bit image to draw into.
+        font: true type font to rasterize glyphs from.
+        """
+        self.__image = image
+        self.__font = font
+        self.__glyphs = {}
+        for char in self.__PRELOADED:
+            self.__glyph(char)
+
+    def textBox(self, location: tuple[float, float], text: str) -> list[float]:
+        """
+        Measures pixels covered by a text.
+        location: top left corner of the text like for 'ImageDraw.text'.
+        text: text to be measured.
+        Returns bounding box [x0, y0, x1, y1] of the text ink or None for an empty text.
+        """
+        box = None
+        x = location[0]
+        for char in text:
+            mask, left, top, advance = self.__glyph(char)
+            if mask is not None:
+                x0 = round(x + left)
+                y0 = round(location[1] + top)
+                glyphBox = [x0, y0, x0 + mask.width - 1, y0 + mask.height - 1]
+                box = glyphBox if box is None else [min(box[0], glyphBox[0]), min(box[1], glyphBox[1]), max(box[2], glyphBox[2]), max(box[3], glyphBox[3])]
+            x += advance
+        return box
+
+    def drawText(self, location: tuple[float, float], text: str, ink: int) -> list[float]:
+        """
+        Blits a text into the image.
+        location: top left corner of the text like for 'ImageDraw.text'.
+        text: text to be drawn.
+        ink: color of the text.
+        Returns bounding box [x0, y0, x1, y1] of the drawn text or None for an empty text.
+        """
+        x = location[0]
+        for char in text:
+            mask, left, top, advance = self.__glyph(char)
+            if mask is not None:
+                self.__image.paste(ink, (round(x + left), round(location[1] + top)), mask)
+            x += advance
+        return self.textBox(location, text)
+
+    def eraseText(self, location: tuple[float, float], text: str, ink: int) -> list[float]:
+        """
+        Removes a text by filling its whole bounding box, so no pixels are left over.
+        location: top left corner of the text like for 'ImageDraw.text'.
+        text: text to be removed.
+        ink: background color.
+        Returns bounding box [x0, y0, x1, y1] of the removed text or None for an empty text.
+        """
+        box = self.textBox(location, text)
+        if box is not None:
+            self.__image.paste(ink, (box[0], box[1], box[2] + 1, box[3] + 1))
+        return box
+
+    def __glyph(self, char: str) -> tuple:
+        glyph = self.__glyphs.get(char)
+        if glyph is None:
+            left, top, right, bottom = self.__font.getbbox(char)
+            advance = self.__font.getlength(char)
+            mask = None
+            if right > left and bottom > top:
+                mask = Image.new('1', (right - left, bottom - top))
+                ImageDraw.Draw(mask).text((-left, -top), char, 255, self.__font)
+            glyph = (mask, left, top, advance)
+            self.__glyphs[char] = glyph
+        return glyph
+
+class NeedleTable:
+    """
+    Precomputed needle end points of a half circle gauge for values 0-100
+    with a resolution of 0.1, rounded to display pixels.
+    """
+
+    # Constants
+    __STEPS = 1000      # Table entries for the range 0-100
+    __LENGTH = 0.85     # Needle length relative to the gauge radius
+
+    def __init__(self, radius: float):
+        """
+        Computes the table.
+        radius: radius of the gauge.
+        """
+        self.__points = []
+        for step in range(self.__STEPS + 1):
+            angle = math.pi * step / self.__STEPS
+            self.__points.append((round(radius * self.__LENGTH * math.cos(angle)), round(radius * self.__LENGTH * math.sin(angle))))
+
+    def offset(self, value: float) -> tuple[int, int]:
+        """
+        Looks up needle end point for a value.
+        value: gauge value 0-100, values outside are clamped.
+        Returns end point offset (dx, dy) relative to the gauge center with angle 0 pointing right.
+        """
+        step = min(self.__STEPS, max(0, round(value * self.__STEPS / 100)))
+        return self.__points[step]
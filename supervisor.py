@@ -0,0 +1,291 @@
+# This library runs the display and the LED strip in worker processes
+# supervised by the cpu fan process, so a hanging or crashing peripheral
+# never stops the thermal control
+
+import os
+import sys
+import mmap
+import time
+import struct
+import pickle
+import signal
+import logging
+import subprocess
+
+from instrumentation import processCpuTime
+
+# Constants
+CHANNEL_SIZE = 65536        # Bytes of the shared memory channel, far more than a pickled snapshot takes
+HEARTBEAT_SLOTS = 8         # Count of workers able to report their heartbeat through one channel
+READ_RETRIES = 10           # Attempts to read a consistent value while the writer publishes
+RESTART_DELAY = 1.0         # Time in seconds before the first restart of a crashed worker
+RESTART_DELAY_MAX = 60.0    # Longest time in seconds between restarts, the delay doubles with every crash up to it
+STABLE_TIME = 60.0          # Time in seconds a worker has to run before its restart delay is reset
+START_TIMEOUT = 30.0        # Time in seconds a started worker may take to report its first heartbeat
+HEARTBEAT_TIMEOUT = 10.0    # Time in seconds without heartbeat after which a worker is considered hung
+STOP_TIMEOUT = 3.0          # Time in seconds a stopped worker gets to clean up before it is killed
+WORKER_NICENESS = 10        # Niceness added to workers, so the cpu fan process gets the cpu first
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+
+class SnapshotChannel:
+    """
+    Latest published value in anonymous shared memory, handed to the worker
+    processes as inherited file descriptor, so nothing is left behind in the
+    file system however the processes end. The writer never waits: it makes a sequence number odd, writes the value and
+    makes the sequence even again. Readers retry while the sequence is odd or
+    changed during their read, so no lock is held that a killed worker could
+    leave behind. Every worker also writes its heartbeat into its own slot.
+    """
+
+    # Layout of the mapped file: sequence, payload length, heartbeats, payload
+    __HEADER = struct.Struct('<QI')
+    __HEARTBEAT = struct.Struct('<d')
+    __HEARTBEATS_OFFSET = 16
+    __PAYLOAD_OFFSET = __HEARTBEATS_OFFSET + HEARTBEAT_SLOTS * 8
+
+    def __init__(self, fd: int = None, size: int = CHANNEL_SIZE):
+        """
+        Creates an empty channel or attaches to an inherited one.
+        fd: file descriptor of the channel created by the supervisor, a new channel is created if not given.
+        size: bytes of a new channel.
+        """
+        if fd is None:
+            fd = os.memfd_create('monitoring-channel')
+            os.ftruncate(fd, size)
+        self.__fd = fd
+        self.__memory = mmap.mmap(fd, 0)
+        self.__sequence = 0
+
+    def fileno(self) -> int:
+        """Returns file descriptor of the channel to be inherited by worker processes."""
+        return self.__fd
+
+    def publish(self, value) -> None:
+        """
+        Makes a value available to all readers.
+        value: picklable value.
+        """
+        payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if self.__PAYLOAD_OFFSET + len(payload) > len(self.__memory):
+            raise ValueError(f'Value of {len(payload)} bytes does not fit the channel')
+        self.__sequence += 1
+        self.__HEADER.pack_into(self.__memory, 0, self.__sequence, 0)
+        self.__memory[self.__PAYLOAD_OFFSET:self.__PAYLOAD_OFFSET + len(payload)] = payload
+        self.__sequence += 1
+        self.__HEADER.pack_into(self.__memory, 0, self.__sequence, len(payload))
+
+    def read(self, seen: int = 0) -> tuple[int, object]:
+        """
+        Reads the latest published value.
+        seen: sequence of the value read last time, 0 if none was read.
+        Returns tuple of sequence and value, the value is None if nothing new was published.
+        """
+        for _ in range(READ_RETRIES):
+            sequence, length = self.__HEADER.unpack_from(self.__memory, 0)
+            if sequence == seen or sequence == 0:
+                return (seen, None)
+            if sequence % 2 == 1:
+                time.sleep(0.001)   # Writer is publishing
+                continue
+            payload = self.__memory[self.__PAYLOAD_OFFSET:self.__PAYLOAD_OFFSET + length]
+            if self.__HEADER.unpack_from(self.__memory, 0)[0] != sequence:
+                continue
+            try:
+                return (sequence, pickle.loads(payload))
+            except Exception:
+                continue            # Torn read the sequence did not reveal, try again
+        return (seen, None)
+
+    def beat(self, slot: int) -> None:
+        """
+        Reports that a worker is alive.
+        slot: heartbeat slot of the worker.
+        """
+        self.__HEARTBEAT.pack_into(self.__memory, self.__HEARTBEATS_OFFSET + slot * 8, time.monotonic())
+
+    def heartbeat(self, slot: int) -> float:
+        """
+        Returns monotonic time of the last heartbeat of a worker or 0.0 if it never reported one.
+        slot: heartbeat slot of the worker.
+        """
+        return self.__HEARTBEAT.unpack_from(self.__memory, self.__HEARTBEATS_OFFSET + slot * 8)[0]
+
+    def clearHeartbeat(self, slot: int) -> None:
+        """
+        Forgets the heartbeat of a worker, e.g. before it is restarted.
+        slot: heartbeat slot of the worker.
+        """
+        self.__HEARTBEAT.pack_into(self.__memory, self.__HEARTBEATS_OFFSET + slot * 8, 0.0)
+
+    def close(self) -> None:
+        """Unmaps the channel, the memory is freed once no process has it open anymore."""
+        self.__memory.close()
+        os.close(self.__fd)
+
+class Worker:
+    """
+    Worker process running one peripheral. It is restarted with a growing delay
+    when it exits or stops reporting heartbeats.
+    """
+
+    def __init__(self, role: str, slot: int, arguments: list[str]):
+        """
+        Creates a stopped worker.
+        role: peripheral driven by the worker, 'display' or 'led'.
+        slot: heartbeat slot of the worker in the channel.
+        arguments: additional command line arguments of the worker script.
+        """
+        self.role = role
+        self.slot = slot
+        self.restarts = 0
+        self.__arguments = arguments
+        self.__process = None
+        self.__startTime = 0.0
+        self.__restartTime = 0.0
+        self.__delay = RESTART_DELAY
+        self.__cpuTime = 0.0
+        self.__lastCpuTime = 0.0
+
+    @property
+    def cpuTime(self) -> float:
+        """Cpu time in seconds used by all processes of the worker so far, up to the last check."""
+        return self.__cpuTime + self.__lastCpuTime
+
+    def start(self, channel: SnapshotChannel) -> None:
+        """
+        Starts the worker process.
+        channel: channel the worker reads snapshots from.
+        """
+        channel.clearHeartbeat(self.slot)
+        command = [sys.executable, WORKER_SCRIPT, self.role, '--channel', str(channel.fileno()), '--slot', str(self.slot), '--restart', str(self.restarts)] + self.__arguments
+        # Own session, so an interrupt from the terminal reaches the supervisor only and it stops the workers in order
+        self.__process = subprocess.Popen(command, pass_fds=(channel.fileno(),), start_new_session=True)
+        self.__startTime = time.monotonic()
+
+    def check(self, channel: SnapshotChannel) -> None:
+        """
+        Restarts the worker if it exited or hangs, once its restart delay passed.
+        channel: channel the worker reads snapshots from.
+        """
+        now = time.monotonic()
+        if self.__process is None:
+            if now >= self.__restartTime:
+                self.restarts += 1
+                logging.info(f'Restarting {self.role} worker, restart {self.restarts}')
+                self.start(channel)
+            return
+
+        cpuTime = processCpuTime(self.__process.pid)     # read before the exited process is reaped
+        self.__lastCpuTime = max(self.__lastCpuTime, cpuTime)
+        code = self.__process.poll()
+        heartbeat = channel.heartbeat(self.slot)
+        if code is None:
+            if heartbeat == 0.0 and now - self.__startTime < START_TIMEOUT:
+                return
+            if heartbeat != 0.0 and now - heartbeat < HEARTBEAT_TIMEOUT:
+                return
+            logging.error(f'{self.role.capitalize()} worker hangs, no heartbeat for {now - max(heartbeat, self.__startTime):.1f} s')
+            self.__process.kill()
+            self.__process.wait()
+        else:
+            logging.error(f'{self.role.capitalize()} worker exited with code {code}')
+
+        # Back off from a worker crashing right away, a worker that ran for a while restarts quickly
+        if now - self.__startTime >= STABLE_TIME:
+            self.__delay = RESTART_DELAY
+        self.__restartTime = now + self.__delay
+        self.__delay = min(RESTART_DELAY_MAX, self.__delay * 2)
+        self.__finish()
+
+    def stop(self) -> None:
+        """Asks the worker to clean up and exit, kills it if it does not."""
+        if self.__process is None:
+            return
+        self.__lastCpuTime = max(self.__lastCpuTime, processCpuTime(self.__process.pid))
+        self.__process.terminate()
+        try:
+            self.__process.wait(STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logging.error(f'{self.role.capitalize()} worker did not stop, killing it')
+            self.__process.kill()
+            self.__process.wait()
+        self.__finish()
+
+    def __finish(self) -> None:
+        """Keeps the cpu time of the ended process."""
+        self.__cpuTime += self.__lastCpuTime
+        self.__lastCpuTime = 0.0
+        self.__process = None
+
+class Supervisor:
+    """
+    Publishes snapshots of the cpu fan process to its workers and keeps them running.
+    """
+
+    def __init__(self):
+        """Creates the channel of the workers."""
+        self.__channel = SnapshotChannel()
+        self.__workers = []
+
+    @property
+    def workers(self) -> list[Worker]:
+        return list(self.__workers)
+
+    def addWorker(self, role: str, arguments: list[str]) -> Worker:
+        """
+        Starts a worker process.
+        role: peripheral driven by the worker, 'display' or 'led'.
+        arguments: additional command line arguments of the worker script.
+        Returns started worker.
+        """
+        if len(self.__workers) == HEARTBEAT_SLOTS:
+            raise ValueError(f'No more than {HEARTBEAT_SLOTS} workers supported')
+        worker = Worker(role, len(self.__workers), arguments)
+        worker.start(self.__channel)
+        self.__workers.append(worker)
+        return worker
+
+    def publish(self, value) -> None:
+        """
+        Hands the latest state to all workers.
+        value: picklable value, e.g. tuple of snapshot, duty cycle and LED effect.
+        """
+        self.__channel.publish(value)
+
+    def check(self) -> None:
+        """Restarts exited and hung workers, called periodically."""
+        for worker in self.__workers:
+            worker.check(self.__channel)
+
+    def stop(self) -> None:
+        """Stops all workers and frees the channel."""
+        for worker in self.__workers:
+            worker.stop()
+        self.__channel.close()
+
+def runWorker(channel: SnapshotChannel, slot: int, period: float, handle, alive=None) -> None:
+    """
+    Runs the loop of a worker process: reports heartbeats and hands every newly
+    published value to the peripheral. Returns once the supervisor is gone or
+    the worker is terminated.
+    channel: channel the values are read from.
+    slot: heartbeat slot of the worker.
+    period: time in seconds between two reads.
+    handle: function taking a published value.
+    alive: optional function returning False while a thread of the peripheral hangs, heartbeats stop then.
+    """
+    parent = os.getppid()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        os.nice(WORKER_NICENESS)
+    except OSError:
+        pass
+
+    seen = 0
+    while os.getppid() == parent:
+        if alive is None or alive():
+            channel.beat(slot)
+        seen, value = channel.read(seen)
+        if value is not None:
+            handle(value)
+        time.sleep(period)
@@ -0,0 +1,165 @@
+# Regression tests of the cpu fan control, the LED strip writer and the
+# dashboard partial refresh running against the simulated hardware
+
+from array import array
+
+import pytest
+
+import fan
+import led
+import common
+import hardware
+from display import DashBoard
+
+class Clock:
+    """Monotonic clock advanced by the test."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(fan.time, 'monotonic', clock)
+    return clock
+
+def decide(cpuFan: fan.CPU_FAN, gpio: hardware.SimulatedGPIO, clock: Clock, temperature: float, elapsed: float = 1.0, **kwargs) -> int:
+    """
+    Advances the clock, lets the cpu fan decide and checks the decision reached the pin.
+    Returns duty cycle written to the pin.
+    """
+    clock.now += elapsed
+    cpuFan.setCpuFanSpeed(temperature, **kwargs)
+    _, channel, dutyCycle = gpio.pwmChanges[-1]
+    assert channel == 8
+    assert dutyCycle == cpuFan.dutyCycle
+    return dutyCycle
+
+def snapshot(**values) -> common.SystemSnapshot:
+    defaults = dict(cpuLoad=12.0, cpuTemperature=45.0, ip='192.168.1.20', totalRam=3.7, usedRam=0.9, totalSd=29.3, usedSd=12.4, totalUsb=58.6, usedUsb=20.1)
+    defaults.update(values)
+    return common.SystemSnapshot(**defaults)
+
+def test_step_mode_levels_and_hysteresis(clock):
+    gpio = hardware.SimulatedGPIO()
+    cpuFan = fan.CPU_FAN(gpio, 8, 'step')
+    assert gpio.channels == {8: gpio.OUT}
+    assert decide(cpuFan, gpio, clock, 44.0) == 0
+    assert decide(cpuFan, gpio, clock, 45.0) == 80
+    assert decide(cpuFan, gpio, clock, 56.0) == 90
+    assert decide(cpuFan, gpio, clock, 66.0) == 100
+    assert decide(cpuFan, gpio, clock, 50.0) == 100     # a running fan never slows down in step mode
+    assert decide(cpuFan, gpio, clock, 40.0) == 0
+    assert decide(cpuFan, gpio, clock, 44.0, throttled=True) == 100
+    assert cpuFan.statistics() == {'hotReadings': 1, 'throttleEvents': 1}
+
+def test_curve_mode_kick_and_rate_limit(clock):
+    gpio = hardware.SimulatedGPIO()
+    cpuFan = fan.CPU_FAN(gpio, 8, 'curve')
+    assert decide(cpuFan, gpio, clock, 40.0) == 0
+    cpuFan.reset()
+    assert decide(cpuFan, gpio, clock, 55.0) == 100     # standing fan is kicked
+    assert decide(cpuFan, gpio, clock, 55.0, 0.5) == 100
+    assert decide(cpuFan, gpio, clock, 55.0, 1.0) == 65  # middle of the curve once the kick ended
+    assert decide(cpuFan, gpio, clock, 65.0) == 76       # smoothed 58.0 on the curve
+    assert decide(cpuFan, gpio, clock, 30.0) == 56       # at most 20% slower per second
+    for _ in range(10):
+        decide(cpuFan, gpio, clock, 30.0)
+    assert cpuFan.dutyCycle == 0
+
+def test_pid_mode_holds_setpoint(clock):
+    gpio = hardware.SimulatedGPIO()
+    cpuFan = fan.CPU_FAN(gpio, 8, 'pid', setpoint=50.0)
+    assert decide(cpuFan, gpio, clock, 49.0) == 0
+    cpuFan.reset()
+    assert decide(cpuFan, gpio, clock, 60.0) == 100
+    assert decide(cpuFan, gpio, clock, 60.0, 1.5) == 85  # proportional 80% and integral of the first 2.5 s
+    assert decide(cpuFan, gpio, clock, 45.0) == 65       # falling temperature, at most 20% slower per second
+    dutyCycles = [decide(cpuFan, gpio, clock, 50.0) for _ in range(30)]
+    assert all(30 <= dutyCycle <= 100 for dutyCycle in dutyCycles)
+    assert dutyCycles[-1] == dutyCycles[-2]              # settled at the setpoint
+
+def test_strip_writer_writes_changed_pixels_only():
+    strip = hardware.SimulatedPixelStrip(5)
+    writer = led.StripWriter(strip)
+    assert writer.count == 4
+    assert writer.write(array('I', [1, 2, 3, 4]))
+    assert strip.frames[-1][1] == (0, 1, 2, 3, 4)        # first pixel is the inner light
+    assert not writer.write(array('I', [1, 2, 3, 4]))
+    assert len(strip.frames) == 1
+
+    strip.setPixelColor(1, 99)
+    assert writer.write(array('I', [1, 2, 7, 4]))
+    assert strip.frames[-1][1] == (0, 99, 2, 7, 4)       # unchanged pixels are not written again
+
+    writer.invalidate()
+    assert writer.write(array('I', [1, 2, 7, 4]))
+    assert strip.frames[-1][1] == (0, 1, 2, 7, 4)
+
+def test_dashboard_sends_dirty_regions_only():
+    screen = hardware.SimulatedDisplay()
+    dashBoard = DashBoard(screen)
+    dashBoard.initializeTiles(snapshot())
+    frames = len(screen.frames)
+    sent = screen.bytesSent
+
+    dashBoard.updateDashboard(snapshot())
+    assert len(screen.frames) > frames and screen.bytesSent - sent < len(screen.memory)        # first update draws the values
+    frames = len(screen.frames)
+    sent = screen.bytesSent
+    dashBoard.updateDashboard(snapshot())
+    assert len(screen.frames) == frames and screen.bytesSent == sent                           # nothing changed, nothing sent
+
+    changed = snapshot(cpuTemperature=61.5)
+    dashBoard.updateDashboard(changed)
+    assert 0 < screen.bytesSent - sent < len(screen.memory) // 4                               # only the pages of the gauge
+
+    # Display memory matches a dashboard drawn from scratch
+    reference = hardware.SimulatedDisplay()
+    other = DashBoard(reference)
+    other.initializeTiles(snapshot())
+    other.updateDashboard(changed)
+    assert screen.memory == reference.memory
+
+def test_dashboard_dims_and_blanks():
+    screen = hardware.SimulatedDisplay()
+    dashBoard = DashBoard(screen, dimAfter=10.0, blankAfter=20.0)
+    dashBoard.initializeTiles(snapshot())
+    dashBoard.updateDashboard(snapshot(), idleTime=10.0)
+    assert screen.contrast == 0 and screen.powered
+
+    frames = len(screen.frames)
+    dashBoard.updateDashboard(snapshot(cpuLoad=50.0), idleTime=20.0)
+    assert not screen.powered and len(screen.frames) == frames
+
+    dashBoard.updateDashboard(snapshot(cpuLoad=50.0), idleTime=0.0)
+    assert screen.powered and screen.contrast == 0xCF and len(screen.frames) > frames          # redrawn once woken up
+
+def test_dashboard_bars_take_totals_of_later_snapshots():
+    screen = hardware.SimulatedDisplay()
+    dashBoard = DashBoard(screen)
+    dashBoard.initializeTiles(snapshot(totalRam=0.0, totalSd=0.0))   # e.g. sampled with the control metrics only
+    dashBoard.updateDashboard(snapshot())
+
+    reference = hardware.SimulatedDisplay()
+    other = DashBoard(reference)
+    other.initializeTiles(snapshot())
+    other.updateDashboard(snapshot())
+    assert screen.memory == reference.memory
+
+def test_history_records_sampled_metrics_only():
+    history = common.SnapshotHistory(60)
+    history.record(snapshot())
+    history.record(snapshot(sampled=frozenset({'cpuTemperature', 'cpuLoad'})))
+    assert len(history.metric('cpuTemperature')) == 2
+    assert len(history.metric('usedRam')) == 1
+
+def test_fan_escalates_on_heat_throttling_only():
+    assert common.isHeatThrottled(0b1000)
+    assert common.isHeatThrottled(0b1001)        # soft temperature limit is heat even on under-voltage
+    assert common.isHeatThrottled(0b0110)
+    assert not common.isHeatThrottled(0b0111)    # capped and throttled because of the supply
+    assert not common.isHeatThrottled(0b0001 | 0b0110 << common.THROTTLE_OCCURRED_SHIFT)
@@ -0,0 +1,105 @@
+# This code runs the display or the LED strip of the tower in a worker
+# process started by the supervisor of monitoring.py. It reads snapshots
+# published by the cpu fan process from shared memory.
+
+import time
+import argparse
+import logging
+
+import common
+import led
+import hardware
+from supervisor import SnapshotChannel, runWorker
+
+# Constants
+DISPLAY_PERIOD = 0.25   # Time in seconds between two reads of the display worker
+LED_PERIOD = 0.1        # Time in seconds between two reads of the LED worker
+RENDER_TIMEOUT = 5.0    # Time in seconds without a frame after which the LED render thread is considered hung
+
+def runDisplay(args: argparse.Namespace, backend, channel: SnapshotChannel) -> None:
+    """
+    Shows the dashboard until the worker is stopped. Tiles are drawn once the first snapshot arrives.
+    """
+    from display import DashBoard
+    from layout import selectLayout
+
+    history = common.SnapshotHistory()
+    dashBoard = DashBoard(backend.display(), selectLayout(args.layout, args.sparkline), args.dim, args.blank)
+    if args.restart == 0:
+        dashBoard.greetings(args.name, args.greeting)
+    initialized = False
+
+    def update(value: tuple) -> None:
+        nonlocal initialized
+        snapshot, dutyCycle, _, idleTime, _ = value
+        history.record(snapshot)
+        if not initialized:
+            dashBoard.initializeTiles(snapshot, history)
+            initialized = True
+        dashBoard.updateDashboard(snapshot, dutyCycle, idleTime)
+
+    try:
+        runWorker(channel, args.slot, DISPLAY_PERIOD, update)
+    finally:
+        dashBoard.clear()
+
+def runLed(args: argparse.Namespace, backend, channel: SnapshotChannel) -> None:
+    """
+    Renders LED effects until the worker is stopped.
+    """
+    strip = led.init(args.count, args.pin, backend)
+    led.clear(strip)
+    engine = led.LedEngine(strip, args.fps)
+    engine.start()
+
+    def update(value: tuple) -> None:
+        snapshot, dutyCycle, effect, _, idle = value
+        engine.update(snapshot.cpuTemperature, dutyCycle, snapshot.cpuLoad)
+        engine.setEffect(effect)
+        engine.setTargetFps(led.IDLE_FPS if idle else args.fps)
+
+    def alive() -> bool:
+        # The render thread writes a frame at least every 'led.STILL_WAIT' seconds, heartbeats stop once it hangs
+        return time.monotonic() - engine.lastFrame < RENDER_TIMEOUT
+
+    try:
+        runWorker(channel, args.slot, LED_PERIOD, update, alive)
+    finally:
+        engine.stop()
+        led.clear(strip)
+
+if __name__ == '__main__':
+    # Parse imput parameters given by the supervisor
+    parser = argparse.ArgumentParser(description='Worker process driving the display or the LED strip')
+    parser.add_argument('role', choices=['display', 'led'], help='peripheral driven by the worker')
+    parser.add_argument('--channel', required=True, type=int, help='inherited file descriptor of the shared memory snapshots are read from')
+    parser.add_argument('--slot', required=True, type=int, help='heartbeat slot of the worker')
+    parser.add_argument('--restart', default=0, type=int, help='count of restarts of the worker so far')
+    parser.add_argument('-l', '--log', default='monitoring.log', type=str, help='log output file')
+    parser.add_argument('--simulate', action='store_true', help='run on simulated hardware instead of the Raspberry Pi')
+    parser.add_argument('--frames', default=None, type=str, help='directory simulated display frames are written to as PNG')
+    parser.add_argument('-n', '--name', default='Yuriy', type=str, help='greetings name shown by first start')
+    parser.add_argument('-g', '--greeting', default=0.0, type=float, help='time in seconds the greeting is shown')
+    parser.add_argument('-s', '--sparkline', default=None, type=str, help='metric history shown as sparkline instead of the USB bar')
+    parser.add_argument('--layout', default=None, type=str, help='JSON file with pages and tiles of the dashboard')
+    parser.add_argument('--dim', default=None, type=float, help='dim the display after this many seconds of stable temperature and load')
+    parser.add_argument('--blank', default=None, type=float, help='switch the display off after this many seconds of stable temperature and load')
+    parser.add_argument('-c', '--count', default=4, type=int, help='count of LED pixels')
+    parser.add_argument('-p', '--pin', default=18, type=int, help='GPIO pin the LED strip is connected to')
+    parser.add_argument('-f', '--fps', default=led.TARGET_FPS, type=float, help='target frame rate of animated LED effects')
+    args = parser.parse_args()
+
+    logging.basicConfig(filename=args.log, encoding='utf-8', level=logging.INFO, format=f'%(levelname)s:{args.role}:%(message)s')
+
+    backend = hardware.SimulatedBackend(args.frames) if args.simulate else hardware.PiBackend()
+    channel = SnapshotChannel(args.channel)
+    try:
+        if args.role == 'display':
+            runDisplay(args, backend, channel)
+        else:
+            runLed(args, backend, channel)
+    except Exception as ex:
+        logging.exception(ex)
+        raise SystemExit(1)
+    finally:
+        channel.close()